@@ -0,0 +1,478 @@
+
+"""
+End-to-end throughput benchmark of the report pipeline and the API. \n
+Seeds a fresh database with N users and M locations, replays a synthetic
+report stream through `ReportMessage` -> `Routine._process_report` (or
+`Routine._process_batch` with --batch), then drives the Flask endpoints with
+the test client. Redis is replaced by an in-process fake. The results are
+written as JSON, and --compare prints the change against an earlier run. \n
+Usage: python benchmarks/pipeline_bench.py [--users N] [--locations M] [--reports R] [--out results.json] [--compare old.json]
+"""
+
+import os, sys
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import argparse
+import contextlib
+import datetime
+import fnmatch
+import io
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+
+def _encoded(value: Any) -> bytes:
+    """A value as Redis stores it."""
+    return value if isinstance(value, bytes) else str(value).encode()
+
+
+class InProcessRedis:
+
+    """
+    The subset of the redis-py client used by the worker and the API, kept
+    in process so the benchmark measures our code rather than the network.
+    The tests use it too. \n
+    Blocking commands never block, since nothing else could push meanwhile.
+    Scripts run on an embedded Lua interpreter (`lupa`), imported the first
+    time a script is called.
+    """
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = {}
+        self._lua: Any = None
+        self._lua_type: Callable[[Any], Optional[str]] = lambda v: None
+
+    def _prune(self, key: str) -> None:
+        """Redis drops a list or hash once it is empty."""
+        if key in self.data and not self.data[key]:
+            del self.data[key]
+
+    def get(self, key: str) -> Optional[bytes]:
+        value: Any = self.data.get(key)
+        return _encoded(value) if value is not None else None
+
+    def set(self, key: str, value: Any, ex: Optional[int] = None) -> bool:
+        self.data[key] = _encoded(value)
+        return True
+
+    def exists(self, *keys: str) -> int:
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key: str) -> int:
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def scan_iter(self, match: str = '*') -> Iterator[bytes]:
+        return iter([key.encode() for key in self.data if fnmatch.fnmatchcase(key, match)])
+
+    def rpush(self, key: str, *values: Any) -> int:
+        queue: List[bytes] = self.data.setdefault(key, [])
+        queue.extend(_encoded(v) for v in values)
+        return len(queue)
+
+    def lpush(self, key: str, *values: Any) -> int:
+        queue: List[bytes] = self.data.setdefault(key, [])
+        for v in values:
+            queue.insert(0, _encoded(v))
+        return len(queue)
+
+    def lpop(self, key: str) -> Optional[bytes]:
+        return self.lmove(key, None, 'LEFT')
+
+    def rpop(self, key: str) -> Optional[bytes]:
+        return self.lmove(key, None, 'RIGHT')
+
+    def llen(self, key: str) -> int:
+        return len(self.data.get(key, []))
+
+    def lindex(self, key: str, index: int) -> Optional[bytes]:
+        queue: List[bytes] = self.data.get(key, [])
+        return queue[index] if -len(queue) <= index < len(queue) else None
+
+    def lrange(self, key: str, start: int, stop: int) -> List[bytes]:
+        return self.data.get(key, [])[start:None if stop == -1 else stop + 1]
+
+    def lmove(self, src: str, dst: Optional[str], wherefrom: str = 'LEFT', whereto: str = 'RIGHT') -> Optional[bytes]:
+        queue: List[bytes] = self.data.get(src, [])
+        if not queue:
+            return None
+        value: bytes = queue.pop(0 if wherefrom == 'LEFT' else -1)
+        self._prune(src)
+        if dst is not None:
+            (self.lpush if whereto == 'LEFT' else self.rpush)(dst, value)
+        return value
+
+    def blmove(self, src: str, dst: str, timeout: float, wherefrom: str = 'LEFT', whereto: str = 'RIGHT') -> Optional[bytes]:
+        return self.lmove(src, dst, wherefrom, whereto)
+
+    def lrem(self, key: str, count: int, value: Any) -> int:
+        queue: List[bytes] = self.data.get(key, [])
+        hits: List[int] = [i for i, v in enumerate(queue) if v == _encoded(value)]
+        hits = (hits[::-1] if count < 0 else hits)[:abs(count) or None]
+        for i in sorted(hits, reverse=True):
+            del queue[i]
+        self._prune(key)
+        return len(hits)
+
+    def hgetall(self, key: str) -> Dict[bytes, bytes]:
+        return dict(self.data.get(key, {}))
+
+    def hset(self, key: str, mapping: Dict[str, Any]) -> int:
+        self.data.setdefault(key, {}).update({_encoded(k): _encoded(v) for k, v in mapping.items()})
+        return len(mapping)
+
+    def hincrby(self, key: str, field: Any, amount: int = 1) -> int:
+        fields: Dict[bytes, bytes] = self.data.setdefault(key, {})
+        fields[_encoded(field)] = _encoded(int(fields.get(_encoded(field), 0)) + int(amount))
+        return int(fields[_encoded(field)])
+
+    def hdel(self, key: str, *fields: Any) -> int:
+        removed: int = sum(self.data.get(key, {}).pop(_encoded(f), None) is not None for f in fields)
+        self._prune(key)
+        return removed
+
+    def hlen(self, key: str) -> int:
+        return len(self.data.get(key, {}))
+
+    def expire(self, key: str, seconds: int) -> bool:
+        return key in self.data
+
+    def pipeline(self, transaction: bool = True) -> 'InProcessPipeline':
+        return InProcessPipeline(self)
+
+    def register_script(self, script: str) -> Callable[..., Any]:
+
+        """A callable running `script` like `Redis.register_script` does, with `keys=` and `args=`."""
+
+        def run(keys: List[str] = [], args: List[Any] = []) -> Any:
+
+            if self._lua is None:
+                from lupa import LuaRuntime, lua_type  # only installed where the scripts are tested
+                self._lua = LuaRuntime(encoding=None)
+                self._lua_type = lua_type
+                self._lua.execute("unpack = unpack or table.unpack")
+
+            lua: Any = self._lua
+            to_lua: Callable[[Any], Any] = lambda v: False if v is None else lua.table_from(v) if isinstance(v, list) \
+                else int(v) if isinstance(v, bool) else v
+
+            def call(command: bytes, key: bytes, *rest: Any) -> Any:
+                return to_lua(getattr(self, command.decode().lower())(key.decode(), *rest))
+
+            def from_lua(v: Any) -> Any:
+                if self._lua_type(v) == 'table':
+                    return [from_lua(v[i]) for i in range(1, len(v) + 1)]
+                return None if v is False else int(v) if isinstance(v, float) else v
+
+            function: Any = lua.execute(f"return function(redis, KEYS, ARGV)\n{script}\nend")
+            return from_lua(function(
+                lua.table_from({b'call': call}),
+                lua.table_from([k.encode() for k in keys]),
+                lua.table_from([_encoded(a) for a in args])
+            ))
+
+        return run
+
+
+class InProcessPipeline:
+
+    """
+    Pipeline of `InProcessRedis`: records the commands and runs them on
+    `execute`, returning their results in order like redis-py does.
+    """
+
+    def __init__(self, client: InProcessRedis) -> None:
+        self.client: InProcessRedis = client
+        self.calls: List[Tuple[Callable[..., Any], Tuple[Any, ...], Dict[str, Any]]] = []
+
+    def __getattr__(self, name: str) -> Callable[..., 'InProcessPipeline']:
+
+        # a command the fake lacks fails when queued, like a typo would
+        command: Callable[..., Any] = getattr(self.client, name)
+
+        def queue(*args: Any, **kwargs: Any) -> 'InProcessPipeline':
+            self.calls.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self) -> List[Any]:
+        calls, self.calls = self.calls, []
+        return [command(*args, **kwargs) for command, args, kwargs in calls]
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+
+    """Mean, p50, p99 and max of latencies in seconds, reported in milliseconds."""
+
+    if not samples:
+        return {"count": 0}
+    ordered: List[float] = sorted(samples)
+    pick: Callable[[float], float] = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+def _seed(db: Any, users: int, locations: int, rng: random.Random) -> Tuple[List[str], List[Tuple[str, Tuple[float, float]]]]:
+
+    """Create the users and locations, returns their names (and positions)."""
+
+    from db import GeneralRepository
+
+    usernames: List[str] = [f"user{i}" for i in range(users)]
+    places: List[Tuple[str, Tuple[float, float]]] = [
+        (f"trip{i}@stop{i % 97}", (50.0 + rng.uniform(-0.2, 0.2), 19.9 + rng.uniform(-0.3, 0.3)))
+        for i in range(locations)
+    ]
+
+    general_repo: GeneralRepository = GeneralRepository(db)
+    with db.transaction():
+        db.conn.executemany(
+            "INSERT INTO users (username, email) VALUES (?, ?)",
+            [(name, f"{name}@bench.local") for name in usernames]
+        )
+        for name, pos in places:
+            general_repo.add_location(name, pos)
+
+    return usernames, places
+
+
+def _report_stream(
+    count: int,
+    usernames: List[str],
+    places: List[Tuple[str, Tuple[float, float]]],
+    rng: random.Random
+) -> List[str]:
+
+    """Raw JSON reports, skewed towards a few busy locations like real traffic."""
+
+    from db import ReportType
+
+    types: List[str] = ReportType.list()
+    weights: List[float] = [0.6, 0.1, 0.1, 0.1, 0.1]
+    hot: List[Tuple[str, Tuple[float, float]]] = places[:max(1, len(places) // 20)]
+
+    stream: List[str] = []
+    for _ in range(count):
+        name, pos = rng.choice(hot) if rng.random() < 0.5 else rng.choice(places)
+        far: bool = rng.random() < 0.1  # a few reporters are nowhere near
+        user_pos: Tuple[float, float] = (pos[0] + rng.uniform(-0.5, 0.5), pos[1] + rng.uniform(-0.5, 0.5)) if far \
+            else (pos[0] + rng.uniform(-0.002, 0.002), pos[1] + rng.uniform(-0.002, 0.002))
+        report_type: str = rng.choices(types, weights)[0]
+        stream.append(json.dumps({
+            "user_name": rng.choice(usernames),
+            "user_location": list(user_pos),
+            "location_name": name,
+            "location_pos": list(pos),
+            "report_type": report_type,
+            "delay_minutes": rng.randint(1, 45) if report_type == "DELAY" else None,
+        }))
+    return stream
+
+
+def bench_pipeline(db: Any, redis_conn: InProcessRedis, stream: List[str], batch_size: int) -> Dict[str, Any]:
+
+    """
+    Replay the stream through the routine worker. Latency is measured per
+    report (`_process_report`, its own transaction) or per batch (`_process_batch`).
+    """
+
+    from core import ReportMessage, Routine
+
+    routine: Routine = Routine(db, batch_size=batch_size)
+    db.add_commit_hook(lambda tables: Routine._publish_changes(redis_conn, tables))
+
+    statements: List[str] = []
+    db.conn.set_trace_callback(statements.append)
+
+    latencies: List[float] = []
+    dead: int = 0
+    started_at: float = time.perf_counter()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        if batch_size > 1:
+            for i in range(0, len(stream), batch_size):
+                t: float = time.perf_counter()
+                dead += len(routine._process_batch(stream[i:i + batch_size]))
+                latencies.append(time.perf_counter() - t)
+        else:
+            for raw in stream:
+                t: float = time.perf_counter()
+                try:
+                    routine._process_report(ReportMessage.from_json(raw))
+                except Routine.TRANSIENT_ERRORS:
+                    raise
+                except Exception:
+                    dead += 1
+                latencies.append(time.perf_counter() - t)
+
+    elapsed: float = time.perf_counter() - started_at
+    db.conn.set_trace_callback(None)
+
+    kinds: Dict[str, int] = defaultdict(int)
+    for statement in statements:
+        kinds[statement.split(None, 1)[0].upper() if statement.strip() else "?"] += 1
+
+    return {
+        "reports": len(stream),
+        "dead": dead,
+        "batch_size": batch_size,
+        "seconds": round(elapsed, 3),
+        "reports_per_sec": round(len(stream) / elapsed, 1),
+        ("batch_latency" if batch_size > 1 else "report_latency"): _percentiles(latencies),
+        "queries_per_report": round(len(statements) / len(stream), 2),
+        "queries_by_kind": dict(sorted(kinds.items())),
+        "incidents_version": int(redis_conn.get("incidents_version") or 0),
+        "cache": db.cache_stats(),
+    }
+
+
+def bench_api(redis_conn: InProcessRedis, stream: List[str], requests: int, rng: random.Random) -> Dict[str, Any]:
+
+    """Time every endpoint through the Flask test client."""
+
+    import web.app as web_app
+
+    web_app.redis_conn = redis_conn
+    web_app.producer = web_app.ReportProducer(redis_conn, max_depth=0)
+    client: Any = web_app.app.test_client()
+
+    lat, lon = json.loads(stream[0])["location_pos"]
+    endpoints: List[Tuple[str, str, Callable[[], Any]]] = [
+        ("GET", "/api/incidents", lambda: client.get("/api/incidents")),
+        ("GET", "/api/incidents?lat&lon&radius_km=2", lambda: client.get(f"/api/incidents?lat={lat}&lon={lon}&radius_km=2")),
+        ("GET", "/api/incidents?limit=100", lambda: client.get("/api/incidents?limit=100")),
+        ("GET", "/api/reports", lambda: client.get("/api/reports")),
+        ("GET", "/api/reports?limit=100", lambda: client.get("/api/reports?limit=100")),
+        ("GET", "/api/reports?stream=1", lambda: client.get("/api/reports?stream=1")),
+        ("GET", "/api/incidents/1/reports", lambda: client.get("/api/incidents/1/reports")),
+        ("GET", "/api/types", lambda: client.get("/api/types")),
+        ("GET", "/api/locations", lambda: client.get("/api/locations")),
+        ("GET", "/gtfs/trip-updates", lambda: client.get("/gtfs/trip-updates")),
+        ("POST", "/enqueue", lambda: client.post("/enqueue", data=rng.choice(stream), content_type="application/json")),
+        ("POST", "/enqueue/batch (50 reports)", lambda: client.post(
+            "/enqueue/batch", data=f"[{','.join(rng.sample(stream, 50))}]", content_type="application/json")),
+    ]
+
+    results: Dict[str, Any] = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for method, label, call in endpoints:
+            latencies: List[float] = []
+            statuses: Dict[int, int] = defaultdict(int)
+            size: int = 0
+            for _ in range(requests):
+                t: float = time.perf_counter()
+                response: Any = call()
+                body: bytes = response.get_data()
+                latencies.append(time.perf_counter() - t)
+                statuses[response.status_code] += 1
+                size = len(body)
+            results[f"{method} {label}"] = {**_percentiles(latencies), "status": dict(statuses), "bytes": size}
+
+    return results
+
+
+def compare(current: Dict[str, Any], previous: Dict[str, Any]) -> None:
+
+    """Print the relative change of every shared numeric metric (throughput up, latency down is better)."""
+
+    def flatten(d: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+        out: Dict[str, float] = {}
+        for k, v in d.items():
+            if isinstance(v, dict): out.update(flatten(v, f"{prefix}{k}."))
+            elif isinstance(v, (int, float)) and not isinstance(v, bool): out[f"{prefix}{k}"] = float(v)
+        return out
+
+    now: Dict[str, float] = flatten({"pipeline": current["pipeline"], "api": current["api"]})
+    before: Dict[str, float] = flatten({"pipeline": previous.get("pipeline", {}), "api": previous.get("api", {})})
+
+    for key in sorted(now.keys() & before.keys()):
+        if not key.endswith(("reports_per_sec", "_ms", "queries_per_report")) or before[key] == 0:
+            continue
+        change: float = (now[key] - before[key]) / before[key] * 100
+        print(f"{key:<70} {before[key]:>12.3f} -> {now[key]:>12.3f} ({change:+.1f}%)")
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--locations", type=int, default=2000)
+    parser.add_argument("--reports", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=1, help="reports per _process_batch call, 1 uses _process_report")
+    parser.add_argument("--requests", type=int, default=50, help="requests per API endpoint")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    rng: random.Random = random.Random(args.seed)
+    fp: str = os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db")
+    os.environ["DB_PATH"] = fp  # read by the API's connection pool on import
+
+    from db import Database, migrate
+
+    db: Database = Database(fp)
+    with contextlib.redirect_stdout(io.StringIO()):
+        migrate(db, background=False)
+    db.fill_types()
+
+    t: float = time.perf_counter()
+    usernames, places = _seed(db, args.users, args.locations, rng)
+    stream: List[str] = _report_stream(args.reports, usernames, places, rng)
+    print(f"[INFO] Seeded {args.users} users and {args.locations} locations in {time.perf_counter() - t:.2f} s.")
+
+    redis_conn: InProcessRedis = InProcessRedis()
+    pipeline: Dict[str, Any] = bench_pipeline(db, redis_conn, stream, args.batch)
+    print(f"[INFO] Pipeline: {pipeline['reports_per_sec']} reports/s, "
+          f"{pipeline['queries_per_report']} queries/report.")
+
+    api: Dict[str, Any] = bench_api(redis_conn, stream, args.requests, rng)
+    for label, r in api.items():
+        print(f"[INFO] {label:<45} p50 {r['p50_ms']:>9.3f} ms  p99 {r['p99_ms']:>9.3f} ms  {r['status']}")
+
+    try: commit: str = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=SCRIPT_DIR).stdout.strip()
+    except OSError: commit = ""
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "args": vars(args),
+        },
+        "pipeline": pipeline,
+        "api": api,
+    }
+
+    out: str = args.out or os.path.join(SCRIPT_DIR, "results", f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[INFO] Results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
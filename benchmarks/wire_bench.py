@@ -0,0 +1,114 @@
+
+"""
+Benchmark of the report queue wire formats. \n
+Encodes a synthetic report stream the way `/enqueue` queues it and decodes it
+the way the worker does, for the path before validation (json.loads then
+json.dumps on the API, `from_json` on the worker) and for every
+`QUEUE_WIRE_FORMAT`. It reports the bytes per message and the API and worker
+cost per message, one by one and in batches (`decode_many`). \n
+Usage: python benchmarks/wire_bench.py [--reports R] [--repeat K] [--batch N] [--out results.json]
+"""
+
+import os, sys
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from pipeline_bench import _report_stream
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import datetime
+import json
+import platform
+import random
+import time
+
+
+def _best(fn: Callable[[], Any], repeat: int) -> float:
+
+    """Best of `repeat` runs of `fn`, in seconds."""
+
+    timings: List[float] = []
+    for _ in range(repeat):
+        t: float = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - t)
+    return min(timings)
+
+
+def bench_format(label: str, bodies: List[bytes], encode: Callable[[bytes], bytes], batch: int, repeat: int) -> Dict[str, Any]:
+
+    """Measure one wire format: `encode` maps a request body to the queued payload."""
+
+    from core import ReportMessage
+
+    payloads: List[bytes] = [encode(b) for b in bodies]
+    n: int = len(bodies)
+
+    api_s: float = _best(lambda: [encode(b) for b in bodies], repeat)
+    worker_s: float = _best(lambda: [ReportMessage.from_wire(p) for p in payloads], repeat)
+    batched_s: float = _best(lambda: [ReportMessage.decode_many(payloads[i:i + batch]) for i in range(0, n, batch)], repeat)
+
+    decoded: List[Any] = ReportMessage.decode_many(payloads)
+    assert all(isinstance(m, ReportMessage) for m in decoded), f"{label}: payloads failed to decode"
+
+    return {
+        "bytes_per_msg": round(sum(map(len, payloads)) / n, 1),
+        "api_us_per_msg": round(api_s / n * 1e6, 3),
+        "worker_us_per_msg": round(worker_s / n * 1e6, 3),
+        "worker_batched_us_per_msg": round(batched_s / n * 1e6, 3),
+    }
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--reports", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the best one is kept")
+    parser.add_argument("--batch", type=int, default=64, help="reports per decode_many call")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default=None, help="JSON results file (default: benchmarks/results/wire-<timestamp>.json)")
+    args = parser.parse_args()
+
+    from core import ReportMessage
+    from core.report_message import orjson
+
+    rng: random.Random = random.Random(args.seed)
+    usernames: List[str] = [f"user{i}" for i in range(500)]
+    places: List[Tuple[str, Tuple[float, float]]] = [
+        (f"trip{i}@stop{i % 40}", (rng.uniform(49.9, 50.2), rng.uniform(19.7, 20.2))) for i in range(2000)
+    ]
+    bodies: List[bytes] = [s.encode() for s in _report_stream(args.reports, usernames, places, rng)]
+
+    formats: Dict[str, Callable[[bytes], bytes]] = {
+        # before: the API re-encoded the parsed body without validating it
+        "json (unvalidated, re-encoded)": lambda b: json.dumps(json.loads(b)).encode(),
+        # QUEUE_WIRE_FORMAT=json: validated, queued as received
+        "json": lambda b: (ReportMessage.from_json(b), b)[1],
+        # QUEUE_WIRE_FORMAT=msgpack: validated, then encoded
+        "msgpack": lambda b: ReportMessage.from_json(b).to_wire("msgpack"),
+    }
+
+    results: Dict[str, Any] = {}
+    for label, encode in formats.items():
+        r: Dict[str, Any] = bench_format(label, bodies, encode, args.batch, args.repeat)
+        results[label] = r
+        print(f"[INFO] {label:<32} {r['bytes_per_msg']:>7.1f} B/msg  API {r['api_us_per_msg']:>7.3f} us  "
+              f"worker {r['worker_us_per_msg']:>7.3f} us  batched {r['worker_batched_us_per_msg']:>7.3f} us")
+
+    out: str = args.out or os.path.join(SCRIPT_DIR, "results", f"wire-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump({
+            "meta": {
+                "at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "orjson": orjson is not None,
+                "args": vars(args),
+            },
+            "formats": results,
+        }, f, indent=2)
+    print(f"[INFO] Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
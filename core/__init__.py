@@ -3,15 +3,21 @@
 from typing import List
 from .aggregator import Aggregator, AggregatorHelper
 from .decider import Decider, Thresholds
-from .report_message import ReportMessage
+from .profiling import Profiler
+from .queue import QueueFull, ReportProducer, queue_name, shard_count, shard_for
+from .report_message import ReportMessage, WIRE_FORMATS
 from .routine import Routine
+from .sweeper import Sweeper
 from .user_elo import UserElo
 
 __all__: List[str] = [
     "Aggregator", "AggregatorHelper",
     "Decider", "Thresholds",
-    "ReportMessage",
+    "Profiler",
+    "QueueFull", "ReportProducer", "queue_name", "shard_count", "shard_for",
+    "ReportMessage", "WIRE_FORMATS",
     "Routine",
+    "Sweeper",
     "UserElo",
 ]
 
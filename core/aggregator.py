@@ -1,9 +1,12 @@
 
-from db import Database, ReportType, ReportRepository, GeneralRepository, UserRepository, IncidentRepository
+from db import Database, ReportType, ReportRepository, GeneralRepository, UserRepository, IncidentRepository, IncidentStatsRepository
 from typing import Any, Dict, List, Optional, Tuple
+from .queue import shard_for
 from .report_message import ReportMessage
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+import numpy as np
+import os
 
 
 # alias for reading
@@ -12,6 +15,9 @@ report_t = Dict[str, Any]
 incident_t = Dict[str, Any]
 user_t = Dict[str, Any]
 
+# LOG_LEVEL=DEBUG logs the rows written for every report, which costs extra reads
+DEBUG: bool = os.getenv("LOG_LEVEL", "INFO").upper() == "DEBUG"
+
 
 # ✅ - Grep the location ID or add it if it doesn't exist yet to the db (with loc)
 # ✅ - Grep the report type ID
@@ -38,20 +44,36 @@ class Aggregator:
     """
     Aggregates user reports into incidents and manages database interactions.
     """
+
+    # a new location name closer than this to a known location reuses it,
+    # 0 disables merging (names encode the GTFS trip, see readme)
+    MERGE_RADIUS_KM: float = float(os.getenv("LOCATION_MERGE_RADIUS_M", 0)) / 1000
     
-    def __init__(self, db: Database) -> None:
+    def __init__(self, db: Database, shard: Optional[int] = None) -> None:
 
-        """Initialize the Aggregator with a Database instance."""
+        """
+        Initialize the Aggregator with a Database instance. With a `shard`,
+        reports are only merged into locations owned by that shard.
+        """
 
         self.db: Database = db
+        self.shard: Optional[int] = shard
 
         # few repo to handle db queries easily
         self.report_repo: ReportRepository = ReportRepository(db)
         self.general_repo: GeneralRepository = GeneralRepository(db)
         self.user_repo: UserRepository = UserRepository(db)
         self.incident_repo: IncidentRepository = IncidentRepository(db)
+        self.stats_repo: IncidentStatsRepository = IncidentStatsRepository(db)
 
     def routine(self, report: ReportMessage) -> None:
+
+        """Aggregate a single report, committing all of its writes at once."""
+
+        with self.db.transaction():
+            self._routine(report)
+
+    def _routine(self, report: ReportMessage) -> None:
         
         # get the correct IDs or add them if they don't exist
         # and push the report to the database
@@ -63,7 +85,8 @@ class Aggregator:
             delay_minutes=report.delay_minutes)
         mids['rid'] = rid
 
-        print(f'[INFO] Added record: {self.report_repo.get_report(rid)}')
+        record: report_t = self.report_repo.get_report(rid)
+        if DEBUG: print(f'[DEBUG] Added record: {record}')
 
         # update the user's report count and trust score
         user: user_t = self.user_repo.get_user(mids["uid"])
@@ -74,8 +97,8 @@ class Aggregator:
         # and run correct subroutine
         incident: Optional[incident_t] = self.incident_repo.get_incident_by_location(mids["lid"])
 
-        if incident: self._incident_subroutine(mids, report, incident)
-        else: self._no_incident_subroutine(mids, report)
+        if incident: self._incident_subroutine(mids, report, incident, record, user)
+        else: self._no_incident_subroutine(mids, report, record, user)
 
     def _handle_ids(self, r: ReportMessage) -> report_t:
 
@@ -88,6 +111,8 @@ class Aggregator:
         # No lid is okay, we add it to the DB.
         # No uid or tid is NOT okay, those MUST exist (no custom report types or
         # users that don't exist).
+        if lid is None and self.MERGE_RADIUS_KM > 0:
+            lid = self._merge_location(r)
         if lid is None:
             lid = self.general_repo.add_location(r.location_name, r.location_pos)
             print(f'[INFO] New location discovered, adding {lid}.')
@@ -100,12 +125,33 @@ class Aggregator:
             "lid": lid
         }
 
+    def _merge_location(self, r: ReportMessage) -> Optional[int]:
+
+        """
+        Reuse the nearest known location within the merge radius. Only the
+        locations of this worker's shard qualify: another worker owns the
+        incidents of the others, and both would write them.
+        """
+
+        nearest: Optional[Tuple[int, float]] = None
+        for candidate in self.general_repo.get_locations_within(r.location_pos, self.MERGE_RADIUS_KM):
+            if self.shard is None or shard_for(self.general_repo.get_location_by_id(candidate[0])["name"]) == self.shard:
+                nearest = candidate
+                break
+        if nearest is None:
+            return None
+
+        print(f'[INFO] Location "{r.location_name}" merged into {nearest[0]} ({nearest[1] * 1000:.1f} m away).')
+        self.general_repo.location_ids.put(r.location_name, nearest[0])
+        return nearest[0]
+
     def _update_report_history(self, user: user_t) -> None:
         """Increment the report count for a user by 1."""
         self.user_repo.update_reports_made(user["id"], (user["reports_made"] + 1))
-        print(f'[INFO] Updated user report count: {self.user_repo.get_user(user["id"])}')
+        user["reports_made"] += 1  # the row now matches the table, for the incident weights
+        if DEBUG: print(f'[DEBUG] Updated user report count: {self.user_repo.get_user(user["id"])}')
 
-    def _no_incident_subroutine(self, mids: Dict[str, int], r: ReportMessage) -> None:
+    def _no_incident_subroutine(self, mids: Dict[str, int], r: ReportMessage, record: report_t, user: user_t) -> None:
 
         """Push the incident in the DB."""
 
@@ -116,7 +162,7 @@ class Aggregator:
             trust_score=0.0,  # will be updated right after
             status='active'
         )
-        print(f'[INFO] Added incident since report is new info ({self.incident_repo.get_incident(iid)})')
+        if DEBUG: print(f'[DEBUG] Added incident since report is new info ({self.incident_repo.get_incident(iid)})')
 
         # add the report to the incident's report list
         self.report_repo.assign_to_incident(mids["rid"], iid)
@@ -124,9 +170,9 @@ class Aggregator:
 
         # update the incident
         incident: Optional[incident_t] = self.incident_repo.get_incident(iid)
-        AggregatorHelper._update_incident(self, incident)
+        AggregatorHelper._update_incident(self, incident, record, user)
 
-    def _incident_subroutine(self, mids: Dict[str, int], r: ReportMessage, incident: incident_t) -> None:
+    def _incident_subroutine(self, mids: Dict[str, int], r: ReportMessage, incident: incident_t, record: report_t, user: user_t) -> None:
         
         """Aggregate the report in the existing incident."""
 
@@ -135,7 +181,7 @@ class Aggregator:
         self._update_user_trust_score(incident)
 
         # update the incident's data
-        AggregatorHelper._update_incident(self, incident)
+        AggregatorHelper._update_incident(self, incident, record, user)
 
     def _update_user_trust_score(self, user: user_t) -> None:
 
@@ -147,11 +193,24 @@ class Aggregator:
 
 
 class AggregatorHelper:
+
+    # full recompute from every report of an incident once every N reports,
+    # as a consistency check of the running aggregates, 0 never recomputes
+    RECOMPUTE_EVERY: int = max(0, int(os.getenv("INCIDENT_RECOMPUTE_EVERY", 50)))
+
+    # A report's trust weight is set when it arrives: its reporter's trust and
+    # experience, and how far its delay is from the incident's average delay at
+    # that moment (both measured at its created_at). The running aggregates
+    # fold it in once, and the recompute replays the reports in arrival order
+    # with the same rules, so for an unchanged user table both give the same
+    # trust. The recompute only moves the score by the reporters' trust and
+    # report counts that changed since their reports arrived.
     
     @staticmethod
-    def _calculate_normalized_delays(reports: List[dict]) -> Dict[int, Optional[float]]:
+    def _calculate_normalized_delays(reports: List[dict], at_receipt: bool = False) -> Dict[int, Optional[float]]:
         """
-        Calculate normalized delays for each report relative to the current time.
+        Calculate normalized delays for each report relative to the current time,
+        or to the time each report arrived with `at_receipt`.
         
         Returns a dict mapping report_id -> remaining delay (in minutes)
         or None if delay is not provided.
@@ -164,21 +223,27 @@ class AggregatorHelper:
         for r in reports:
             if r["delay_minutes"] is not None:
                 
-                created_at: datetime = datetime.fromisoformat(r["created_at"])
-                planned: datetime = created_at + timedelta(minutes=r["delay_minutes"])
-                planned = planned.replace(tzinfo=timezone.utc)
-
                 # difference between planned end and now
-                diff = planned - now
+                diff = AggregatorHelper._planned_end(r) - (AggregatorHelper._created_at(r) if at_receipt else now)
                 remaining_minutes = diff.total_seconds() / 60
 
                 d[r["id"]] = round(remaining_minutes, 2)  # keep 2 decimals
             else:
                 d[r["id"]] = None
 
-        print(f"[INFO] Normalized time table: {d}")
+        if DEBUG: print(f"[DEBUG] Normalized time table: {d}")
         return d
 
+    @staticmethod
+    def _created_at(r: report_t) -> datetime:
+        """When a report arrived (UTC)."""
+        return datetime.fromisoformat(r["created_at"]).replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def _planned_end(r: report_t) -> datetime:
+        """When the delay announced by a report is expected to be over (UTC)."""
+        return AggregatorHelper._created_at(r) + timedelta(minutes=r["delay_minutes"])
+
     @staticmethod
     def _calculate_average_time(reports: List[report_t]) -> Optional[float]:
 
@@ -197,53 +262,77 @@ class AggregatorHelper:
         return delay
 
     @staticmethod
-    def _calculate_trust_score(ag: Aggregator, reports: List[report_t], avg: Optional[float] = None) -> float:
-        
-        # Calculate a score of trust 
+    def _delay_weight(normalized_delay: Optional[float], avg: Optional[float]) -> float:
 
-        score: float = 0.0
-        weights: List[float] = list()
-        normalized_delays: Dict[int, Optional[float]] = AggregatorHelper._calculate_normalized_delays(reports)
+        """Delay time weight (reports close to avg_delay are more trustworthy)."""
 
-        for r in reports:
+        if normalized_delay is None or avg is None or avg <= 0:
+            return 1.0
+
+        delay_diff: float = abs(int(normalized_delay) - avg)
+        return max(0.5, 1.0 - (delay_diff / avg))  # reduce weight for outliers
+
+    @staticmethod
+    def _calculate_weights(ag: Aggregator, reports: List[report_t]) -> np.ndarray:
+
+        """
+        Trust weight of each report, from its reporter and how close it was to
+        the average when it arrived. `reports` are in arrival order. Reporters
+        are fetched in bulk and the weights computed as array operations.
+        """
+
+        users: Dict[int, user_t] = ag.user_repo.get_users(r["user_id"] for r in reports)
+        normalized_delays: Dict[int, Optional[float]] = AggregatorHelper._calculate_normalized_delays(reports, at_receipt=True)
+
+        trust: np.ndarray = np.fromiter((users[r["user_id"]]["trust_score"] for r in reports), dtype=float, count=len(reports))
+        made: np.ndarray = np.fromiter((users[r["user_id"]]["reports_made"] for r in reports), dtype=float, count=len(reports))
+
+        # base weight is 1.0, scaled by the reporter's trust and experience
+        weights: np.ndarray = trust * (1.0 + (made / 100.0))
 
-            weight: float = 1.0  # base weight is 1.0
-            user: user_t = ag.user_repo.get_user(r["user_id"])
+        # Delay time weight (reports close to avg_delay are more trustworthy),
+        # against the average of the delays known when each report arrived
+        delayed: List[int] = [i for i, r in enumerate(reports) if r["delay_minutes"] is not None]
+        if delayed:
+            delays: np.ndarray = np.array([normalized_delays[reports[i]["id"]] for i in delayed], dtype=float)
+            planned: np.ndarray = np.array([AggregatorHelper._planned_end(reports[i]).timestamp() / 60 for i in delayed])
+            created: np.ndarray = np.array([AggregatorHelper._created_at(reports[i]).timestamp() / 60 for i in delayed])
+            avgs: np.ndarray = np.cumsum(planned) / np.arange(1, len(delayed) + 1) - created
+            with np.errstate(divide="ignore", invalid="ignore"):
+                factor: np.ndarray = np.maximum(0.5, 1.0 - (np.abs(np.trunc(delays) - avgs) / avgs))
+            weights[delayed] *= np.where(avgs > 0, factor, 1.0)
 
-            weight *= user["trust_score"]
-            weight *= (1.0 + (user["reports_made"] / 100.0))
+        return weights
 
-            if normalized_delays[r["id"]] is not None and avg is not None:
-                # Delay time weight (reports close to avg_delay are more trustworthy)
-                delay_diff: int = abs(int(normalized_delays[r["id"]]) - avg)
-                if avg > 0:
-                    weight *= max(0.5, 1.0 - (delay_diff / avg))  # reduce weight for outliers
+    @staticmethod
+    def _trust_from_weights(weight_sum: float, weight_max: float, count: int) -> float:
 
-            weights.append(weight)
+        """Normalize the summed weights to a score between 0.0 and 1.0."""
 
-        # Normalize score to be between 0.0 and 1.0
-        max_weight = max(weights) if weights else 1.0
-        for w in weights:
-            score += w / max_weight
-        if len(reports) > 0:
-            score /= len(reports)
+        if count <= 0 or weight_max <= 0:
+            return 0.0
 
+        score: float = (weight_sum / weight_max) / count
         return min(max(score, 0.0), 1.0)
 
     @staticmethod
-    def _calculate_type(ag: Aggregator, reports: List[report_t]) -> int:
+    def _calculate_trust_score(ag: Aggregator, reports: List[report_t]) -> float:
+        
+        # Calculate a score of trust 
 
-        """Determine the most common report type among the reports."""
+        if not reports:
+            return 0.0
 
-        type_count: Dict[int, int] = dict()
+        weights: np.ndarray = AggregatorHelper._calculate_weights(ag, sorted(reports, key=lambda r: r["id"]))
+        return AggregatorHelper._trust_from_weights(float(weights.sum()), float(weights.max()), len(reports))
 
-        # sort reports by created_at (datetime) descending
-        reports.sort(key=lambda x: x["created_at"], reverse=True)
-        for r in reports:
-            if r["type_id"] in type_count:
-                type_count[r["type_id"]] += 1
-            else:
-                type_count[r["type_id"]] = 1
+    @staticmethod
+    def _pick_type(ag: Aggregator, type_count: Dict[int, List[int]]) -> int:
+
+        """
+        Pick the incident type from a type_id -> [count, last_report_id] histogram:
+        resolved wins, otherwise the most common type, ties going to the latest report.
+        """
 
         s: int = ag.general_repo.get_type_id(ReportType.SOLVED)
         
@@ -251,24 +340,117 @@ class AggregatorHelper:
         if s in type_count: return s
 
         # if no resolved, then the most common type is the incident type
-        # last update is given in case of tie (by sorting)
-        m: int = max(type_count, key=type_count.get)
+        # last update is given in case of tie
+        m: int = max(type_count, key=lambda t: (type_count[t][0], type_count[t][1]))
         return m
 
     @staticmethod
-    def _update_incident(ag: Aggregator, incident: incident_t) -> None:
-        
-        # get all reports for this incident
-        reports: List[Dict[str, Any]] = ag.report_repo.get_reports_by_incident(incident["id"])
+    def _calculate_type(ag: Aggregator, reports: List[report_t]) -> int:
+
+        """Determine the most common report type among the reports."""
+
+        return AggregatorHelper._pick_type(ag, AggregatorHelper._type_histogram(reports))
+
+    @staticmethod
+    def _type_histogram(reports: List[report_t]) -> Dict[int, List[int]]:
+
+        """Count reports per type, remembering the latest report of each type."""
+
+        type_count: Dict[int, List[int]] = dict()
+
+        for r in reports:
+            if r["type_id"] in type_count:
+                type_count[r["type_id"]][0] += 1
+                type_count[r["type_id"]][1] = max(type_count[r["type_id"]][1], r["id"])
+            else:
+                type_count[r["type_id"]] = [1, r["id"]]
+
+        return type_count
+
+    @staticmethod
+    def _average_from_stats(stats: Dict[str, Any]) -> Optional[float]:
+
+        """Average remaining delay (in minutes) from the running aggregates, 0 once it is over."""
+
+        if stats["delay_count"] == 0:
+            return None
+
+        now: float = datetime.now(timezone.utc).timestamp() / 60
+        return max(round(stats["delay_sum"] / stats["delay_count"] - now, 2), 0.0)
+
+    @staticmethod
+    def _update_incident(ag: Aggregator, incident: incident_t, report: report_t, user: user_t) -> None:
+
+        """
+        Fold a new report into the incident's running aggregates, in O(1).
+        Falls back to a full recompute when the incident has no aggregates yet
+        and every `RECOMPUTE_EVERY` reports (never if it is 0).
+        """
+
+        every: int = AggregatorHelper.RECOMPUTE_EVERY
+        stats: Optional[Dict[str, Any]] = ag.stats_repo.get_stats(incident["id"])
+        if stats is None or (every > 0 and (stats["report_count"] + 1) % every == 0):
+            AggregatorHelper._recompute_incident(ag, incident)
+            return
+
+        # weight of the new report, set as it arrives (see the note above)
+        weight: float = user["trust_score"] * (1.0 + (user["reports_made"] / 100.0))
+
+        stats["report_count"] += 1
+        if report["delay_minutes"] is not None:
+            stats["delay_sum"] += AggregatorHelper._planned_end(report).timestamp() / 60
+            stats["delay_count"] += 1
+            normalized: Optional[float] = AggregatorHelper._calculate_normalized_delays([report], at_receipt=True)[report["id"]]
+            receipt_avg: float = stats["delay_sum"] / stats["delay_count"] - AggregatorHelper._created_at(report).timestamp() / 60
+            weight *= AggregatorHelper._delay_weight(normalized, receipt_avg)
+
+        avg: Optional[float] = AggregatorHelper._average_from_stats(stats)
+        stats["weight_sum"] += weight
+        stats["weight_max"] = max(stats["weight_max"], weight)
+
+        count: List[int] = stats["type_counts"].setdefault(report["type_id"], [0, report["id"]])
+        count[0] += 1
+        count[1] = max(count[1], report["id"])
+
+        trust: float = AggregatorHelper._trust_from_weights(stats["weight_sum"], stats["weight_max"], stats["report_count"])
+        type_id: int = AggregatorHelper._pick_type(ag, stats["type_counts"])
+
+        if DEBUG: print(f'[DEBUG] Average: {avg}, trust: {trust}, type id: {type_id}')
+
+        ag.stats_repo.save_stats(stats)
+        ag.incident_repo.update_aggregates(incident['id'], type_id, avg, trust)
+
+    @staticmethod
+    def _recompute_incident(ag: Aggregator, incident: incident_t) -> None:
+
+        """Recompute an incident and rebuild its running aggregates from all of its reports."""
+
+        # get all reports for this incident, replayed in arrival order
+        reports: List[Dict[str, Any]] = sorted(ag.report_repo.get_reports_by_incident(incident["id"]), key=lambda r: r["id"])
         assert len(reports) > 0, "[CRITICAL] No reports found for incident"
-        avg: Optional[float] = AggregatorHelper._calculate_average_time(reports)
-        trust: float = AggregatorHelper._calculate_trust_score(ag, reports, avg)
-        type_id: int = AggregatorHelper._calculate_type(ag, reports)
+        weights: np.ndarray = AggregatorHelper._calculate_weights(ag, reports)
+        delays: np.ndarray = np.array([
+            AggregatorHelper._planned_end(r).timestamp() / 60
+            for r in reports if r["delay_minutes"] is not None
+        ])
+
+        # sums accumulated in arrival order, like the running aggregates
+        stats: Dict[str, Any] = {
+            "incident_id": incident["id"],
+            "report_count": len(reports),
+            "delay_sum": float(np.cumsum(delays)[-1]) if len(delays) else 0.0,
+            "delay_count": len(delays),
+            "weight_sum": float(np.cumsum(weights)[-1]),
+            "weight_max": float(weights.max()),
+            "type_counts": AggregatorHelper._type_histogram(reports)
+        }
+
+        avg: Optional[float] = AggregatorHelper._average_from_stats(stats)
+        trust: float = AggregatorHelper._trust_from_weights(stats["weight_sum"], stats["weight_max"], stats["report_count"])
+        type_id: int = AggregatorHelper._pick_type(ag, stats["type_counts"])
 
-        print(f'[INFO] Average: {avg}\n[INFO] Trust: {trust}\n[INFO] Type id: {type_id}')
+        if DEBUG: print(f'[DEBUG] Average: {avg}, trust: {trust}, type id: {type_id}')
 
-        ag.incident_repo.update_incident_type(incident['id'], type_id)
-        ag.incident_repo.update_avg_delay(incident['id'], avg)
-        ag.incident_repo.update_trust_score(incident['id'], trust)
-        ag.incident_repo.update_last_updated(incident['id'])
+        ag.stats_repo.save_stats(stats)
+        ag.incident_repo.update_aggregates(incident['id'], type_id, avg, trust)
 
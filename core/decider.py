@@ -1,8 +1,9 @@
 
 from db import Database, UserRepository
 from .report_message import ReportMessage
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 from dataclasses import dataclass
+import numpy as np
 import math
 
 
@@ -20,6 +21,9 @@ class Decider:
     PRIOR: float = 0.9
     PRIOR_WEIGHT: float = 1.0
     LOW_THRESHOLD: float = 0.5   
+    # relative distance to a threshold under which `decide_many` falls back to
+    # the scalar formula, far above the few ulps numpy and math can differ by
+    BOUNDARY_TOLERANCE: float = 1e-9
 
     def __init__(self, db: Database) -> None:
 
@@ -39,16 +43,71 @@ class Decider:
         time_diff: Optional[float] = message.delay_minutes or 0.0
         trust_score: float = self._trust(self.user_repo.get_user_id(message.user_name))
 
-        if self._instant_reject(distance, time_diff, trust_score):
+        return self._decision(distance, time_diff, trust_score)
+
+    @staticmethod
+    def _decision(distance: float, time_diff: float, trust_score: float) -> Tuple[bool, float]:
+
+        """Decision and probability from a report's distance, delay and user trust."""
+
+        if Decider._instant_reject(distance, time_diff, trust_score):
             return False, 0.0
 
         score: float = (
             (trust_score * 2.0) - (distance / Thresholds.DISTANCE) - (time_diff / Thresholds.TIME)
         )
-        prob: float = self._sigmoid(score)
+        prob: float = Decider._sigmoid(score)
 
         return (prob >= Thresholds.DECIDE, prob)
 
+    def decide_many(self, messages: Sequence[ReportMessage]) -> Tuple[np.ndarray, np.ndarray]:
+
+        """
+        Vectorized `decide` over a batch of messages. Users are resolved in a
+        single query, distances, thresholds and probabilities are computed as
+        array operations, in the same order as `decide`. Returns a boolean mask
+        of trusted messages and their probabilities. \n
+        The mask is exactly what `decide` returns for each message. numpy's
+        trigonometric and exponential functions may round differently from
+        `math` in the last bit, so the probabilities can differ by an ulp, and
+        messages within `BOUNDARY_TOLERANCE` of the distance or decision
+        threshold are decided again with the scalar formula. \n
+        Raises `ValueError` if a message comes from an unknown user.
+        """
+
+        users: Dict[str, Dict[str, Any]] = self.user_repo.get_users_by_name(m.user_name for m in messages)
+        unknown: List[str] = [m.user_name for m in messages if m.user_name not in users]
+        if unknown:
+            raise ValueError(f"[CRITICAL] Unknown user(s): {', '.join(sorted(set(unknown)))}")
+
+        positions: np.ndarray = np.array(
+            [(*m.user_location, *m.location_pos) for m in messages], dtype=float
+        ).reshape(-1, 4)
+        distance: np.ndarray = self._distance_many(positions)
+        time_diff: np.ndarray = np.array([m.delay_minutes or 0.0 for m in messages], dtype=float)
+        trust_score: np.ndarray = self._trust_many(
+            np.array([users[m.user_name]['trust_score'] for m in messages], dtype=float),
+            np.array([users[m.user_name]['reports_made'] for m in messages], dtype=float)
+        )
+
+        rejected: np.ndarray = (distance > Thresholds.DISTANCE) | (time_diff > Thresholds.TIME) \
+            | (trust_score < Thresholds.TRUST)
+
+        score: np.ndarray = (
+            (trust_score * 2.0) - (distance / Thresholds.DISTANCE) - (time_diff / Thresholds.TIME)
+        )
+        with np.errstate(over='ignore'):  # only rejected messages can overflow
+            prob: np.ndarray = np.where(rejected, 0.0, 1 / (1 + np.exp(-score)))
+        accepted: np.ndarray = ~rejected & (prob >= Thresholds.DECIDE)
+
+        # a last-bit difference could flip these, decide them like `decide` does
+        close: np.ndarray = (np.abs(distance - Thresholds.DISTANCE) <= self.BOUNDARY_TOLERANCE * Thresholds.DISTANCE) \
+            | (np.abs(prob - Thresholds.DECIDE) <= self.BOUNDARY_TOLERANCE * Thresholds.DECIDE)
+        for i in np.flatnonzero(close):
+            accepted[i], prob[i] = self._decision(self._distance(messages[i]), float(time_diff[i]), float(trust_score[i]))
+
+        return (accepted, prob)
+
     def _distance(self, message: ReportMessage) -> float:
 
         """
@@ -56,10 +115,12 @@ class Decider:
         location and the reported location.
         """
 
-        lat1: float = message.user_location[0]
-        lon1: float = message.user_location[1]
-        lat2: float = message.location_pos[0]
-        lon2: float = message.location_pos[1]
+        return Decider.haversine(*message.user_location, *message.location_pos)
+
+    @staticmethod
+    def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+
+        """Haversine distance in km between two (lat, lon) points in degrees."""
 
         # map to radians yuh
         lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
@@ -93,6 +154,35 @@ class Decider:
 
         return trust_score if trust_score <= low_threshold else raw
 
+    @staticmethod
+    def _distance_many(positions: np.ndarray) -> np.ndarray:
+
+        """
+        Vectorized `_distance`, over an (n, 4) array of
+        (user lat, user lon, location lat, location lon) rows.
+        """
+
+        lat1, lon1, lat2, lon2 = np.radians(positions).T
+
+        dlat: np.ndarray = lat2 - lat1
+        dlon: np.ndarray = lon2 - lon1
+        R: float = 6371  # radius of earth in km
+
+        a: np.ndarray = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) \
+            * np.sin(dlon/2)**2
+        c: np.ndarray = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+        return R * c  # km distances
+
+    def _trust_many(self, trust_score: np.ndarray, reports_count: np.ndarray) -> np.ndarray:
+
+        """Vectorized `_trust`, from the users' trust scores and report counts."""
+
+        raw: np.ndarray = (self.PRIOR_WEIGHT * self.PRIOR + reports_count * trust_score) / \
+            (self.PRIOR_WEIGHT + reports_count)
+
+        return np.where(trust_score <= self.LOW_THRESHOLD, trust_score, raw)
+
     @staticmethod
     def _instant_reject(distance: float, time_diff: float, trust_score: float) -> bool:
 
@@ -0,0 +1,268 @@
+
+from .aggregator import AggregatorHelper
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Set, TYPE_CHECKING
+import cProfile
+import threading
+import random
+import time
+import sys
+import os
+
+if TYPE_CHECKING:
+    from .queue import ReportQueue
+    from .routine import Routine
+
+
+PROFILE_MODES: Set[str] = {"spans", "cprofile", "stacks"}
+
+
+class StackSampler:
+
+    """
+    Samples the stack of one thread every `interval` seconds from a daemon
+    thread, and counts each stack in the collapsed format of flame graph tools
+    (`outer;inner;leaf count`). \n
+    Unlike a CPU profiler it also sees the thread while it waits, so time spent
+    in SQLite (fsync included) or on a Redis round trip shows up, under the
+    Python frame that made the call.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005) -> None:
+
+        """Initialize the sampler of the thread `thread_id`, sampling is off until `start()`."""
+
+        self.thread_id: int = thread_id
+        self.interval: float = interval
+        self._stacks: Counter = Counter()
+        self._lock: threading.Lock = threading.Lock()
+        self._stop: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.skip: Set[Any] = set()  # code objects left out of the stacks (profiling wrappers)
+
+    def start(self) -> None:
+        """Start sampling in the background."""
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop sampling."""
+        self._stop.set()
+
+    def _run(self) -> None:
+
+        """Sampling loop, one stack per tick."""
+
+        while not self._stop.wait(self.interval):
+            frame: Any = sys._current_frames().get(self.thread_id)
+            stack: List[str] = []
+            while frame is not None:
+                code: Any = frame.f_code
+                if code not in self.skip:
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                with self._lock:
+                    self._stacks[";".join(reversed(stack))] += 1
+
+    def drain(self) -> Dict[str, int]:
+
+        """Return the stacks counted since the last call, and start over."""
+
+        with self._lock:
+            stacks: Dict[str, int] = dict(self._stacks)
+            self._stacks.clear()
+        return stacks
+
+
+class Profiler:
+
+    """
+    Profiling mode of the routine worker, enabled with `WORKER_PROFILE`. \n
+    Timing spans wrap the processing of a report and each of its stages
+    (decide, elo, id lookups, incident update), plus every SQLite statement
+    and commit and every Redis round trip of the queue. Every `every` reports
+    the spans are logged, and depending on the modes a cProfile of a sample of
+    the batches (`.prof`, for pstats or snakeviz) and a collapsed-stack file
+    (`.collapsed`, for flamegraph.pl or speedscope) are written to `out_dir`.
+    """
+
+    def __init__(
+        self,
+        modes: Set[str],
+        every: Optional[int] = None,
+        sample: Optional[float] = None,
+        out_dir: Optional[str] = None,
+        label: str = "worker"
+    ) -> None:
+
+        """
+        Initialize the Profiler with the `modes` to run, among `PROFILE_MODES`
+        (spans are always timed). \n
+        The settings default to the `PROFILE_EVERY`, `PROFILE_SAMPLE` (fraction
+        of the batches run under cProfile) and `PROFILE_DIR` environment variables.
+        """
+
+        unknown: Set[str] = modes - PROFILE_MODES
+        if unknown:
+            raise ValueError(f"Unknown profile mode(s): {', '.join(sorted(unknown))}")
+
+        self.modes: Set[str] = modes
+        self.every: int = max(1, every or int(os.getenv("PROFILE_EVERY", 1000)))
+        self.sample: float = sample if sample is not None else float(os.getenv("PROFILE_SAMPLE", 0.1))
+        self.out_dir: str = out_dir or os.getenv("PROFILE_DIR", "profiles")
+        self.label: str = label
+
+        # span name -> [calls, total seconds, max seconds]
+        self.spans: Dict[str, List[float]] = {}
+        self.reports: int = 0
+        self.dumps: int = 0
+        self.window_started_at: float = time.monotonic()
+
+        self._depth: int = 0
+        self._profile: Optional[cProfile.Profile] = cProfile.Profile() if "cprofile" in modes else None
+        self._profiling: bool = False
+        self._sampler: Optional[StackSampler] = None
+        if "stacks" in modes:
+            self._sampler = StackSampler(threading.get_ident(), float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000)
+
+    @classmethod
+    def from_env(cls, label: str = "worker") -> Optional['Profiler']:
+
+        """
+        The Profiler configured by `WORKER_PROFILE`, a comma separated list of
+        modes (`1` is `spans`), or None when it is unset or `0`.
+        """
+
+        value: str = os.getenv("WORKER_PROFILE", "0").strip().lower()
+        if value in ("", "0", "false", "no"):
+            return None
+        modes: Set[str] = {"spans"} if value in ("1", "true", "yes") else {m.strip() for m in value.split(",") if m.strip()}
+        return cls(modes, label=label)
+
+    def _record(self, name: str, seconds: float) -> None:
+
+        """Add one call of `seconds` to the span `name`."""
+
+        entry: Optional[List[float]] = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]: entry[2] = seconds
+
+    def wrap(self, fn: Callable[..., Any], name: str, top: bool = False, reports: bool = False) -> Callable[..., Any]:
+
+        """
+        Return `fn` timed under the span `name`. A `top` level call (batch or
+        lone report) may be run under cProfile and checks whether a dump is
+        due once it returns. With `reports`, each call counts as a report.
+        """
+
+        perf_counter: Callable[[], float] = time.perf_counter
+
+        def spanned(*args: Any, **kwargs: Any) -> Any:
+
+            outer: bool = top and self._depth == 0
+            if outer:
+                self._start_sample()
+            self._depth += 1
+            started_at: float = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._record(name, perf_counter() - started_at)
+                self._depth -= 1
+                if reports:
+                    self.reports += 1
+                if outer:
+                    self._stop_sample()
+                    if self.reports >= self.every:
+                        self.dump()
+
+        spanned.__wrapped__ = fn  # type: ignore[attr-defined]
+        if self._sampler is not None:
+            self._sampler.skip.add(spanned.__code__)
+        return spanned
+
+    def instrument(self, routine: 'Routine', queue: Optional['ReportQueue'] = None) -> None:
+
+        """
+        Wrap the hot path of `routine` (and the Redis calls of its `queue`) in
+        spans. Only meant for a worker process: `AggregatorHelper._update_incident`
+        is wrapped for the whole process.
+        """
+
+        routine._process_batch = self.wrap(routine._process_batch, "process_batch", top=True)
+        routine._process_report = self.wrap(routine._process_report, "process_report", top=True, reports=True)
+        routine.decider.decide = self.wrap(routine.decider.decide, "decide")
+        routine.decider.decide_many = self.wrap(routine.decider.decide_many, "decide_many")
+        routine.elo.compute_new_elo = self.wrap(routine.elo.compute_new_elo, "elo")
+        routine.aggregator._handle_ids = self.wrap(routine.aggregator._handle_ids, "handle_ids")
+        if not hasattr(AggregatorHelper._update_incident, "__wrapped__"):
+            AggregatorHelper._update_incident = staticmethod(self.wrap(AggregatorHelper._update_incident, "update_incident"))
+
+        routine.db.execute = self.wrap(routine.db.execute, "sqlite.execute")
+        routine.db._commit = self.wrap(routine.db._commit, "sqlite.commit")
+
+        if queue is not None:
+            # fetch includes the time spent waiting for reports to arrive
+            queue.fetch = self.wrap(queue.fetch, "redis.fetch")
+            queue.ack = self.wrap(queue.ack, "redis.ack")
+            queue.beat = self.wrap(queue.beat, "redis.beat")
+
+        if self._sampler is not None:
+            self._sampler.start()
+
+        print(f"[INFO] Profiling {self.label} ({', '.join(sorted(self.modes))}), "
+              f"dumping every {self.every} report(s) to {self.out_dir}.")
+
+    def _start_sample(self) -> None:
+
+        """Run the coming batch under cProfile, for a `sample` fraction of the batches."""
+
+        if self._profile is not None and random.random() < self.sample:
+            self._profile.enable()
+            self._profiling = True
+
+    def _stop_sample(self) -> None:
+        """Stop profiling the batch that just ended, if it was sampled."""
+        if self._profiling:
+            self._profile.disable()
+            self._profiling = False
+
+    def dump(self) -> None:
+
+        """
+        Log the spans of the window that just ended, write its profiles and
+        start a new window.
+        """
+
+        elapsed: float = time.monotonic() - self.window_started_at
+        print(f"[PROFILE] {self.label}: {self.reports} report(s) in {elapsed:.2f} s "
+              f"({self.reports / max(elapsed, 1e-9):.1f} reports/s)")
+        for name, (calls, total, peak) in sorted(self.spans.items(), key=lambda s: s[1][1], reverse=True):
+            print(f"[PROFILE]   {name:<16} {int(calls):>8}x {total * 1000:>10.1f} ms "
+                  f"({100 * total / max(elapsed, 1e-9):5.1f}%) mean {total / calls * 1000:.3f} ms max {peak * 1000:.2f} ms")
+
+        prefix: str = os.path.join(self.out_dir, f"{self.label}-{os.getpid()}-{self.dumps:04d}")
+        if self._profile is not None or self._sampler is not None:
+            os.makedirs(self.out_dir, exist_ok=True)
+
+        if self._profile is not None:
+            self._profile.dump_stats(f"{prefix}.prof")
+            self._profile = cProfile.Profile()
+            print(f"[PROFILE]   cProfile of sampled batches written to {prefix}.prof")
+
+        if self._sampler is not None:
+            stacks: Dict[str, int] = self._sampler.drain()
+            with open(f"{prefix}.collapsed", "w") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            print(f"[PROFILE]   {sum(stacks.values())} stack sample(s) written to {prefix}.collapsed")
+
+        self.spans = {}
+        self.reports = 0
+        self.dumps += 1
+        self.window_started_at = time.monotonic()
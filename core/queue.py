@@ -0,0 +1,291 @@
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from redis import Redis
+import socket
+import time
+import zlib
+import os
+
+
+# Reports are sharded by location so every location is aggregated by a single
+# worker: the aggregator does read-modify-write on incidents.
+
+QUEUE_PREFIX: str = 'report_queue'
+
+
+def shard_count() -> int:
+    """Number of report queues (and workers), from `REPORT_SHARDS`."""
+    return max(1, int(os.getenv("REPORT_SHARDS", 1)))
+
+
+def shard_for(location_name: Optional[str], shards: Optional[int] = None) -> int:
+
+    """
+    Shard owning a location. Uses CRC32 rather than `hash()`, which is salted
+    per process and would route the same location differently in every worker.
+    """
+
+    shards = shards or shard_count()
+    return zlib.crc32((location_name or '').encode('utf-8')) % shards
+
+
+def queue_name(shard: int) -> str:
+    """Redis list holding the reports of a shard."""
+    return f'{QUEUE_PREFIX}:{shard}'
+
+
+def processing_name(shard: int, worker_id: str) -> str:
+    """Redis list holding the reports a worker took but has not acknowledged yet."""
+    return f'{queue_name(shard)}:processing:{worker_id}'
+
+
+def heartbeat_name(shard: int, worker_id: str) -> str:
+    """Redis key kept alive by a worker while it runs."""
+    return f'{queue_name(shard)}:heartbeat:{worker_id}'
+
+
+def deliveries_name(queue: str) -> str:
+
+    """
+    Redis hash counting, by payload, how many dead workers held a report of
+    `queue`. It only ever holds the reports reaped and not acknowledged since.
+    """
+
+    return f'{queue}:deliveries'
+
+
+DEAD_LETTER_QUEUE: str = f'{QUEUE_PREFIX}:dead'
+
+
+# Moves a dead worker's in-flight reports back to the head of their queue, in
+# order, counting a failed delivery for each of them. A report that reached
+# ARGV[1] deliveries is moved to the dead-letter queue instead: it keeps
+# killing the worker that takes it.
+# KEYS: the processing list, the queue, the dead-letter queue, the queue's deliveries hash.
+# Returns {re-queued, dead-lettered}.
+REAP_SCRIPT: str = """
+local requeued, dead = 0, 0
+while true do
+    local raw = redis.call('RPOP', KEYS[1])
+    if not raw then break end
+    if redis.call('HINCRBY', KEYS[4], raw, 1) >= tonumber(ARGV[1]) then
+        redis.call('RPUSH', KEYS[3], raw)
+        redis.call('HDEL', KEYS[4], raw)
+        dead = dead + 1
+    else
+        redis.call('LPUSH', KEYS[2], raw)
+        requeued = requeued + 1
+    end
+end
+return {requeued, dead}
+"""
+
+
+class ReportQueue:
+
+    """
+    Reliable consumer of a shard's report queue. \n
+    Reports are atomically moved (LMOVE) into a per-worker processing list and
+    only removed from it once acknowledged, after the batch was committed. If the
+    worker dies, `reap` puts whatever it left in flight back on the queue, up to
+    `REPORT_MAX_DELIVERIES` times per report before dead-lettering it.
+    """
+
+    HEARTBEAT_TTL: int = int(os.getenv("WORKER_HEARTBEAT_TTL", 30))  # seconds
+
+    def __init__(self, redis_conn: Redis, shard: int, worker_id: Optional[str] = None) -> None:
+
+        """Initialize the consumer of `shard`, identified by `worker_id` (host and pid by default)."""
+
+        self.redis: Redis = redis_conn
+        self.worker_id: str = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.queue: str = queue_name(shard)
+        self.processing: str = processing_name(shard, self.worker_id)
+        self.heartbeat: str = heartbeat_name(shard, self.worker_id)
+        self.deliveries: str = deliveries_name(self.queue)
+
+    def beat(self) -> bool:
+
+        """
+        Tell the reaper this worker is alive. Returns whether reports left by a
+        dead worker are being redelivered on this shard, in the same round trip.
+        """
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.heartbeat, 1, ex=self.HEARTBEAT_TTL)
+        pipe.exists(self.deliveries)
+        return bool(pipe.execute()[1])
+
+    def fetch(self, batch_size: int, wait_ms: int) -> List[bytes]:
+
+        """
+        Wait (a third of the heartbeat TTL at most) for a report, then take up
+        to `batch_size` reports, waiting at most `wait_ms` for the batch to fill.
+        Returns an empty list if nothing arrived.
+        """
+
+        first: Optional[bytes] = self.redis.blmove(self.queue, self.processing, self.HEARTBEAT_TTL / 3, 'LEFT', 'RIGHT')
+        if first is None:
+            return []
+
+        batch: List[bytes] = [first]
+        deadline: float = time.monotonic() + wait_ms / 1000
+
+        while len(batch) < batch_size:
+
+            # grab whatever is already there in a single round trip
+            pipe = self.redis.pipeline(transaction=False)
+            for _ in range(batch_size - len(batch)):
+                pipe.lmove(self.queue, self.processing, 'LEFT', 'RIGHT')
+            moved: List[bytes] = [m for m in pipe.execute() if m is not None]
+            if moved:
+                batch.extend(moved)
+                continue
+
+            # queue is empty, wait for the rest of the latency budget
+            remaining: float = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            popped: Optional[bytes] = self.redis.blmove(self.queue, self.processing, remaining, 'LEFT', 'RIGHT')
+            if popped is None:
+                break
+            batch.append(popped)
+
+        return batch
+
+    def ack(self, messages: Sequence[bytes], dead: Sequence[bytes] = ()) -> None:
+
+        """
+        Acknowledge a committed batch in one round trip: drop it from the
+        processing list and from the delivery counts, and move the `dead`
+        (poison) messages to the dead-letter queue.
+        """
+
+        pipe = self.redis.pipeline(transaction=True)
+        for raw in dead:
+            pipe.rpush(DEAD_LETTER_QUEUE, raw)
+        for raw in messages:
+            pipe.lrem(self.processing, 1, raw)
+        if messages:
+            pipe.hdel(self.deliveries, *messages)
+        pipe.execute()
+
+    @staticmethod
+    def reap(redis_conn: Redis, max_deliveries: Optional[int] = None) -> Tuple[int, int]:
+
+        """
+        Put the in-flight reports of workers whose heartbeat expired back at the
+        head of their queue, in order. A report that was in flight in
+        `max_deliveries` dead workers (`REPORT_MAX_DELIVERIES` by default) goes
+        to the dead-letter queue instead, so it cannot crash-loop its shard.
+        Returns the number of reports re-queued and dead-lettered.
+        """
+
+        max_deliveries = max(1, max_deliveries or int(os.getenv("REPORT_MAX_DELIVERIES", 5)))
+        reap_script = redis_conn.register_script(REAP_SCRIPT)
+
+        requeued: int = 0
+        dead: int = 0
+        for key in redis_conn.scan_iter(match=f'{QUEUE_PREFIX}:*:processing:*'):
+
+            processing: str = key.decode()
+            queue, worker_id = processing.split(':processing:', 1)
+            if redis_conn.exists(f'{queue}:heartbeat:{worker_id}'):
+                continue
+
+            moved, dropped = reap_script(keys=[processing, queue, DEAD_LETTER_QUEUE, deliveries_name(queue)], args=[max_deliveries])
+            requeued += moved
+            dead += dropped
+
+        return requeued, dead
+
+
+# Pushes reports onto one or more queues, all or nothing: if any queue would
+# grow past ARGV[1] reports, nothing is pushed.
+# KEYS: the queues. ARGV: the max depth, the number of reports of each queue,
+# then the reports, queue after queue.
+# Returns {1, new length of each queue}, or {0, index of the full queue, its depth}.
+BOUNDED_PUSH_SCRIPT: str = """
+local max = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    local depth = redis.call('LLEN', KEYS[i])
+    if depth + tonumber(ARGV[1 + i]) > max then
+        return {0, i, depth}
+    end
+end
+local lengths = {1}
+local at = 2 + #KEYS
+for i = 1, #KEYS do
+    local last = at + tonumber(ARGV[1 + i]) - 1
+    while at <= last do
+        -- unpack is bounded by the Lua stack, push large batches in chunks
+        local stop = math.min(at + 999, last)
+        lengths[i + 1] = redis.call('RPUSH', KEYS[i], unpack(ARGV, at, stop))
+        at = stop + 1
+    end
+end
+return lengths
+"""
+
+
+class QueueFull(Exception):
+
+    """Raised when pushing would grow a report queue past its maximum depth."""
+
+    def __init__(self, queue: str, depth: int) -> None:
+        super().__init__(f"{queue} holds {depth} report(s)")
+        self.queue: str = queue
+        self.depth: int = depth
+
+
+class ReportProducer:
+
+    """
+    Pushes encoded reports onto their shard queues in a single round trip. \n
+    With a `max_depth`, the push is refused (`QueueFull`) rather than letting
+    a queue grow past it, so a spike is pushed back to the clients instead of
+    growing Redis memory. The depth check and the push run in one Lua script,
+    so concurrent API workers cannot overshoot the limit together.
+    """
+
+    def __init__(self, redis_conn: Redis, max_depth: Optional[int] = None) -> None:
+
+        """Initialize the producer, `max_depth` defaults to the `MAX_QUEUE_DEPTH` environment variable."""
+
+        self.redis: Redis = redis_conn
+        # reports per queue, 0 is unbounded
+        self.max_depth: int = max(0, max_depth if max_depth is not None else int(os.getenv("MAX_QUEUE_DEPTH", 0)))
+        self._bounded_push = redis_conn.register_script(BOUNDED_PUSH_SCRIPT)
+
+    def push(self, reports: Sequence[Tuple[str, bytes]]) -> Dict[str, int]:
+
+        """
+        Push `(queue, payload)` pairs, in order within each queue. Returns the
+        new length of every queue pushed to. Raises `QueueFull` if one of the
+        queues is too deep, in which case nothing was pushed.
+        """
+
+        queues: Dict[str, List[bytes]] = {}
+        for queue, payload in reports:
+            queues.setdefault(queue, []).append(payload)
+        if not queues:
+            return {}
+
+        if self.max_depth <= 0:
+            if len(queues) == 1:
+                ((queue, payloads),) = queues.items()
+                return {queue: self.redis.rpush(queue, *payloads)}  # RPUSH returns the new length
+            pipe = self.redis.pipeline(transaction=False)
+            for queue, payloads in queues.items():
+                pipe.rpush(queue, *payloads)
+            return dict(zip(queues, pipe.execute()))
+
+        keys: List[str] = list(queues)
+        args: List[Any] = [self.max_depth, *(len(queues[k]) for k in keys)]
+        for k in keys:
+            args.extend(queues[k])
+
+        result: List[int] = self._bounded_push(keys=keys, args=args)
+        if not result[0]:
+            raise QueueFull(keys[result[1] - 1], result[2])
+        return dict(zip(keys, result[1:]))
@@ -1,14 +1,64 @@
 
 from dataclasses import dataclass
-from typing import Tuple, Optional, Any
+from typing import Dict, List, Tuple, Optional, Any, Sequence, Union
 from db import ReportType
+import msgpack
 import json
+import os
 
+try:
+    import orjson  # optional, about 3x faster than json on report payloads
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    _loads = json.loads
 
-@dataclass
+
+_REPORT_TYPES: Dict[str, ReportType] = {t.value: t for t in ReportType}
+
+# Queue wire formats. A binary payload starts with its version byte, a JSON one
+# with `{`, so the worker decodes both while the API switches from one to the other.
+WIRE_FORMATS: Tuple[str, ...] = ("json", "msgpack")
+MSGPACK_V1: bytes = b"\x01"  # then a msgpack array [user_name, lat, lon, location_name, lat, lon, report_type, delay_minutes]
+
+
+def _position(value: Any, field: str) -> Tuple[float, float]:
+
+    """Validate a `[lat, lon]` or `{"latitude", "longitude"}` position."""
+
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        lat, lon = value
+    elif isinstance(value, dict):
+        lat, lon = value.get("latitude"), value.get("longitude")
+    else:
+        raise ValueError(f"{field} must be [latitude, longitude]")
+
+    if type(lat) not in (int, float) or type(lon) not in (int, float):
+        raise ValueError(f"{field} coordinates must be numbers")
+    # NaN fails both comparisons
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        raise ValueError(f"{field} is out of range")
+    return (float(lat), float(lon))
+
+
+def _name(value: Any, field: str) -> str:
+
+    """Validate a non-empty string."""
+
+    if type(value) is not str or not value:
+        raise ValueError(f"{field} must be a non-empty string")
+    return value
+
+
+@dataclass(frozen=True, slots=True)
 class ReportMessage:
 
-    """Structured representation of a user report message."""
+    """
+    Structured representation of a user report message. \n
+    Messages are only built through the validating decoders below, so a
+    message that exists is well-formed: bad payloads are rejected with a
+    `ValueError` before any database work.
+    """
 
     user_name: str
     user_location: Tuple[float, float]
@@ -16,7 +66,7 @@ class ReportMessage:
     location_pos: Tuple[float, float]
     report_type: ReportType
     delay_minutes: Optional[int] = None
-    
+
     def to_dict(self) -> dict:
         return {
             "user_name": self.user_name,
@@ -32,26 +82,170 @@ class ReportMessage:
             "report_type": self.report_type.name,
             "delay_minutes": self.delay_minutes
         }
-    
+
     @classmethod
-    def from_json(cls, raw: str) -> 'ReportMessage':
+    def from_dict(cls, data: Any) -> 'ReportMessage':
+
+        """
+        Validate a decoded payload and build the message, in a single pass. \n
+        Positions are `[lat, lon]` lists (as sent by the app) or
+        `{"latitude", "longitude"}` objects (as written by `to_dict()`).
+        Raises `ValueError` on the first invalid field.
+        """
+
+        if not isinstance(data, dict):
+            raise ValueError("report must be a JSON object")
+
+        return cls._validated(
+            data.get('user_name'), data.get('user_location'), data.get('location_name'),
+            data.get('location_pos'), data.get('report_type'), data.get('delay_minutes')
+        )
+
+    @classmethod
+    def _validated(
+        cls,
+        user_name: Any,
+        user_location: Any,
+        location_name: Any,
+        location_pos: Any,
+        report_type: Any,
+        delay: Any
+    ) -> 'ReportMessage':
+
+        """Validate the raw fields of a report, whatever its wire format, and build the message."""
+
+        rtype: Optional[ReportType] = _REPORT_TYPES.get(report_type) if type(report_type) is str else None
+        if rtype is None:
+            raise ValueError(f"report_type must be one of {', '.join(_REPORT_TYPES)}")
+
+        if delay is not None:
+            if type(delay) is float and delay.is_integer():
+                delay = int(delay)
+            if type(delay) is not int or delay < 0:
+                raise ValueError("delay_minutes must be a non-negative integer or null")
 
-        """Creates a ReportMessage instance from a JSON string."""
-        
-        data: Any = json.loads(raw)
-        
         return cls(
-            user_name=data.get('user_name'),
-            user_location=(
-                data.get('user_location')[0],
-                data.get('user_location')[1]
-            ),
-            location_name=data.get('location_name'),
-            location_pos=(
-                data.get('location_pos')[0],
-                data.get('location_pos')[1]
-            ),
-            report_type=ReportType(data.get('report_type')),
-            delay_minutes=data.get('delay_minutes')
+            user_name=_name(user_name, 'user_name'),
+            user_location=_position(user_location, 'user_location'),
+            location_name=_name(location_name, 'location_name'),
+            location_pos=_position(location_pos, 'location_pos'),
+            report_type=rtype,
+            delay_minutes=delay
         )
 
+    @classmethod
+    def from_json(cls, raw: Union[str, bytes]) -> 'ReportMessage':
+
+        """Creates a ReportMessage instance from a JSON string, see `from_dict()`."""
+
+        return cls.from_dict(_loads(raw))
+
+    @classmethod
+    def decode_array(cls, raw: Union[str, bytes]) -> List[Union['ReportMessage', ValueError]]:
+
+        """
+        Decode a JSON array of reports (a `/enqueue/batch` body). Returns, in
+        order, the message or the `ValueError` that rejected each of them.
+        Raises `ValueError` if the body is not a JSON array.
+        """
+
+        data: Any = _loads(raw)
+        if not isinstance(data, list):
+            raise ValueError("body must be a JSON array of reports")
+
+        messages: List[Union[ReportMessage, ValueError]] = []
+        for item in data:
+            try: messages.append(cls.from_dict(item))
+            except ValueError as e: messages.append(e)
+        return messages
+
+    def to_wire(self, fmt: str = "json") -> bytes:
+
+        """
+        Encode the message for the report queue, as JSON (the `/enqueue`
+        request format) or as a versioned msgpack record.
+        """
+
+        if fmt == "msgpack":
+            return MSGPACK_V1 + msgpack.packb([
+                self.user_name, self.user_location[0], self.user_location[1],
+                self.location_name, self.location_pos[0], self.location_pos[1],
+                self.report_type.value, self.delay_minutes
+            ])
+        if fmt == "json":
+            return json.dumps({
+                "user_name": self.user_name,
+                "user_location": list(self.user_location),
+                "location_name": self.location_name,
+                "location_pos": list(self.location_pos),
+                "report_type": self.report_type.value,
+                "delay_minutes": self.delay_minutes
+            }).encode()
+        raise ValueError(f"Unknown wire format {fmt!r}, expected one of {', '.join(WIRE_FORMATS)}")
+
+    @classmethod
+    def from_wire(cls, raw: Union[str, bytes]) -> 'ReportMessage':
+
+        """Decode a queued report in any wire format, see `to_wire()`."""
+
+        if raw[:1] == MSGPACK_V1:
+            return cls._from_msgpack(raw)
+        return cls.from_json(raw)
+
+    @classmethod
+    def _from_msgpack(cls, raw: bytes) -> 'ReportMessage':
+
+        """Decode a msgpack v1 record (version byte included)."""
+
+        try:
+            fields: Any = msgpack.unpackb(raw[1:])
+        except ValueError as e:
+            raise ValueError(f"invalid msgpack report: {e}") from None
+        if type(fields) is not list or len(fields) != 8:
+            raise ValueError("msgpack report must be an array of 8 fields")
+
+        uname, ulat, ulon, lname, plat, plon, rtype, delay = fields
+        return cls._validated(uname, (ulat, ulon), lname, (plat, plon), rtype, delay)
+
+    @classmethod
+    def decode_many(cls, raws: Sequence[bytes]) -> List[Union['ReportMessage', ValueError]]:
+
+        """
+        Decode a batch of raw reports, in any wire format. Returns, in order,
+        the message or the `ValueError` that rejected each of them. \n
+        The JSON reports of the batch are parsed as a single JSON array, only
+        falling back to one parse per report when one of them is not valid JSON.
+        """
+
+        messages: List[Union[ReportMessage, ValueError]] = [None] * len(raws)  # type: ignore[list-item]
+        json_at: List[int] = []
+        for i, raw in enumerate(raws):
+            if raw[:1] == MSGPACK_V1:
+                try: messages[i] = cls._from_msgpack(raw)
+                except ValueError as e: messages[i] = e
+            else:
+                json_at.append(i)
+
+        if not json_at:
+            return messages
+
+        # every raw report is a whole JSON document (/enqueue validated it), so the
+        # array lines up with the batch, the length check catches anything else
+        try:
+            joined: bytes = b"[" + b",".join(raws[i] if isinstance(raws[i], bytes) else raws[i].encode() for i in json_at) + b"]"
+            decoded: List[Any] = _loads(joined)
+            if len(decoded) != len(json_at):
+                raise ValueError("batch split into a different number of reports")
+        except ValueError:
+            decoded = []
+            for i in json_at:
+                try: decoded.append(_loads(raws[i]))
+                except ValueError as e: decoded.append(e)
+
+        for i, data in zip(json_at, decoded):
+            if isinstance(data, ValueError):
+                messages[i] = data
+                continue
+            try: messages[i] = cls.from_dict(data)
+            except ValueError as e: messages[i] = e
+        return messages
@@ -1,60 +1,260 @@
 
 from .aggregator import Aggregator
 from .decider import Decider
+from .profiling import Profiler
+from .queue import ReportQueue, queue_name, shard_for
 from .report_message import ReportMessage
 from .user_elo import UserElo
-from db import Database, UserRepository
-from typing import Tuple
-from redis import Redis
+from db import Database, GeneralRepository, IncidentRepository, ReportRepository, ReportType, UserRepository
+from typing import Dict, List, Optional, Set, Tuple
+from redis import Redis, RedisError
+import sqlite3
+import time
 import os
 
 class Routine:
 
-    def __init__(self, db: Database) -> None:
+    # errors of the environment rather than of the report (a locked database,
+    # Redis going away): they roll the batch back and `run` processes it again
+    # after a back-off, the worker keeps it in its processing list meanwhile.
+    # Anything else a report raises would be raised again, the report goes to
+    # the dead-letter queue.
+    TRANSIENT_ERRORS: Tuple[type, ...] = (sqlite3.OperationalError, RedisError, MemoryError)
+    RETRY_BACKOFF: float = 0.1  # seconds before the first retry, doubled on every failure
+    STATS_INTERVAL: float = float(os.getenv("STATS_DUMP_INTERVAL", 60))  # seconds between two stats dumps
 
-        """Initialize the Routine with a Database instance."""
+    def __init__(
+        self,
+        db: Database,
+        batch_size: Optional[int] = None,
+        batch_wait_ms: Optional[int] = None,
+        shard: int = 0
+    ) -> None:
+
+        """
+        Initialize the Routine with a Database instance. \n
+        `batch_size` caps how many reports are drained from the queue at once and
+        `batch_wait_ms` how long to wait for a batch to fill up once the first
+        report arrived. Both default to the `REPORT_BATCH_SIZE` and
+        `REPORT_BATCH_WAIT_MS` environment variables. \n
+        The routine only consumes the queue of its `shard`. With `WORKER_PROFILE`
+        set, its hot path is profiled (see `Profiler`).
+        """
 
         self.db: Database = db
-        self.aggregator: Aggregator = Aggregator(db)
+        self.aggregator: Aggregator = Aggregator(db, shard)
         self.decider: Decider = Decider(db)
         self.elo: UserElo = UserElo(db)
         self.user_repo: UserRepository = UserRepository(db)
 
+        self.shard: int = shard
+        self.queue: str = queue_name(shard)
+        self.batch_size: int = max(1, batch_size or int(os.getenv("REPORT_BATCH_SIZE", 64)))
+        self.batch_wait_ms: int = max(0, batch_wait_ms if batch_wait_ms is not None
+                                      else int(os.getenv("REPORT_BATCH_WAIT_MS", 50)))
+        self.profiler: Optional[Profiler] = Profiler.from_env(f"worker-{shard}")
+
     def run(self) -> None:
 
         """Main processing loop for incoming reports."""
 
         redis_conn: Redis = Redis(host=os.getenv("REDIS_HOST", "redis"), port=os.getenv("REDIS_PORT", 6379), db=os.getenv("REDIS_DB", 0))
-        print(f"[INFO] Listening for incoming reports.")
+        self.db.add_commit_hook(lambda tables: self._publish_changes(redis_conn, tables))
+        print(f"[INFO] Listening for incoming reports on {self.queue} (batch of {self.batch_size}, {self.batch_wait_ms} ms).")
+
+        self.warm_up()
+        queue: ReportQueue = ReportQueue(redis_conn, self.shard)
+        print(f"[INFO] Worker {queue.worker_id} in-flight list is {queue.processing}.")
+        if self.profiler is not None:
+            self.profiler.instrument(self, queue)
+
+        dumped_at: float = time.monotonic()
+        raw_messages: List[bytes] = []  # batch taken but not acknowledged yet
+        dead: Optional[List[bytes]] = None  # its poison messages, once committed
+        failures: int = 0
 
         while True:
-            _, raw_message = redis_conn.blpop('report_queue')
-            report: ReportMessage = ReportMessage.from_json(raw_message)
-            self._process_report(report)
+            try:
+                redelivering: bool = queue.beat()
+                if self.db.stats is not None and time.monotonic() - dumped_at >= self.STATS_INTERVAL:
+                    self.dump_stats()
+                    dumped_at = time.monotonic()
+
+                # while a dead worker's reports are redelivered, take them one at a
+                # time: only a report that kills this worker too is charged for it
+                if not raw_messages:
+                    raw_messages = queue.fetch(1 if redelivering else self.batch_size, self.batch_wait_ms)
+                    if not raw_messages:
+                        continue
+
+                # acknowledged only once committed, a crash before that leaves the
+                # batch in the processing list for the reaper to re-queue
+                if dead is None:
+                    dead = self._process_batch(raw_messages)
+                queue.ack(raw_messages, dead)
+                raw_messages, dead, failures = [], None, 0
+
+            except self.TRANSIENT_ERRORS as e:
+                # retry the same batch (or only its ack, if it was committed),
+                # beating often enough for the reaper to leave it alone
+                failures += 1
+                backoff: float = min(self.RETRY_BACKOFF * 2 ** (failures - 1), queue.HEARTBEAT_TTL / 3)
+                print(f"[WARN] Batch of {len(raw_messages)} report(s) failed ({type(e).__name__}: {e}), "
+                      f"retry {failures} in {backoff:.1f} s.")
+                time.sleep(backoff)
+
+    def warm_up(self, user_hours: float = 24) -> None:
+
+        """
+        Preload what the first batches would otherwise fetch one by one: the
+        location index, the type IDs, the IDs of this shard's locations with
+        an active incident and the users who reported in the last `user_hours`.
+        """
+
+        started_at: float = time.monotonic()
+        general_repo: GeneralRepository = GeneralRepository(self.db)
+
+        locations: int = len(self.db.location_index())
+        for t in ReportType:
+            general_repo.get_type_id(t)
+
+        active: int = 0
+        for location_id, name in IncidentRepository(self.db).list_active_locations():
+            if shard_for(name) == self.shard:
+                general_repo.location_ids.put(name, location_id)
+                active += 1
+
+        uids: List[int] = ReportRepository(self.db).get_recent_user_ids(user_hours, self.user_repo.rows.maxsize)
+        for user in self.user_repo.get_users(uids).values():
+            self.user_repo.ids.put(user["username"], user["id"])
+
+        print(f"[INFO] Warmed up {locations} indexed location(s), {active} active location(s) "
+              f"and {len(uids)} user(s) in {(time.monotonic() - started_at) * 1000:.1f} ms.")
+
+    def dump_stats(self, top: int = 10) -> None:
+
+        """
+        Log the `top` statements by total time (with `DB_STATS` set) and the
+        hit rate of every row cache of the worker.
+        """
+
+        if self.db.stats is not None:
+            entries: List[Dict] = self.db.stats.top(top)
+            total: Dict = self.db.stats.snapshot()
+            print(f"[STATS] {self.queue}: {sum(e['calls'] for e in total.values())} statement(s), "
+                  f"{sum(e['total_s'] for e in total.values()):.3f} s in SQLite, top {len(entries)}:")
+            for e in entries:
+                print(f"[STATS]   {e['calls']:>8}x {e['total_s'] * 1000:>10.1f} ms "
+                      f"(max {e['max_s'] * 1000:.2f} ms) {e['rows']:>8} rows  {e['query'][:120]}")
+
+        for name, c in sorted(self.db.cache_stats().items()):
+            lookups: int = c["hits"] + c["misses"]
+            print(f"[STATS]   cache {name}: {c['hits']}/{lookups} hits "
+                  f"({100 * c['hits'] / max(lookups, 1):.1f}%), {c['size']}/{c['maxsize']} entries")
+
+    @staticmethod
+    def _publish_changes(redis_conn: Redis, tables: Set[str]) -> None:
+
+        """Bump the incidents version so the API drops its cached GTFS feed."""
 
-    def _process_report(self, report: ReportMessage) -> None:
+        if "incidents" in tables:
+            redis_conn.incr('incidents_version')
 
-        """Process an incoming report message."""
+    def _process_batch(self, raw_messages: List[bytes]) -> List[bytes]:
+
+        """
+        Decode and process a batch of raw reports inside a single transaction. \n
+        A report that fails to decode or to process is rolled back on its own
+        (savepoint) and returned as a poison message, the rest of the batch goes
+        on. Only `TRANSIENT_ERRORS` abort the batch.
+        """
+
+        dead: List[bytes] = []
+        reports: List[Tuple[bytes, ReportMessage]] = []
+
+        for raw, message in zip(raw_messages, ReportMessage.decode_many(raw_messages)):
+            if isinstance(message, ReportMessage):
+                reports.append((raw, message))
+            else:
+                print(f"[ERROR] Dropping invalid report to the dead-letter queue ({type(message).__name__}: {message}).")
+                dead.append(raw)
+
+        with self.db.transaction():
+            decisions: List[Optional[Tuple[bool, float]]] = self._decide_batch([r for _, r in reports])
+            for (raw, report), decision in zip(reports, decisions):
+                try:
+                    self._process_report(report, decision)
+                except self.TRANSIENT_ERRORS:
+                    raise
+                except Exception as e:
+                    print(f"[ERROR] Dropping report to the dead-letter queue ({type(e).__name__}: {e}).")
+                    dead.append(raw)
+
+        print(f"[INFO] Batch of {len(raw_messages)} report(s) committed ({len(dead)} dead).")
+        return dead
+
+    def _decide_batch(self, reports: List[ReportMessage]) -> List[Optional[Tuple[bool, float]]]:
+
+        """
+        Decide the first report of every user in the batch at once. Later reports
+        of the same user are left undecided (None): they depend on the trust score
+        updated by the previous ones and go through `Decider.decide` in turn.
+        """
+
+        decisions: List[Optional[Tuple[bool, float]]] = [None] * len(reports)
+        first: Dict[str, int] = {}
+        for i, report in enumerate(reports):
+            first.setdefault(report.user_name, i)
+
+        if not first:
+            return decisions
+
+        try:
+            mask, prob = self.decider.decide_many([reports[i] for i in first.values()])
+        except self.TRANSIENT_ERRORS:
+            raise
+        except Exception:
+            return decisions  # e.g. an unknown user, decided (and rejected or dropped) one by one
+
+        for k, i in enumerate(first.values()):
+            decisions[i] = (bool(mask[k]), float(prob[k]))
+        return decisions
+
+    def _process_report(self, report: ReportMessage, decision: Optional[Tuple[bool, float]] = None) -> None:
+
+        """
+        Process an incoming report message. \n
+        All of its writes land in one transaction, or in a savepoint of the
+        enclosing batch transaction. A `decision` already made for the report
+        (see `Decider.decide_many`) is used instead of deciding again.
+        """
+
+        with self.db.transaction():
+            self._handle_report(report, decision)
+
+    def _handle_report(self, report: ReportMessage, decision: Optional[Tuple[bool, float]] = None) -> None:
+
+        """Decide, score and aggregate a single report."""
 
         # Step 1: Decide if the report is valid
         user_id: int = UserRepository(self.db).get_user_id(report.user_name)
 
-        k: Tuple[bool, float] = self.decider.decide(report)
+        k: Tuple[bool, float] = decision or self.decider.decide(report)
         if not k[0]:
             print(f"[INFO] Report from {report.user_name} rejected (with {k[1]}).")
             # Penalize user trust score for false report
             new_elo: float = self.elo.compute_new_elo(user_id, False)
             self.user_repo.update_trust_score(user_id, new_elo)
             return
-        
+
         # Reward user trust score for valid report
         new_elo: float = self.elo.compute_new_elo(user_id, True)
         self.aggregator.user_repo.update_trust_score(user_id, new_elo)
 
         print(f"[INFO] Report from {report.user_name} accepted (with {k[1]}).")
-        
+
         # Step 2: Aggregate the report into the system
         self.aggregator.routine(report)
         print(f"[INFO] Report from {report.user_name} processed.")
 
-       
\ No newline at end of file
+
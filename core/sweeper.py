@@ -0,0 +1,66 @@
+
+from db import Database, IncidentRepository
+from typing import Optional, Tuple
+import time
+import os
+
+
+class Sweeper:
+
+    """
+    Expires the active incidents nobody reported on for longer than their
+    remaining delay (plus a grace period) by marking them resolved. Incidents
+    reported without a delay expire after a default TTL instead. \n
+    Incidents are resolved in batches of `batch_size`, each batch in its own
+    short transaction so the routine workers are never blocked for long.
+    """
+
+    INTERVAL: float = float(os.getenv("SWEEP_INTERVAL", 60))  # seconds between two sweeps
+
+    def __init__(
+        self,
+        db: Database,
+        grace_minutes: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        default_ttl_minutes: Optional[float] = None
+    ) -> None:
+
+        """
+        Initialize the Sweeper with a Database instance. \n
+        The settings default to the `SWEEP_GRACE_MINUTES`, `SWEEP_BATCH_SIZE` and
+        `INCIDENT_DEFAULT_TTL_MINUTES` environment variables. A TTL of 0 keeps
+        the incidents without a delay active until they are resolved otherwise.
+        """
+
+        self.db: Database = db
+        self.incident_repo: IncidentRepository = IncidentRepository(db)
+
+        self.grace_minutes: float = grace_minutes if grace_minutes is not None \
+            else float(os.getenv("SWEEP_GRACE_MINUTES", 5))
+        self.batch_size: int = max(1, batch_size or int(os.getenv("SWEEP_BATCH_SIZE", 500)))
+        ttl: float = default_ttl_minutes if default_ttl_minutes is not None \
+            else float(os.getenv("INCIDENT_DEFAULT_TTL_MINUTES", 60))
+        self.default_ttl_minutes: Optional[float] = ttl if ttl > 0 else None
+
+    def sweep(self) -> Tuple[int, float]:
+
+        """
+        Resolve every stale incident, batch after batch. \n
+        Returns the number of incidents resolved and the sweep duration in seconds.
+        """
+
+        started_at: float = time.monotonic()
+        resolved: int = 0
+
+        while True:
+            with self.db.transaction():
+                n: int = self.incident_repo.update_status_for_old_incidents(
+                    self.grace_minutes, self.batch_size, self.default_ttl_minutes
+                )
+            resolved += n
+            if n < self.batch_size:
+                break
+
+        duration: float = time.monotonic() - started_at
+        print(f"[INFO] Sweep resolved {resolved} stale incident(s) in {duration * 1000:.1f} ms.")
+        return resolved, duration
@@ -2,16 +2,24 @@
 # __init__.py file for db package
 from typing import List
 from .db import Database, ReportType, Status
+from .pool import ConnectionPool
+from .stats import QueryStats, query_stats, render_prometheus
+from .migrations import LATEST_VERSION, migrate, schema_version
 from .repositories.user_repository import UserRepository
 from .repositories.report_repository import ReportRepository
 from .repositories.incident_repository import IncidentRepository
+from .repositories.incident_stats_repository import IncidentStatsRepository
 from .repositories.general_repository import GeneralRepository
 
 __all__: List[str] = [
     "Database", "ReportType", "Status",
+    "ConnectionPool",
+    "QueryStats", "query_stats", "render_prometheus",
+    "LATEST_VERSION", "migrate", "schema_version",
     "UserRepository",
     "ReportRepository",
     "IncidentRepository",
+    "IncidentStatsRepository",
     "GeneralRepository"
 ]
 
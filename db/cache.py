@@ -0,0 +1,92 @@
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import time
+import os
+
+
+# how long reference lookups (type, location and user ids) stay cached, in seconds
+REFERENCE_TTL: float = float(os.getenv("REFERENCE_CACHE_TTL", 300))
+REFERENCE_MAXSIZE: int = int(os.getenv("REFERENCE_CACHE_SIZE", 8192))
+
+
+class LRUCache:
+
+    """
+    Small least-recently-used cache, bounded to `maxsize` entries and
+    optionally expiring entries `ttl` seconds after they were cached. \n
+    Not thread-safe, each `Database` (hence each thread) owns its caches.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, volatile: bool = False) -> None:
+
+        """
+        Initialize an empty cache. A `volatile` cache holds rows other
+        connections may change, it is dropped whenever they commit.
+        """
+
+        self.maxsize: int = maxsize
+        self.ttl: Optional[float] = ttl
+        self.volatile: bool = volatile
+        self.hits: int = 0
+        self.misses: int = 0
+        self._data: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, count: bool = True) -> Optional[Any]:
+
+        """Return the cached value, or None if absent or expired."""
+
+        entry: Optional[Tuple[Any, float]] = self._data.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._data[key]
+            entry = None
+
+        if entry is None:
+            if count: self.misses += 1
+            return None
+
+        if count: self.hits += 1
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Optional[Any]]) -> Optional[Any]:
+
+        """
+        Read-through lookup: on a miss, call `loader` and cache its result.
+        None results are not cached, so a row added later is still found.
+        """
+
+        value: Optional[Any] = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+
+        """Cache a value, evicting the least recently used entry if full."""
+
+        expires: float = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """Invalidate a single entry."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Invalidate every entry."""
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and current size."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
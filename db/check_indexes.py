@@ -0,0 +1,177 @@
+
+"""
+Checks that every repository query is served by an index. \n
+Each repository method is run against a small in-memory database, and the
+EXPLAIN QUERY PLAN of every statement it executes is inspected. A scan (of
+the table or of a whole index) or a temporary sort b-tree fails the check,
+unless the method is a whole-table listing allowed in `ALLOWED_SCANS`. \n
+Usage: python -m db.check_indexes
+"""
+
+from .db import Database, ReportType, Status
+from .migrations import migrate
+from .repositories.user_repository import UserRepository
+from .repositories.report_repository import ReportRepository
+from .repositories.incident_repository import IncidentRepository
+from .repositories.incident_stats_repository import IncidentStatsRepository
+from .repositories.general_repository import GeneralRepository
+from typing import Any, Callable, List, Set, Tuple
+import datetime
+import sys
+
+
+# listings that read every row by design, a scan is the best plan for them.
+# Their filtered variants are labelled `method(filter)` and checked.
+ALLOWED_SCANS: Set[str] = {
+    "GeneralRepository.list_locations",
+    "GeneralRepository.list_types",
+    "UserRepository.list_users",
+    "ReportRepository.list_reports",
+    "ReportRepository.iter_reports",
+    "IncidentRepository.list_incidents",
+    "IncidentRepository.list_incidents_detailed",
+    "IncidentRepository.iter_incidents_detailed",
+    "ReportRepository.list_recent_reports",  # walks idx_reports_created_at, stops at LIMIT
+    "IncidentRepository.list_active_locations",  # reads the active set only, grouped in a temp b-tree
+    "IncidentRepository.list_incidents(location_id)",  # seeks the location, sorts its few incidents
+}
+
+
+def _plan_problems(db: Database, query: str, params: Tuple) -> List[str]:
+
+    """The full scans and temporary sorts in the query plan of a statement."""
+
+    if not query.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+        return []
+
+    rows: List[Tuple] = db.conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall()
+    return [
+        detail for *_, detail in rows
+        # SCAN walks the whole table (or index), only SEARCH seeks into an index
+        if (detail.startswith("SCAN ") and detail != "SCAN CONSTANT ROW") or detail.startswith("USE TEMP B-TREE")
+    ]
+
+
+def _calls(db: Database) -> List[Tuple[str, Callable[[], Any]]]:
+
+    """Every repository method, with arguments hitting the seeded rows."""
+
+    general: GeneralRepository = GeneralRepository(db)
+    users: UserRepository = UserRepository(db)
+    reports: ReportRepository = ReportRepository(db)
+    incidents: IncidentRepository = IncidentRepository(db)
+    stats: IncidentStatsRepository = IncidentStatsRepository(db)
+    since: datetime.datetime = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(hours=1)
+
+    return [
+        ("GeneralRepository.add_location", lambda: general.add_location("trip@stop", (50.06, 19.94))),
+        ("GeneralRepository.get_type_id", lambda: general.get_type_id(ReportType.DELAY)),
+        ("GeneralRepository.get_location_id", lambda: general.get_location_id("trip@stop")),
+        ("GeneralRepository.get_location_by_id", lambda: general.get_location_by_id(1)),
+        ("GeneralRepository.list_locations", lambda: general.list_locations()),
+        ("GeneralRepository.list_types", lambda: general.list_types()),
+
+        ("UserRepository.add_user", lambda: users.add_user("check", "check@check.check")),
+        ("UserRepository.ensure_user", lambda: users.ensure_user("check", "check@check.check")),
+        ("UserRepository.get_user", lambda: users.get_user(1)),
+        ("UserRepository.get_users", lambda: users.get_users([1, 2])),
+        ("UserRepository.get_user_id", lambda: users.get_user_id("check")),
+        ("UserRepository.get_users_by_name", lambda: users.get_users_by_name(["check", "other"])),
+        ("UserRepository.update_trust_score", lambda: users.update_trust_score(1, 0.5)),
+        ("UserRepository.update_reports_made", lambda: users.update_reports_made(1, 1)),
+        ("UserRepository.list_users", lambda: users.list_users()),
+
+        ("IncidentRepository.add_incident", lambda: incidents.add_incident(1, 1, 5.0, 0.5)),
+        ("IncidentRepository.get_incident", lambda: incidents.get_incident(1)),
+        ("IncidentRepository.get_incidents_since", lambda: incidents.get_incidents_since(since)),
+        ("IncidentRepository.get_incidents_since_detailed", lambda: incidents.get_incidents_since_detailed(since)),
+        ("IncidentRepository.list_active_locations", lambda: incidents.list_active_locations()),
+        ("IncidentRepository.get_incident_by_location", lambda: incidents.get_incident_by_location(1)),
+        ("IncidentRepository.list_incidents", lambda: incidents.list_incidents()),
+        ("IncidentRepository.list_incidents(location_id)", lambda: incidents.list_incidents(location_id=1)),
+        ("IncidentRepository.list_incidents(status)", lambda: incidents.list_incidents(status="active")),
+        ("IncidentRepository.list_incidents_detailed", lambda: incidents.list_incidents_detailed()),
+        ("IncidentRepository.list_incidents_detailed(location_ids)", lambda: incidents.list_incidents_detailed(status="active", location_ids=[1])),
+        ("IncidentRepository.iter_incidents_detailed", lambda: list(incidents.iter_incidents_detailed(limit=10))),
+        ("IncidentRepository.iter_incidents_detailed(after_id)", lambda: list(incidents.iter_incidents_detailed(after_id=2, limit=10))),
+        ("IncidentRepository.update_trust_score", lambda: incidents.update_trust_score(1, 0.5)),
+        ("IncidentRepository.update_avg_delay", lambda: incidents.update_avg_delay(1, 5.0)),
+        ("IncidentRepository.update_last_updated", lambda: incidents.update_last_updated(1)),
+        ("IncidentRepository.update_status", lambda: incidents.update_status(1, Status.ACTIVE)),
+        ("IncidentRepository.update_aggregates", lambda: incidents.update_aggregates(1, 1, 5.0, 0.5)),
+        ("IncidentRepository.update_incident_type", lambda: incidents.update_incident_type(1, 1)),
+        ("IncidentRepository.update_status_for_old_incidents", lambda: incidents.update_status_for_old_incidents()),
+
+        ("IncidentStatsRepository.save_stats", lambda: stats.save_stats({
+            "incident_id": 1, "report_count": 1, "delay_sum": 0.0, "delay_count": 0,
+            "weight_sum": 1.0, "weight_max": 1.0, "type_counts": {1: [1, 1]}
+        })),
+        ("IncidentStatsRepository.get_stats", lambda: stats.get_stats(1)),
+
+        ("ReportRepository.add_report", lambda: reports.add_report(1, 1, 1, 5)),
+        ("ReportRepository.get_report", lambda: reports.get_report(1)),
+        ("ReportRepository.assign_to_incident", lambda: reports.assign_to_incident(1, 1)),
+        ("ReportRepository.get_reports_by_incident", lambda: reports.get_reports_by_incident(1)),
+        ("IncidentRepository.get_reports_for_incident", lambda: incidents.get_reports_for_incident(1)),
+        ("ReportRepository.list_reports", lambda: reports.list_reports()),
+        ("ReportRepository.list_reports(location_id)", lambda: reports.list_reports(location_id=1)),
+        ("ReportRepository.list_reports(type_id)", lambda: reports.list_reports(type_id=1)),
+        ("ReportRepository.iter_reports", lambda: list(reports.iter_reports(limit=10))),
+        ("ReportRepository.iter_reports(after_id)", lambda: list(reports.iter_reports(after_id=2, limit=10))),
+        ("ReportRepository.get_recent_user_ids", lambda: reports.get_recent_user_ids()),
+        ("ReportRepository.list_recent_reports", lambda: reports.list_recent_reports()),
+
+        ("IncidentStatsRepository.delete_stats", lambda: stats.delete_stats(1)),
+        ("IncidentRepository.delete_incident", lambda: incidents.delete_incident(1)),
+        ("UserRepository.delete_user", lambda: users.delete_user(1)),
+    ]
+
+
+def check() -> List[Tuple[str, str, str]]:
+
+    """
+    Run every repository method and return the (method, query, plan detail)
+    of each statement that is not served by an index.
+    """
+
+    db: Database = Database(":memory:")
+    migrate(db, background=False)
+    db.fill_types()
+
+    executed: List[Tuple[str, Tuple]] = []
+    execute: Callable[..., Any] = db.execute
+
+    def recording_execute(query: str, params: Tuple = ()) -> Any:
+        executed.append((query, params))
+        return execute(query, params)
+
+    db.execute = recording_execute  # type: ignore[method-assign]
+
+    failures: List[Tuple[str, str, str]] = []
+    for name, call in _calls(db):
+
+        # cached lookups would not reach the database at all
+        db._clear_caches()
+        executed.clear()
+        call()
+
+        if name in ALLOWED_SCANS:
+            continue
+        for query, params in executed:
+            for detail in _plan_problems(db, query, params):
+                failures.append((name, " ".join(query.split()), detail))
+
+    db.close()
+    return failures
+
+
+if __name__ == "__main__":
+
+    failures: List[Tuple[str, str, str]] = check()
+    for name, query, detail in failures:
+        print(f"[ERROR] {name}: {detail}\n        {query}")
+
+    if failures:
+        print(f"[ERROR] {len(failures)} statement(s) not served by an index.")
+        sys.exit(1)
+    print("[INFO] Every repository query is served by an index.")
@@ -1,7 +1,13 @@
 
 import sqlite3
-from typing import List, Tuple
+import time
+import os
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Set, Tuple
 from enum import Enum
+from .cache import LRUCache
+from .spatial import LocationIndex
+from .stats import CountingCursor, QueryStats, query_stats
 
 
 class Table(Enum):
@@ -64,6 +70,21 @@ class Table(Enum):
         );
     """
 
+    # running aggregates of an incident, updated in O(1) per report
+    # delay_sum holds the planned end (epoch minutes) of every report with a delay
+    INCIDENT_STATS: str = """
+        CREATE TABLE IF NOT EXISTS incident_stats (
+            incident_id INTEGER PRIMARY KEY,
+            report_count INTEGER NOT NULL DEFAULT 0,
+            delay_sum REAL NOT NULL DEFAULT 0.0,
+            delay_count INTEGER NOT NULL DEFAULT 0,
+            weight_sum REAL NOT NULL DEFAULT 0.0,
+            weight_max REAL NOT NULL DEFAULT 0.0,
+            type_counts TEXT NOT NULL DEFAULT '{}',
+            FOREIGN KEY (incident_id) REFERENCES incidents(id) ON DELETE CASCADE
+        );
+    """
+
     @staticmethod
     def list() -> List[str]:
         return [table.value for table in Table]
@@ -95,67 +116,236 @@ class Status(Enum):
 
 class Database:
 
-    _INDEXES: List[str] = [
-        "CREATE INDEX IF NOT EXISTS idx_reports_location ON reports(location_id);",
-        "CREATE INDEX IF NOT EXISTS idx_reports_type ON reports(type_id);",
-        "CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at);",
-        "CREATE INDEX IF NOT EXISTS idx_incidents_location ON incidents(location_id);",
-        "CREATE INDEX IF NOT EXISTS idx_incidents_type ON incidents(type_id);",
-        "CREATE INDEX IF NOT EXISTS idx_incidents_last_updated ON incidents(last_updated);"
-    ]
+    def __init__(self, fp: str, read_only: bool = False, stats: Optional[QueryStats] = None) -> None:
 
-    def __init__(self, fp: str) -> None:
+        """
+        Initialize the database connection and enable foreign key support. \n
+        The schema is not touched here, call `db.migrations.migrate()` once at
+        startup. A `read_only` connection refuses writes and never changes the
+        journal mode. \n
+        Statements are counted in `stats`, by default the process-wide stats
+        enabled by `DB_STATS` (see `db.stats`), otherwise not at all.
+        """
+
+        self.fp: str = fp
+        self.read_only: bool = read_only
+        self.stats: Optional[QueryStats] = stats or query_stats()
+        if read_only: self.conn: sqlite3.Connection = sqlite3.connect(f"file:{fp}?mode=ro", uri=True)
+        else: self.conn: sqlite3.Connection = sqlite3.connect(fp)
 
-        """Initialize the database connection and enable foreign key support."""
+        # several workers may write concurrently, wait for the lock instead of failing
+        self.conn.execute(f"PRAGMA busy_timeout = {int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))};")
 
-        self.conn: sqlite3.Connection = sqlite3.connect(fp)
         self.cursor: sqlite3.Cursor = self.conn.cursor()
+        self._depth: int = 0
+
+        # tables written since the last commit, handed to the commit hooks
+        self._changed: Set[str] = set()
+        self._commit_hooks: List[Callable[[Set[str]], None]] = []
+
+        # row caches shared by every repository using this connection
+        self._caches: Dict[str, LRUCache] = {}
+        self._data_version: Optional[int] = None
+        self._location_index: Optional[LocationIndex] = None
         self.execute("PRAGMA foreign_keys = ON;")
-        self.execute("PRAGMA journal_mode = WAL;")
+        if not read_only:
+            self.execute("PRAGMA journal_mode = WAL;")
 
-        self._init_tables()
-        self._create_indexes()
+    def fill_types(self) -> int:
 
-    def _init_tables(self) -> None:
+        """
+        Insert the defined report types that are missing, in a single statement.
+        Returns the number of types added.
+        """
 
-        """Initialize all tables in the database."""
+        types: List[str] = ReportType.list()
+        cur: sqlite3.Cursor = self.execute(
+            query=f"INSERT OR IGNORE INTO report_types (name) VALUES {', '.join(['(?)'] * len(types))}",
+            params=tuple(types)
+        )
+        return cur.rowcount
 
-        for t in Table.list():
-            self.execute(query=t)
+    def close(self) -> None:
+        """Close the database connection."""
+        self.conn.close()
 
-    def _create_indexes(self) -> None:
+    @contextmanager
+    def transaction(self) -> Iterator['Database']:
 
-        """Create necessary indexes for performance optimization."""
+        """
+        Group every statement executed inside the block into a single
+        transaction, committed on exit and rolled back on error. \n
+        Nested calls open a savepoint instead, so an inner block can fail and
+        roll back on its own without aborting the outer transaction.
+        """
 
-        for idx in self._INDEXES:
-            self.execute(idx)
+        depth: int = self._depth
+        savepoint: str = f"sp_{depth}"
+
+        if depth == 0:
+            # take the write lock up front: a deferred transaction that reads
+            # then writes can deadlock against another worker doing the same
+            self.conn.execute("BEGIN" if self.read_only else "BEGIN IMMEDIATE")
+            self._check_data_version()
+            if self._location_index is not None:
+                self._location_index.checkpoint()
+        else:
+            self.conn.execute(f"SAVEPOINT {savepoint}")
+        self._depth += 1
+
+        try:
+            yield self
+        except BaseException:
+            self._depth = depth
+            self._clear_caches()
+            if depth == 0:
+                self.conn.rollback()
+                self._changed.clear()
+            else:
+                self.conn.execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+                self.conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+            raise
+
+        self._depth = depth
+        if depth == 0:
+            try:
+                self._commit()
+            except BaseException:
+                # a failed COMMIT (busy, I/O error) leaves the transaction open
+                self._clear_caches()
+                self._changed.clear()
+                self.conn.rollback()
+                raise
+            self._notify_commit()
+        else:
+            self.conn.execute(f"RELEASE SAVEPOINT {savepoint}")
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether a `transaction()` block is currently open."""
+        return self._depth > 0
+
+    def cache(self, name: str, maxsize: int = 1024, ttl: Optional[float] = None, volatile: bool = False) -> LRUCache:
 
-    def fill_types(self) -> None:
+        """
+        Return the row cache called `name`, creating it on first use. \n
+        Every cache is dropped when a transaction rolls back, `volatile` ones
+        also whenever another connection commits.
+        """
 
-        """Fill the report_types table with defined types."""
+        if name not in self._caches:
+            self._caches[name] = LRUCache(maxsize=maxsize, ttl=ttl, volatile=volatile)
+        return self._caches[name]
 
-        for t in ReportType.list():
-            try:
-                self.execute(
-                    query="INSERT INTO report_types (name) VALUES (?)",
-                    params=(t,)
-                )
-            except sqlite3.IntegrityError as e:
-                print(f'Type "{t}" already exists. Skipping... ({e}).')
+    def location_index(self, refresh: bool = True) -> LocationIndex:
 
-    def close(self) -> None:
-        """Close the database connection."""
-        self.conn.close()
+        """
+        Return the spatial index over locations, built on first use. With
+        `refresh`, locations inserted since the last call (by any connection)
+        are indexed first.
+        """
+
+        if self._location_index is None:
+            self._location_index = LocationIndex()
+            refresh = True
+        if refresh:
+            self._location_index.refresh(self)
+        return self._location_index
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss counters of every cache, by name."""
+        return {name: c.stats() for name, c in self._caches.items()}
+
+    def invalidate(self, name: str, key: Hashable) -> None:
+        """Drop `key` from the cache called `name`, if that cache exists."""
+        if name in self._caches:
+            self._caches[name].pop(key)
+
+    def _clear_caches(self, volatile_only: bool = False) -> None:
+
+        """
+        Drop cached rows that may no longer match the database. The location
+        index only forgets the locations of the current transaction.
+        """
+
+        for c in self._caches.values():
+            if c.volatile or not volatile_only:
+                c.clear()
+        if not volatile_only and self._location_index is not None:
+            self._location_index.rollback()
+
+    def _check_data_version(self) -> None:
+
+        """Drop volatile caches if another connection committed since last time."""
+
+        version: int = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and version != self._data_version:
+            self._clear_caches(volatile_only=True)
+        self._data_version = version
+
+    def add_commit_hook(self, hook: Callable[[Set[str]], None]) -> None:
+
+        """
+        Register a callback run after every commit that changed data. \n
+        The hook receives the names of the tables marked with `mark_changed()`.
+        """
+
+        self._commit_hooks.append(hook)
+
+    def mark_changed(self, table: str) -> None:
+
+        """Record that `table` was written by the current transaction."""
+
+        self._changed.add(table)
+        if not self.in_transaction:
+            self._notify_commit()
+
+    def _notify_commit(self) -> None:
+
+        """Hand the changed tables to the commit hooks, errors are only logged."""
+
+        if not self._changed:
+            return
+
+        changed: Set[str] = self._changed
+        self._changed = set()
+        for hook in self._commit_hooks:
+            try:
+                hook(changed)
+            except Exception as e:
+                print(f"[ERROR] Commit hook failed: {e}")
 
     def execute(self, query: str, params: Tuple = ()) -> sqlite3.Cursor:
 
         """
         Execute a query with optional parameters. Returns the cursor. \n
+        Commits right away unless called inside `transaction()`. \n
         Raises `sqlite3.Error` exceptions on error.
         """
 
-        cur: sqlite3.Cursor = self.conn.cursor()
-        cur.execute(query, params)
-        self.conn.commit()
+        if self.stats is None:
+            cur: sqlite3.Cursor = self.conn.cursor()
+            cur.execute(query, params)
+        else:
+            cur: CountingCursor = self.conn.cursor(CountingCursor)
+            started_at: float = time.perf_counter()
+            cur.execute(query, params)
+            cur.stats = self.stats
+            cur.key = self.stats.record(query, time.perf_counter() - started_at, max(cur.rowcount, 0))
+
+        if not self.in_transaction:
+            self._commit()
         return cur
 
+    def _commit(self) -> None:
+
+        """Commit the connection, timed as a `COMMIT` statement when instrumented."""
+
+        if self.stats is None:
+            self.conn.commit()
+            return
+
+        started_at: float = time.perf_counter()
+        self.conn.commit()
+        self.stats.record("COMMIT", time.perf_counter() - started_at)
+
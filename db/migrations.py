@@ -0,0 +1,171 @@
+
+from .db import Database, Table
+from dataclasses import dataclass
+from multiprocessing import Process
+from typing import List
+import time
+
+
+@dataclass(frozen=True)
+class Migration:
+
+    """
+    One schema step, taking the database from `version - 1` to `version`. \n
+    An `online` step only builds (or drops) indexes: it runs in the background
+    so the workers can start right away, one statement per transaction. Each
+    index build still holds SQLite's write lock until it is done.
+    """
+
+    version: int
+    name: str
+    statements: List[str]
+    online: bool = False
+
+
+# Ordered schema history, the applied version is stored in PRAGMA user_version.
+# Append new steps, never edit an applied one.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline tables", [
+        Table.REPORT_TYPE.value,
+        Table.LOCATION.value,
+        Table.USER.value,
+        Table.REPORT.value,
+        Table.INCIDENT.value,
+        "CREATE INDEX IF NOT EXISTS idx_reports_location ON reports(location_id);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_type ON reports(type_id);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports(created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_location ON incidents(location_id);",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_type ON incidents(type_id);",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_last_updated ON incidents(last_updated);",
+    ]),
+    Migration(2, "incident aggregates", [
+        Table.INCIDENT_STATS.value,
+    ]),
+    # composite indexes matching the query shapes (see db/check_indexes.py),
+    # replacing the single-column indexes they start with. The worker only
+    # looks up the active incident of a location, so that index is partial;
+    # idx_incidents_location stays for the API's listings of any status.
+    Migration(3, "composite indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_reports_location_created ON reports(location_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_type_created ON reports(type_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_incident ON reports(incident_id, created_at);",
+        "CREATE INDEX IF NOT EXISTS idx_reports_user ON reports(user_id);",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_location_active ON incidents(location_id, last_updated) WHERE status = 'active';",
+        "CREATE INDEX IF NOT EXISTS idx_incidents_status_updated ON incidents(status, last_updated);",
+        "CREATE INDEX IF NOT EXISTS idx_locations_name ON locations(name);",
+        "DROP INDEX IF EXISTS idx_reports_location;",
+        "DROP INDEX IF EXISTS idx_reports_type;",
+    ], online=True),
+]
+
+LATEST_VERSION: int = MIGRATIONS[-1].version
+
+
+def schema_version(db: Database) -> int:
+    """Version of the schema applied to the database (0 for a new one)."""
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def migrate(db: Database, background: bool = True) -> int:
+
+    """
+    Bring the schema up to `LATEST_VERSION`. Returns the version reached before
+    returning, which is all the caller can rely on. \n
+    An up-to-date database costs a single `PRAGMA user_version` read. Pending
+    steps are applied in order, each in its own transaction along with its
+    version bump. From the first `online` step on, the remaining steps run in a
+    background process on their own connection, unless `background` is False
+    (or the database is in memory).
+    """
+
+    version: int = schema_version(db)
+    if version >= LATEST_VERSION:
+        return version
+
+    background = background and db.fp != ":memory:"
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if migration.online and background:
+            _start_online(db.fp, migration.version)
+            return version
+        version = _apply(db, migration)
+
+    # planner statistics of the tables whose indexes changed
+    db.execute("PRAGMA optimize;")
+    return version
+
+
+def _apply(db: Database, migration: Migration) -> int:
+
+    """Run a step in a single transaction, unless another process already did."""
+
+    with db.transaction():
+        # re-read under the write lock, several processes may start at once
+        current: int = schema_version(db)
+        if current >= migration.version:
+            return current
+
+        started_at: float = time.monotonic()
+        for statement in migration.statements:
+            db.execute(statement)
+        db.execute(f"PRAGMA user_version = {migration.version};")
+
+    print(f"[INFO] Schema migrated to v{migration.version} ({migration.name}) "
+          f"in {(time.monotonic() - started_at) * 1000:.1f} ms.")
+    return migration.version
+
+
+def _apply_online(db: Database, migration: Migration) -> int:
+
+    """
+    Run an index step one statement per transaction. This does not make the
+    step non-blocking: SQLite holds the write lock for the whole build of an
+    index, so the workers' writes wait for it, and fail with "database is
+    locked" past `DB_BUSY_TIMEOUT_MS` (the worker then retries its batch).
+    One index per transaction only bounds each wait to a single build. The
+    version is bumped once every statement went through (they are all
+    idempotent).
+    """
+
+    started_at: float = time.monotonic()
+    for statement in migration.statements:
+        with db.transaction():
+            db.execute(statement)
+
+    with db.transaction():
+        if schema_version(db) < migration.version:
+            db.execute(f"PRAGMA user_version = {migration.version};")
+
+    print(f"[INFO] Schema migrated to v{migration.version} ({migration.name}, in the background) "
+          f"in {(time.monotonic() - started_at) * 1000:.1f} ms.")
+    return migration.version
+
+
+def _start_online(fp: str, from_version: int) -> Process:
+
+    """Apply the steps from `from_version` on in a background process."""
+
+    print(f"[INFO] Building schema v{from_version}..v{LATEST_VERSION} in the background.")
+    builder: Process = Process(target=_run_online, args=(fp, from_version), name="schema-migrations", daemon=True)
+    builder.start()
+    return builder
+
+
+def _run_online(fp: str, from_version: int) -> None:
+
+    """Background process entry point, an interrupted build is resumed on the next start."""
+
+    db: Database = Database(fp)
+    try:
+        for migration in MIGRATIONS:
+            if migration.version < from_version or migration.version <= schema_version(db):
+                continue
+            if migration.online: _apply_online(db, migration)
+            else: _apply(db, migration)
+        db.execute("PRAGMA optimize;")
+    except Exception as e:
+        print(f"[ERROR] Background schema migration failed: {e}")
+    finally:
+        db.close()
+
@@ -0,0 +1,59 @@
+
+from .db import Database
+from typing import Dict, List
+import threading
+
+
+class ConnectionPool:
+
+    """
+    Hands out one long-lived `Database` per thread. \n
+    Connections are opened lazily on first use and reused by every later call
+    from the same thread, so request handlers no longer pay for opening a
+    connection (sqlite3 connections cannot be shared between threads).
+    """
+
+    def __init__(self, fp: str, read_only: bool = True) -> None:
+
+        """Initialize the pool for the database at `fp`."""
+
+        self.fp: str = fp
+        self.read_only: bool = read_only
+        self._local: threading.local = threading.local()
+        self._lock: threading.Lock = threading.Lock()
+        self._opened: List[Database] = []
+
+    def get(self) -> Database:
+
+        """Return the connection owned by the calling thread, opening it if needed."""
+
+        db: Database = getattr(self._local, "db", None)
+        if db is None:
+            db = Database(self.fp, read_only=self.read_only)
+            self._local.db = db
+            with self._lock:
+                self._opened.append(db)
+        return db
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+
+        """Hit/miss counters of every cache, summed over the pool's connections."""
+
+        totals: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for db in self._opened:
+                for name, counters in db.cache_stats().items():
+                    total: Dict[str, int] = totals.setdefault(name, dict.fromkeys(counters, 0))
+                    for k, v in counters.items():
+                        total[k] += v
+        return totals
+
+    def close(self) -> None:
+
+        """Close every connection opened by the pool."""
+
+        with self._lock:
+            for db in self._opened:
+                db.close()
+            self._opened.clear()
+        self._local = threading.local()
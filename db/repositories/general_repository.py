@@ -1,6 +1,7 @@
 
 from ..db import Database, ReportType
-from typing import Optional, Tuple
+from ..cache import LRUCache, REFERENCE_MAXSIZE, REFERENCE_TTL
+from typing import List, Optional, Tuple
 import sqlite3
 
 
@@ -8,9 +9,16 @@ class GeneralRepository:
 
     def __init__(self, db: Database) -> None:
         self.db = db
+        self.type_ids: LRUCache = db.cache("type_ids", maxsize=REFERENCE_MAXSIZE, ttl=REFERENCE_TTL)
+        self.location_ids: LRUCache = db.cache("location_ids", maxsize=REFERENCE_MAXSIZE, ttl=REFERENCE_TTL)
 
     def get_type_id(self, report_type: ReportType) -> Optional[int]:
-        """Get the ID of a report type by its name. Returns None if not found."""
+        """Get the ID of a report type by its name (cached). Returns None if not found."""
+        return self.type_ids.get_or_load(report_type.value, lambda: self._fetch_type_id(report_type))
+
+    def _fetch_type_id(self, report_type: ReportType) -> Optional[int]:
+
+        """Query the ID of a report type by its name."""
 
         cur: sqlite3.Cursor = self.db.execute(
             query="SELECT id FROM report_types WHERE name = ?",
@@ -21,7 +29,13 @@ class GeneralRepository:
     
     def get_location_id(self, location_name: str) -> Optional[int]:
 
-        """Get the ID of a location by its name. Returns None if not found."""
+        """Get the ID of a location by its name (cached). Returns None if not found."""
+
+        return self.location_ids.get_or_load(location_name, lambda: self._fetch_location_id(location_name))
+
+    def _fetch_location_id(self, location_name: str) -> Optional[int]:
+
+        """Query the ID of a location by its name."""
         
         cur: sqlite3.Cursor = self.db.execute(
             query="SELECT id FROM locations WHERE name = ?",
@@ -55,7 +69,27 @@ class GeneralRepository:
             query="INSERT INTO locations (name, coords_lat, coords_lon) VALUES (?, ?, ?)",
             params=(location_name, pos[0], pos[1]),
         )
+        self.location_ids.put(location_name, cur.lastrowid)
+        self.db.location_index()  # picks up the new row, and any added by other workers
         return cur.lastrowid
+
+    def get_nearest_location(self, pos: Tuple[float, float], max_km: Optional[float] = None) -> Optional[Tuple[int, float]]:
+
+        """
+        Get the location closest to `pos` as (location ID, distance in km),
+        using the spatial index. Returns None if there is none within `max_km`.
+        """
+
+        found: List[Tuple[int, float]] = self.db.location_index().nearest(pos, k=1)
+        if not found or (max_km is not None and found[0][1] > max_km):
+            return None
+        return found[0]
+
+    def get_locations_within(self, pos: Tuple[float, float], radius_km: float) -> List[Tuple[int, float]]:
+
+        """Get every location within `radius_km` of `pos` as (location ID, distance in km), closest first."""
+
+        return self.db.location_index().within(pos, radius_km)
     
     def list_locations(self) -> list:
 
@@ -1,12 +1,15 @@
 
 from ..db import Database, Status
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 import sqlite3
 import datetime
 
 
 class IncidentRepository:
 
+    CHUNK_SIZE: int = 500
+    FETCH_SIZE: int = 500
+
     def __init__(self, db: Database) -> None:
         """Initialize the IncidentRepository with a Database instance."""
         self.db: Database = db
@@ -32,6 +35,7 @@ class IncidentRepository:
             """,
             params=(location_id, type_id, avg_delay, trust_score, status),
         )
+        self.db.mark_changed("incidents")
         return cur.lastrowid
 
     def get_incident(self, incident_id: int) -> Optional[Dict[str, Any]]:
@@ -91,6 +95,7 @@ class IncidentRepository:
             query="DELETE FROM incidents WHERE id = ?",
             params=(incident_id,),
         )
+        self.db.mark_changed("incidents")
 
     def list_incidents(
         self,
@@ -139,6 +144,146 @@ class IncidentRepository:
             for r in rows
         ]
 
+    _DETAILED_QUERY: str = """
+        SELECT i.id, i.location_id, i.type_id, i.avg_delay, i.trust_score, i.status,
+               i.created_at, i.last_updated,
+               l.name, l.coords_lat, l.coords_lon, t.name
+        FROM incidents i
+        LEFT JOIN locations l ON l.id = i.location_id
+        LEFT JOIN report_types t ON t.id = i.type_id
+    """
+
+    @staticmethod
+    def _detailed_row(r: Tuple) -> Dict[str, Any]:
+
+        """Map a row of `_DETAILED_QUERY` to an incident dict."""
+
+        return {
+            "id": r[0],
+            "location_id": r[1],
+            "type_id": r[2],
+            "avg_delay": r[3],
+            "trust_score": r[4],
+            "status": r[5],
+            "created_at": r[6],
+            "last_updated": r[7],
+            "location_name": r[8] if r[8] is not None else 'Unknown',
+            "coords": (r[9], r[10]),
+            "type_name": r[11]
+        }
+
+    def list_incidents_detailed(
+        self,
+        location_id: Optional[int] = None,
+        type_id: Optional[int] = None,
+        status: Optional[str] = None,
+        location_ids: Optional[Sequence[int]] = None
+    ) -> List[Dict[str, Any]]:
+
+        """
+        Same as `list_incidents`, but each incident also carries its location
+        name, coordinates and type name, fetched in one joined query. \n
+        `location_ids` restricts the incidents to a set of locations (e.g. the
+        result of a spatial query), looked up in chunks of `CHUNK_SIZE`.
+        """
+
+        query: str = self._DETAILED_QUERY
+        filters: List[str] = []
+        params: Tuple = ()
+
+        if location_id is not None:
+            filters.append("i.location_id = ?")
+            params += (location_id,)
+        if type_id is not None:
+            filters.append("i.type_id = ?")
+            params += (type_id,)
+        if status is not None:
+            # unary + keeps the planner on the location index when ids are given
+            filters.append("i.status = ?" if location_ids is None else "+i.status = ?")
+            params += (status,)
+
+        if location_ids is None:
+            if filters:
+                query += " WHERE " + " AND ".join(filters)
+            query += " ORDER BY i.last_updated DESC"
+            cur: sqlite3.Cursor = self.db.execute(query=query, params=params)
+            return [self._detailed_row(r) for r in cur.fetchall()]
+
+        ids: List[int] = list(dict.fromkeys(location_ids))
+        rows: List[Tuple] = []
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            chunk: List[int] = ids[i:i + self.CHUNK_SIZE]
+            where: List[str] = filters + [f"i.location_id IN ({','.join('?' * len(chunk))})"]
+            cur: sqlite3.Cursor = self.db.execute(
+                query=query + " WHERE " + " AND ".join(where),
+                params=params + tuple(chunk),
+            )
+            rows += cur.fetchall()
+
+        incidents: List[Dict[str, Any]] = [self._detailed_row(r) for r in rows]
+        incidents.sort(key=lambda x: x['last_updated'] or '', reverse=True)
+        return incidents
+
+    def iter_incidents_detailed(
+        self,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        location_id: Optional[int] = None,
+        type_id: Optional[int] = None,
+        status: Optional[str] = None
+    ) -> Iterator[Dict[str, Any]]:
+
+        """
+        Iterate over detailed incidents (see `list_incidents_detailed`), newest
+        (highest ID) first. \n
+        Keyset pagination: only incidents with an ID below `after_id` are read,
+        up to `limit` of them. Rows are fetched `FETCH_SIZE` at a time so memory
+        stays flat however many incidents are iterated.
+        """
+
+        query: str = self._DETAILED_QUERY
+        filters: List[str] = []
+        params: Tuple = ()
+
+        if after_id is not None:
+            filters.append("i.id < ?")
+            params += (after_id,)
+        if location_id is not None:
+            filters.append("i.location_id = ?")
+            params += (location_id,)
+        if type_id is not None:
+            filters.append("i.type_id = ?")
+            params += (type_id,)
+        if status is not None:
+            filters.append("i.status = ?")
+            params += (status,)
+
+        if filters:
+            query += " WHERE " + " AND ".join(filters)
+
+        query += " ORDER BY i.id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+
+        cur: sqlite3.Cursor = self.db.execute(query=query, params=params)
+        while rows := cur.fetchmany(self.FETCH_SIZE):
+            for r in rows:
+                yield self._detailed_row(r)
+
+    def get_incidents_since_detailed(self, timestamp: datetime.datetime) -> List[Dict[str, Any]]:
+
+        """
+        Same as `get_incidents_since`, joined with the location name,
+        coordinates and type name.
+        """
+
+        cur: sqlite3.Cursor = self.db.execute(
+            query=self._DETAILED_QUERY + " WHERE i.last_updated >= ?",
+            params=(timestamp,),
+        )
+        return [self._detailed_row(r) for r in cur.fetchall()]
+
     def get_reports_for_incident(self, incident_id: int) -> List[Dict[str, Any]]:
         
         """Retrieve all reports linked to a given incident."""
@@ -165,6 +310,20 @@ class IncidentRepository:
             for r in rows
         ]
 
+    def list_active_locations(self) -> List[Tuple[int, str]]:
+
+        """(location ID, name) of every location with an active incident."""
+
+        cur: sqlite3.Cursor = self.db.execute(
+            query="""
+                SELECT i.location_id, l.name
+                FROM incidents i JOIN locations l ON l.id = i.location_id
+                WHERE i.status = 'active'
+                GROUP BY i.location_id
+            """,
+        )
+        return cur.fetchall()
+
     def get_incident_by_location(self, lid: int) -> Optional[Dict[str, Any]]:
         """Get the most recent active incident by location ID."""
         cur: sqlite3.Cursor = self.db.execute(
@@ -206,6 +365,7 @@ class IncidentRepository:
             """,
             params=(new_score, incident_id),
         )
+        self.db.mark_changed("incidents")
 
     def update_avg_delay(self, incident_id: int, new_delay: float) -> None:
 
@@ -223,6 +383,7 @@ class IncidentRepository:
             """,
             params=(new_delay, incident_id),
         )
+        self.db.mark_changed("incidents")
 
     def update_last_updated(self, incident_id: int) -> None:
 
@@ -236,12 +397,13 @@ class IncidentRepository:
             """,
             params=(incident_id,),
         )
+        self.db.mark_changed("incidents")
 
     def update_status(self, incident_id: int, new_status: Status) -> None:
 
         """Update the status of an incident."""
 
-        if new_status not in Status.list():
+        if not isinstance(new_status, Status):
             raise ValueError(f"[CRITICAL] Invalid status: {new_status}")
 
         self.db.execute(
@@ -252,16 +414,72 @@ class IncidentRepository:
             """,
             params=(new_status.value, incident_id),
         )
+        self.db.mark_changed("incidents")
     
-    def update_status_for_old_incidents(self):
-        """Set Status to 'RESOLVED' if last_updated is older than created_at + avg_delay + 5 minutes."""
+    def update_status_for_old_incidents(
+        self,
+        grace_minutes: float = 5,
+        limit: int = 500,
+        default_ttl_minutes: Optional[float] = 60
+    ) -> int:
+
+        """
+        Resolve up to `limit` active incidents that outlived their delay: not
+        updated since `avg_delay` (the remaining delay when last updated) plus
+        `grace_minutes`. An incident without a delay lives `default_ttl_minutes`
+        instead, or stays active if it is None. Returns the number of incidents
+        resolved. \n
+        Only the active incidents older than the grace period are scanned,
+        through the `(status, last_updated)` index.
+        """
+
+        # MAX() is NULL for a NULL avg_delay, so delay-less incidents get the TTL
+        cur: sqlite3.Cursor = self.db.execute(
+            query="""
+                UPDATE incidents
+                SET status = ?
+                WHERE id IN (
+                    SELECT id FROM incidents
+                    WHERE status = 'active'
+                      AND last_updated < datetime('now', 'utc', ?)
+                      AND julianday(last_updated) + (COALESCE(MAX(avg_delay, 0), ?) + ?) / 1440.0
+                          < julianday(datetime('now', 'utc'))
+                    LIMIT ?
+                )
+            """,
+            params=(Status.RESOLVED.value, f"-{grace_minutes} minutes", default_ttl_minutes, grace_minutes, limit),
+        )
+        if cur.rowcount > 0:
+            self.db.mark_changed("incidents")
+        return cur.rowcount
+
+    def update_aggregates(
+        self,
+        incident_id: int,
+        type_id: int,
+        avg_delay: Optional[float],
+        trust_score: float
+    ) -> None:
+
+        """
+        Update the type, average delay and trust score of an incident and
+        bump its last_updated timestamp, all in a single statement.
+        """
+
+        if 0 > trust_score or 1 < trust_score:
+            raise ValueError(f"[CRITICAL] Trust score must be between 0.0 and 1.0 (got {trust_score})")
+        if avg_delay is not None and avg_delay < 0:
+            raise ValueError("[CRITICAL] Average delay cannot be negative")
+
         self.db.execute(
-           query="""
-               UPDATE incidents
-               SET status = 'RESOLVED'
-               WHERE last_updated < created_at + INTERVAL avg_delay + 5 MINUTE
-           """,
-       )
+            query="""
+                UPDATE incidents
+                SET type_id = ?, avg_delay = ?, trust_score = ?, last_updated = datetime('now', 'utc')
+                WHERE id = ?
+            """,
+            params=(type_id, avg_delay, trust_score, incident_id),
+        )
+        self.db.mark_changed("incidents")
 
     def update_incident_type(self, incident_id: int, nit: int) -> None:
 
@@ -275,4 +493,5 @@ class IncidentRepository:
             """,
             params=(nit, incident_id),
         )
+        self.db.mark_changed("incidents")
 
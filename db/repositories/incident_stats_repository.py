@@ -0,0 +1,77 @@
+
+from ..db import Database
+from typing import Any, Dict, Optional
+import sqlite3
+import json
+
+
+class IncidentStatsRepository:
+
+    def __init__(self, db: Database) -> None:
+        """Initialize the IncidentStatsRepository with a Database instance."""
+        self.db: Database = db
+
+    def get_stats(self, incident_id: int) -> Optional[Dict[str, Any]]:
+
+        """
+        Retrieve the running aggregates of an incident. Returns None if the
+        incident has none yet. `type_counts` maps type_id -> [count, last_report_id].
+        """
+
+        cur: sqlite3.Cursor = self.db.execute(
+            query="""
+                SELECT incident_id, report_count, delay_sum, delay_count, weight_sum, weight_max, type_counts
+                FROM incident_stats WHERE incident_id = ?
+            """,
+            params=(incident_id,),
+        )
+
+        row = cur.fetchone()
+        if row:
+            return {
+                "incident_id": row[0],
+                "report_count": row[1],
+                "delay_sum": row[2],
+                "delay_count": row[3],
+                "weight_sum": row[4],
+                "weight_max": row[5],
+                "type_counts": {int(k): v for k, v in json.loads(row[6]).items()}
+            }
+        return None
+
+    def save_stats(self, stats: Dict[str, Any]) -> None:
+
+        """Insert or overwrite the running aggregates of an incident."""
+
+        self.db.execute(
+            query="""
+                INSERT INTO incident_stats
+                    (incident_id, report_count, delay_sum, delay_count, weight_sum, weight_max, type_counts)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(incident_id) DO UPDATE SET
+                    report_count = excluded.report_count,
+                    delay_sum = excluded.delay_sum,
+                    delay_count = excluded.delay_count,
+                    weight_sum = excluded.weight_sum,
+                    weight_max = excluded.weight_max,
+                    type_counts = excluded.type_counts
+            """,
+            params=(
+                stats["incident_id"],
+                stats["report_count"],
+                stats["delay_sum"],
+                stats["delay_count"],
+                stats["weight_sum"],
+                stats["weight_max"],
+                json.dumps(stats["type_counts"])
+            ),
+        )
+
+    def delete_stats(self, incident_id: int) -> None:
+
+        """Drop the running aggregates of an incident, forcing a full recompute."""
+
+        self.db.execute(
+            query="DELETE FROM incident_stats WHERE incident_id = ?",
+            params=(incident_id,),
+        )
@@ -1,11 +1,13 @@
 
 from ..db import Database
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 import sqlite3
 
 
 class ReportRepository:
 
+    FETCH_SIZE: int = 500
+
     def __init__(self, db: Database) -> None:
         """Initialize the ReportRepository with a Database instance."""
         self.db: Database = db
@@ -42,6 +44,7 @@ class ReportRepository:
                 query="UPDATE users SET reports_made = ? WHERE id = ?",
                 params=(new_count, user_id),
             )
+            self.db.invalidate("users", user_id)
 
         return cur.lastrowid
 
@@ -115,6 +118,86 @@ class ReportRepository:
             for r in rows
         ]
 
+    @staticmethod
+    def _row(r: Tuple) -> Dict[str, Any]:
+
+        """Map a `reports` row to a report dict."""
+
+        return {
+            "id": r[0],
+            "user_id": r[1],
+            "location_id": r[2],
+            "type_id": r[3],
+            "delay_minutes": r[4],
+            "created_at": r[5]
+        }
+
+    def iter_reports(
+        self,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        location_id: Optional[int] = None,
+        type_id: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+
+        """
+        Iterate over reports, newest (highest ID) first, optionally filtered
+        by location or type. \n
+        Keyset pagination: only reports with an ID below `after_id` are read,
+        up to `limit` of them. Rows are fetched `FETCH_SIZE` at a time so memory
+        stays flat however many reports are iterated.
+        """
+
+        query: str = """
+            SELECT id, user_id, location_id, type_id, delay_minutes, created_at
+            FROM reports
+        """
+        params: Tuple = ()
+        filters: List[str] = []
+
+        if after_id is not None:
+            filters.append("id < ?")
+            params += (after_id,)
+        if location_id is not None:
+            filters.append("location_id = ?")
+            params += (location_id,)
+        if type_id is not None:
+            filters.append("type_id = ?")
+            params += (type_id,)
+
+        if filters:
+            query += " WHERE " + " AND ".join(filters)
+
+        query += " ORDER BY id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+
+        cur: sqlite3.Cursor = self.db.execute(query, params)
+        while rows := cur.fetchmany(self.FETCH_SIZE):
+            for r in rows:
+                yield self._row(r)
+
+    def get_recent_user_ids(self, hours: float = 24, limit: int = 1000) -> List[int]:
+
+        """IDs of up to `limit` users who reported in the last `hours`, most recent first."""
+
+        cur: sqlite3.Cursor = self.db.execute(
+            query="""
+                SELECT user_id FROM reports
+                WHERE created_at >= datetime('now', 'utc', ?)
+                ORDER BY created_at DESC
+            """,
+            params=(f"-{hours} hours",),
+        )
+
+        # deduplicated here, DISTINCT would need a temporary b-tree over the range
+        uids: Dict[int, None] = {}
+        while len(uids) < limit and (rows := cur.fetchmany(self.FETCH_SIZE)):
+            for (uid,) in rows:
+                uids.setdefault(uid)
+        return list(uids)[:limit]
+
     def list_recent_reports(self, limit: int = 50) -> List[Dict[str, Any]]:
 
         """Get the most recent reports."""
@@ -1,14 +1,34 @@
 
 from ..db import Database
-from typing import Any, Dict, Optional, List
+from ..cache import LRUCache, REFERENCE_MAXSIZE, REFERENCE_TTL
+from typing import Any, Dict, Iterable, Optional, List
 import sqlite3
 
 
 class UserRepository:
 
+    # max number of bound parameters per IN (...) query
+    CHUNK_SIZE: int = 500
+
     def __init__(self, db: Database) -> None:
         """Initialize the UserRepository with a Database instance."""
         self.db: Database = db
+        self.rows: LRUCache = db.cache("users", maxsize=4096, volatile=True)
+        self.ids: LRUCache = db.cache("user_ids", maxsize=REFERENCE_MAXSIZE, ttl=REFERENCE_TTL)
+
+    @staticmethod
+    def _row(row: Any) -> Dict[str, Any]:
+
+        """Map a `users` row to a dict."""
+
+        return {
+            "id": row[0],
+            "username": row[1],
+            "email": row[2],
+            "trust_score": row[3],
+            "reports_made": row[4],
+            "created_at": row[5],
+        }
 
     def add_user(self, username: str, email: str) -> int:
 
@@ -18,31 +38,79 @@ class UserRepository:
             query="INSERT INTO users (username, email) VALUES (?, ?)",
             params=(username, email),
         )
+        self.ids.put(username, cur.lastrowid)
         return cur.lastrowid
 
+    def ensure_user(self, username: str, email: str) -> int:
+
+        """Add a user unless the username is taken. Returns the user's ID either way."""
+
+        self.db.execute(
+            query="INSERT OR IGNORE INTO users (username, email) VALUES (?, ?)",
+            params=(username, email),
+        )
+        return self.get_user_id(username)
+
     def get_user(self, uid: int) -> Optional[Dict[str, Any]]:
 
         """Retrieve a user by ID. Returns a dictionary or None if not found."""
 
+        cached: Optional[Dict[str, Any]] = self.rows.get(uid)
+        if cached is not None:
+            return dict(cached)
+
         cur: sqlite3.Cursor = self.db.execute(
             query="SELECT id, username, email, trust_score, reports_made, created_at FROM users WHERE id = ?",
             params=(uid,),
         )
         row: Any = cur.fetchone()
         if row:
-            return {
-                "id": row[0],
-                "username": row[1],
-                "email": row[2],
-                "trust_score": row[3],
-                "reports_made": row[4],
-                "created_at": row[5],
-            }
+            user: Dict[str, Any] = self._row(row)
+            self.rows.put(uid, user)
+            return dict(user)
         return None
 
+    def get_users(self, uids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+
+        """
+        Retrieve many users at once. Returns a dict mapping user ID -> user,
+        unknown IDs are left out. Cached users cost no query, the others are
+        fetched with one query per `CHUNK_SIZE` IDs.
+        """
+
+        users: Dict[int, Dict[str, Any]] = {}
+        missing: List[int] = []
+
+        for uid in dict.fromkeys(uids):
+            cached: Optional[Dict[str, Any]] = self.rows.get(uid)
+            if cached is not None: users[uid] = dict(cached)
+            else: missing.append(uid)
+
+        for i in range(0, len(missing), self.CHUNK_SIZE):
+            chunk: List[int] = missing[i:i + self.CHUNK_SIZE]
+            cur: sqlite3.Cursor = self.db.execute(
+                query=f"""
+                    SELECT id, username, email, trust_score, reports_made, created_at
+                    FROM users WHERE id IN ({", ".join("?" * len(chunk))})
+                """,
+                params=tuple(chunk),
+            )
+            for row in cur.fetchall():
+                user: Dict[str, Any] = self._row(row)
+                self.rows.put(user["id"], user)
+                users[user["id"]] = dict(user)
+
+        return users
+
     def get_user_id(self, username: str) -> Optional[int]:
 
-        """Retrieve a user's ID by username. Returns the ID or None if not found."""
+        """Retrieve a user's ID by username (cached). Returns the ID or None if not found."""
+
+        return self.ids.get_or_load(username, lambda: self._fetch_user_id(username))
+
+    def _fetch_user_id(self, username: str) -> Optional[int]:
+
+        """Query a user's ID by username."""
 
         cur: sqlite3.Cursor = self.db.execute(
             query="SELECT id FROM users WHERE username = ?",
@@ -53,6 +121,40 @@ class UserRepository:
             return row[0]
         return None
 
+    def get_users_by_name(self, usernames: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+
+        """
+        Retrieve many users at once by username. Returns a dict mapping
+        username -> user, unknown usernames are left out.
+        """
+
+        names: List[str] = list(dict.fromkeys(usernames))
+        ids: Dict[str, int] = {}
+        missing: List[str] = []
+
+        for name in names:
+            uid: Optional[int] = self.ids.get(name)
+            if uid is not None: ids[name] = uid
+            else: missing.append(name)
+
+        for i in range(0, len(missing), self.CHUNK_SIZE):
+            chunk: List[str] = missing[i:i + self.CHUNK_SIZE]
+            cur: sqlite3.Cursor = self.db.execute(
+                query=f"""
+                    SELECT id, username, email, trust_score, reports_made, created_at
+                    FROM users WHERE username IN ({", ".join("?" * len(chunk))})
+                """,
+                params=tuple(chunk),
+            )
+            for row in cur.fetchall():
+                user: Dict[str, Any] = self._row(row)
+                self.rows.put(user["id"], user)
+                self.ids.put(user["username"], user["id"])
+                ids[user["username"]] = user["id"]
+
+        users: Dict[int, Dict[str, Any]] = self.get_users(ids.values())
+        return {name: users[uid] for name, uid in ids.items() if uid in users}
+
     def update_trust_score(self, uid: int, score: float) -> None:
 
         """Update the trust score of a user."""
@@ -61,6 +163,7 @@ class UserRepository:
             query="UPDATE users SET trust_score = ? WHERE id = ?",
             params=(score, uid),
         )
+        self.rows.pop(uid)
 
     def delete_user(self, uid: int) -> None:
 
@@ -70,6 +173,8 @@ class UserRepository:
             query="DELETE FROM users WHERE id = ?",
             params=(uid,),
         )
+        self.rows.pop(uid)
+        self.ids.clear()  # keyed by username, deletions are rare
 
     def update_reports_made(self, uid: int, count: int) -> None:
 
@@ -79,6 +184,7 @@ class UserRepository:
             query="UPDATE users SET reports_made = ? WHERE id = ?",
             params=(count, uid),
         )
+        self.rows.pop(uid)
 
     def list_users(self) -> List[Dict[str, Any]]:
 
@@ -91,15 +197,5 @@ class UserRepository:
 
         rows: List[Any] = cur.fetchall()
 
-        return [
-            {
-                "id": row[0],
-                "username": row[1],
-                "email": row[2],
-                "trust_score": row[3],
-                "reports_made": row[4],
-                "created_at": row[5],
-            }
-            for row in rows
-        ]
+        return [self._row(row) for row in rows]
 
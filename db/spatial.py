@@ -0,0 +1,162 @@
+
+from typing import Any, List, Tuple
+import numpy as np
+import sqlite3
+
+
+EARTH_RADIUS_KM: float = 6371.0
+
+
+class LocationIndex:
+
+    """
+    In-memory spatial index over the `locations` coordinates, for nearest
+    location and radius queries in O(log n). \n
+    Backed by a scikit-learn BallTree (haversine metric). Locations added since
+    the tree was built sit in a small buffer scanned linearly, the tree is
+    rebuilt once that buffer outgrows `rebuild_threshold`. \n
+    Locations are never updated nor deleted, so a rollback only has to forget
+    the ones indexed since the last `checkpoint` (see `rollback`).
+    """
+
+    def __init__(self, rebuild_threshold: int = 256) -> None:
+
+        """Initialize an empty index."""
+
+        self.rebuild_threshold: int = rebuild_threshold
+        self.max_id: int = 0
+        self.committed_id: int = 0  # max_id when the current transaction began
+        self._tree: Any = None
+        self._ids: np.ndarray = np.empty(0, dtype=np.int64)
+        self._coords: np.ndarray = np.empty((0, 2))  # radians, rows of the tree
+        self._pending_ids: List[int] = []
+        self._pending_coords: List[Tuple[float, float]] = []
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._pending_ids)
+
+    def checkpoint(self) -> None:
+        """Record that every location indexed so far is committed, called when a transaction begins."""
+        self.committed_id = self.max_id
+
+    def rollback(self) -> None:
+
+        """
+        Forget the locations indexed since the last `checkpoint`, they may have
+        been rolled back. Those that were not are loaded again by the next
+        `refresh`, along with the rest of the outer transaction's.
+        """
+
+        if self.max_id <= self.committed_id:
+            return
+
+        keep: np.ndarray = self._ids <= self.committed_id
+        if not keep.all():
+            self._ids = self._ids[keep]
+            self._coords = self._coords[keep]
+            self._tree = None
+            if len(self._ids) > 0:
+                from sklearn.neighbors import BallTree
+                self._tree = BallTree(self._coords, metric='haversine')
+
+        pending: List[int] = [i for i, lid in enumerate(self._pending_ids) if lid <= self.committed_id]
+        self._pending_ids = [self._pending_ids[i] for i in pending]
+        self._pending_coords = [self._pending_coords[i] for i in pending]
+        self.max_id = self.committed_id
+
+    def refresh(self, db: Any) -> None:
+
+        """
+        Load the locations inserted since the last refresh (by any connection),
+        rebuilding the tree at most once.
+        """
+
+        cur: sqlite3.Cursor = db.execute(
+            query="""
+                SELECT id, coords_lat, coords_lon FROM locations
+                WHERE id > ? AND coords_lat IS NOT NULL AND coords_lon IS NOT NULL
+                ORDER BY id
+            """,
+            params=(self.max_id,),
+        )
+        rows: List[Tuple[int, float, float]] = cur.fetchall()
+        if not rows:
+            return
+
+        self._pending_ids.extend(r[0] for r in rows)
+        self._pending_coords.extend((float(r[1]), float(r[2])) for r in rows)
+        self.max_id = max(self.max_id, rows[-1][0])
+        self._rebuild_if_needed()
+
+    def add(self, location_id: int, pos: Tuple[float, float]) -> None:
+
+        """Index a new location, ignored if it is already indexed."""
+
+        if location_id <= self.max_id or pos[0] is None or pos[1] is None:
+            return
+
+        self._pending_ids.append(location_id)
+        self._pending_coords.append((float(pos[0]), float(pos[1])))
+        self.max_id = max(self.max_id, location_id)
+        self._rebuild_if_needed()
+
+    def _rebuild_if_needed(self) -> None:
+
+        """Rebuild the tree once the pending buffer outgrows its threshold."""
+
+        if len(self._pending_ids) > max(self.rebuild_threshold, int(np.sqrt(len(self._ids)))):
+            self._rebuild()
+
+    def _rebuild(self) -> None:
+
+        """Fold the pending locations into a new BallTree."""
+
+        from sklearn.neighbors import BallTree  # heavy import, only when needed
+
+        pending: np.ndarray = np.radians(np.array(self._pending_coords, dtype=float).reshape(-1, 2))
+        self._coords = np.concatenate([self._coords, pending])
+        self._ids = np.concatenate([self._ids, np.array(self._pending_ids, dtype=np.int64)])
+        self._tree = BallTree(self._coords, metric='haversine')
+        self._pending_ids = []
+        self._pending_coords = []
+
+    def _pending_distances(self, pos: Tuple[float, float]) -> np.ndarray:
+
+        """Haversine distance (km) from `pos` to every pending location."""
+
+        if not self._pending_coords:
+            return np.empty(0)
+
+        lat1, lon1 = np.radians(pos)
+        lat2, lon2 = np.radians(np.array(self._pending_coords)).T
+        a: np.ndarray = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+        return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    def nearest(self, pos: Tuple[float, float], k: int = 1) -> List[Tuple[int, float]]:
+
+        """The `k` locations closest to `pos`, as (location_id, distance_km) sorted by distance."""
+
+        found: List[Tuple[int, float]] = []
+
+        if self._tree is not None and len(self._ids) > 0:
+            dist, idx = self._tree.query(np.radians([pos]), k=min(k, len(self._ids)))
+            found += [(int(self._ids[i]), float(d * EARTH_RADIUS_KM)) for d, i in zip(dist[0], idx[0])]
+
+        found += [(lid, float(d)) for lid, d in zip(self._pending_ids, self._pending_distances(pos))]
+        return sorted(found, key=lambda x: x[1])[:k]
+
+    def within(self, pos: Tuple[float, float], radius_km: float) -> List[Tuple[int, float]]:
+
+        """Every location within `radius_km` of `pos`, as (location_id, distance_km) sorted by distance."""
+
+        found: List[Tuple[int, float]] = []
+
+        if self._tree is not None and len(self._ids) > 0:
+            idx, dist = self._tree.query_radius(np.radians([pos]), r=radius_km / EARTH_RADIUS_KM, return_distance=True)
+            found += [(int(self._ids[i]), float(d * EARTH_RADIUS_KM)) for i, d in zip(idx[0], dist[0])]
+
+        found += [
+            (lid, float(d)) for lid, d in zip(self._pending_ids, self._pending_distances(pos))
+            if d <= radius_km
+        ]
+        return sorted(found, key=lambda x: x[1])
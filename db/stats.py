@@ -0,0 +1,174 @@
+
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+import sqlite3
+import threading
+import re
+import os
+
+
+# `IN (?, ?, ?)` and `VALUES (?), (?)` lists are collapsed, so chunked lookups
+# of any size share a single entry
+_IN_LIST: re.Pattern = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+_SPACES: re.Pattern = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def normalize(query: str) -> str:
+    """The statement with whitespace and parameter lists collapsed, used as its stats key."""
+    return _IN_LIST.sub("(?)", _SPACES.sub(" ", query).strip().rstrip(";").strip())
+
+
+class QueryStats:
+
+    """
+    Per-statement counters, keyed by normalized SQL: executions, total and
+    max latency of `execute` (for a SELECT, that includes stepping to the
+    first row) and rows returned, or changed for a write. \n
+    Thread-safe, a single instance is shared by every connection of the process.
+    """
+
+    def __init__(self) -> None:
+
+        """Initialize empty counters."""
+
+        self._lock: threading.Lock = threading.Lock()
+        # normalized SQL -> [calls, total seconds, max seconds, rows]
+        self._entries: Dict[str, List[float]] = {}
+
+    def record(self, query: str, seconds: float, rows: int = 0) -> str:
+
+        """Count one execution of `query`. Returns its key, for `add_rows()`."""
+
+        key: str = normalize(query)
+        with self._lock:
+            entry: Optional[List[float]] = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [1, seconds, seconds, rows]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                if seconds > entry[2]: entry[2] = seconds
+                entry[3] += rows
+        return key
+
+    def add_rows(self, key: str, rows: int) -> None:
+
+        """Count rows fetched after the statement returned."""
+
+        with self._lock:
+            self._entries[key][3] += rows
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+
+        """Copy of the counters, by normalized SQL."""
+
+        with self._lock:
+            return {
+                key: {"calls": int(calls), "total_s": total, "max_s": peak, "rows": int(rows)}
+                for key, (calls, total, peak, rows) in self._entries.items()
+            }
+
+    def top(self, n: int = 10, by: str = "total_s") -> List[Dict[str, Any]]:
+
+        """The `n` statements with the highest `by` counter, highest first."""
+
+        rows: List[Dict[str, Any]] = [{"query": k, **v} for k, v in self.snapshot().items()]
+        rows.sort(key=lambda r: r[by], reverse=True)
+        return rows[:n]
+
+    def reset(self) -> None:
+        """Drop every counter."""
+        with self._lock:
+            self._entries.clear()
+
+
+class CountingCursor(sqlite3.Cursor):
+
+    """Cursor adding the rows it hands out to the stats entry of its statement."""
+
+    stats: QueryStats
+    key: str
+
+    def fetchone(self) -> Any:
+        row: Any = super().fetchone()
+        if row is not None:
+            self.stats.add_rows(self.key, 1)
+        return row
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        rows: List[Any] = super().fetchmany(self.arraysize if size is None else size)
+        if rows:
+            self.stats.add_rows(self.key, len(rows))
+        return rows
+
+    def fetchall(self) -> List[Any]:
+        rows: List[Any] = super().fetchall()
+        if rows:
+            self.stats.add_rows(self.key, len(rows))
+        return rows
+
+    def __next__(self) -> Any:
+        row: Any = super().__next__()
+        self.stats.add_rows(self.key, 1)
+        return row
+
+
+def _escape(value: str) -> str:
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_prometheus(stats: Optional[QueryStats], caches: Dict[str, Dict[str, int]]) -> str:
+
+    """
+    Render the query counters (if instrumentation is on) and the cache
+    counters in the Prometheus text exposition format.
+    """
+
+    lines: List[str] = []
+
+    def metric(name: str, kind: str, doc: str, samples: List[tuple]) -> None:
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} {kind}")
+        for label, value in samples:
+            lines.append(f"{name}{{{label}}} {value}")
+
+    if stats is not None:
+        entries: Dict[str, Dict[str, float]] = stats.snapshot()
+        labels: Dict[str, str] = {key: f'query="{_escape(key)}"' for key in entries}
+        metric("db_query_calls_total", "counter", "Statements executed, by normalized SQL.",
+               [(labels[k], int(v["calls"])) for k, v in entries.items()])
+        metric("db_query_seconds_total", "counter", "Time spent executing the statement.",
+               [(labels[k], f'{v["total_s"]:.6f}') for k, v in entries.items()])
+        metric("db_query_seconds_max", "gauge", "Slowest single execution of the statement.",
+               [(labels[k], f'{v["max_s"]:.6f}') for k, v in entries.items()])
+        metric("db_query_rows_total", "counter", "Rows returned (or changed) by the statement.",
+               [(labels[k], int(v["rows"])) for k, v in entries.items()])
+
+    names: Dict[str, str] = {name: f'cache="{_escape(name)}"' for name in caches}
+    metric("db_cache_hits_total", "counter", "Row cache hits.",
+           [(names[n], c["hits"]) for n, c in caches.items()])
+    metric("db_cache_misses_total", "counter", "Row cache misses.",
+           [(names[n], c["misses"]) for n, c in caches.items()])
+    metric("db_cache_entries", "gauge", "Rows currently cached.",
+           [(names[n], c["size"]) for n, c in caches.items()])
+
+    return "\n".join(lines) + "\n"
+
+
+_query_stats: Optional[QueryStats] = None
+
+
+def query_stats() -> Optional[QueryStats]:
+
+    """
+    The process-wide stats shared by every `Database`, None unless the
+    `DB_STATS` environment variable is set (read on first call, so after
+    `load_dotenv()`).
+    """
+
+    global _query_stats
+    if _query_stats is None and os.getenv("DB_STATS", "0").lower() in ("1", "true", "yes"):
+        _query_stats = QueryStats()
+    return _query_stats
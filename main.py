@@ -1,29 +1,55 @@
 
+from dotenv import load_dotenv
+# before `core` and `db`, which read their settings from the environment at import
+load_dotenv()
+
 from core import Routine
-from db import Database, UserRepository, ReportType
+from db import Database, UserRepository, ReportType, migrate
 from core import ReportMessage
 import requests
+import sys
+import time
 import os
-from dotenv import load_dotenv
 
 
 def test_tb(db: Database) -> None:
-    
+
     ur: UserRepository = UserRepository(db)
-    _: int = ur.add_user('demo', 'demo@demo.demo')
+    _: int = ur.ensure_user('demo', 'demo@demo.demo')
 
-if __name__ == "__main__":
 
-    load_dotenv()
+def setup() -> None:
+
+    """
+    Prepare the database, once, before any worker starts. \n
+    The existing database is kept: only missing schema steps, report types
+    and the demo user are added, so a restart loses no data.
+    """
 
-    try: os.remove(os.getenv("DB_PATH"))
-    except FileNotFoundError: ...
+    started_at: float = time.monotonic()
 
     db: Database = Database(os.getenv("DB_PATH"))
-    db.fill_types()
+    migrate(db)
+    with db.transaction():
+        db.fill_types()
+        test_tb(db)
+    db.close()
+
+    print(f"[INFO] Database ready in {(time.monotonic() - started_at) * 1000:.1f} ms.")
+
 
-    test_tb(db)
-    
-    routine: Routine = Routine(db)
+def run_worker(shard: int = 0) -> None:
+
+    """Consume the report queue of a single shard, forever."""
+
+    db: Database = Database(os.getenv("DB_PATH"))
+    routine: Routine = Routine(db, shard=shard)
     routine.run()
 
+
+if __name__ == "__main__":
+
+    setup()
+
+    # usage: python main.py [shard], see supervisor.py to run every shard
+    run_worker(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -5,7 +5,7 @@ import datetime
 from faker import Faker
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from db import Database, ReportType, Status
+from db import Database, ReportType, Status, migrate
 from db.repositories.user_repository import UserRepository
 from db.repositories.report_repository import ReportRepository
 from db.repositories.incident_repository import IncidentRepository
@@ -14,6 +14,7 @@ from db.repositories.general_repository import GeneralRepository
 fake = Faker()
 Faker.seed(42)
 db = Database("test.db")
+migrate(db, background=False)
 user_repo = UserRepository(db)
 report_repo = ReportRepository(db)
 incident_repo = IncidentRepository(db)
@@ -72,8 +73,7 @@ for _ in range(num_zero_delay):
     created_at = fake.date_time_between(start_date='-30d', end_date='now')
     db.execute(
         "INSERT INTO incidents (location_id, type_id, avg_delay, trust_score, status, created_at, last_updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (location_id, type_id, avg_delay, trust_score, status, created_at, created_at),
-        commit=True
+        (location_id, type_id, avg_delay, trust_score, status, created_at, created_at)
     )
 
 for _ in range(num_nonzero_delay):
@@ -104,8 +104,7 @@ for _ in range(num_nonzero_delay):
     created_at = fake.date_time_between(start_date='-30d', end_date='now')
     db.execute(
         "INSERT INTO incidents (location_id, type_id, avg_delay, trust_score, status, created_at, last_updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (location_id, type_id, avg_delay, trust_score, status, created_at, created_at),
-        commit=True
+        (location_id, type_id, avg_delay, trust_score, status, created_at, created_at)
     )
 
 print("Fake data generation complete.")
@@ -0,0 +1,171 @@
+
+from dotenv import load_dotenv
+# before `core` and `db`, which read their settings from the environment at import
+load_dotenv()
+
+from core import ReportMessage, Routine, Sweeper, queue_name, shard_count, shard_for
+from core.queue import QUEUE_PREFIX, ReportQueue
+from main import setup, run_worker
+from db import Database
+from multiprocessing import Process
+from typing import Dict, Optional
+from redis import Redis
+import signal
+import time
+import os
+
+
+class Supervisor:
+
+    """
+    Runs one routine worker per report shard and restarts any worker that
+    dies, so every shard always has exactly one consumer. It also reaps the
+    in-flight reports of dead workers back onto their queue, and periodically
+    sweeps the stale incidents (see `Sweeper`).
+    """
+
+    CHECK_INTERVAL: float = 1.0  # seconds between liveness checks
+    RESTART_BACKOFF: float = 2.0  # min seconds between two restarts of a shard
+
+    def __init__(self, shards: int, redis_conn: Redis, db_path: Optional[str] = None) -> None:
+
+        """Initialize the Supervisor for `shards` workers, sweeping the database at `db_path` if given."""
+
+        self.shards: int = shards
+        self.redis: Redis = redis_conn
+        self.db_path: Optional[str] = db_path
+        self.swept_at: float = 0.0
+        self.reaped_at: float = 0.0
+        self.workers: Dict[int, Process] = {}
+        self.started_at: Dict[int, float] = {}
+        self.running: bool = False
+
+    def run(self) -> None:
+
+        """Start every worker and keep them alive until SIGTERM/SIGINT."""
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for shard in range(self.shards):
+            self._start(shard)
+
+        while self.running:
+            time.sleep(self.CHECK_INTERVAL)
+            for shard, worker in list(self.workers.items()):
+                if worker.is_alive() or not self.running:
+                    continue
+                if time.monotonic() - self.started_at[shard] < self.RESTART_BACKOFF:
+                    continue
+                print(f"[WARN] Worker for shard {shard} died (exit code {worker.exitcode}), restarting.")
+                self._start(shard)
+
+            if time.monotonic() - self.reaped_at >= ReportQueue.HEARTBEAT_TTL:
+                self._reap()
+
+            if self.db_path and time.monotonic() - self.swept_at >= Sweeper.INTERVAL:
+                self._sweep()
+
+        for worker in self.workers.values():
+            worker.join()
+
+    def _reap(self) -> None:
+
+        """Re-queue the in-flight reports of workers whose heartbeat expired."""
+
+        self.reaped_at = time.monotonic()
+        try:
+            requeued, dead = ReportQueue.reap(self.redis)
+        except Exception as e:
+            print(f"[ERROR] Reaper failed: {e}")
+            return
+        if requeued:
+            print(f"[WARN] Re-queued {requeued} in-flight report(s) of dead workers.")
+        if dead:
+            print(f"[WARN] Moved {dead} report(s) that kept killing their worker to the dead-letter queue.")
+
+    def _sweep(self) -> None:
+
+        """Resolve the stale incidents, a failed sweep is retried on the next interval."""
+
+        # a short-lived connection: one left open would be inherited by the next forked worker
+        self.swept_at = time.monotonic()
+        db: Database = Database(self.db_path)
+        # resolved incidents must drop out of the API's cached GTFS feed too
+        db.add_commit_hook(lambda tables: Routine._publish_changes(self.redis, tables))
+        try:
+            Sweeper(db).sweep()
+        except Exception as e:
+            print(f"[ERROR] Sweeper failed: {e}")
+        finally:
+            db.close()
+
+    def _start(self, shard: int) -> None:
+
+        """Spawn the worker owning `shard`."""
+
+        worker: Process = Process(target=_worker_main, args=(shard,), name=f"routine-worker-{shard}")
+        worker.start()
+        self.workers[shard] = worker
+        self.started_at[shard] = time.monotonic()
+        print(f"[INFO] Started worker {worker.pid} for shard {shard}.")
+
+    def _stop(self, signum: int, _frame: Optional[object]) -> None:
+
+        """Forward the shutdown signal to every worker."""
+
+        print(f"[INFO] Received signal {signum}, stopping workers.")
+        self.running = False
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.terminate()
+
+
+def _worker_main(shard: int) -> None:
+
+    """Worker process entry point, the supervisor's signal handlers are not inherited."""
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    run_worker(shard)
+
+
+def rebalance(redis_conn: Redis, shards: int) -> int:
+
+    """
+    Move reports left in queues that no longer map to a shard (the unsharded
+    legacy queue, or shards above the current count) to the queue now owning
+    their location. Returns the number of reports moved.
+    """
+
+    moved: int = 0
+    for key in redis_conn.scan_iter(match=f'{QUEUE_PREFIX}*'):
+
+        name: str = key.decode()
+        suffix: str = name[len(QUEUE_PREFIX) + 1:]
+        if name != QUEUE_PREFIX and (not suffix.isdigit() or int(suffix) < shards):
+            continue
+
+        # peek at the head, then move it in a single command: a crash between
+        # the two leaves the report where it was, never in neither queue
+        while (raw := redis_conn.lindex(name, 0)) is not None:
+            try: location_name: Optional[str] = ReportMessage.from_wire(raw).location_name
+            except Exception: location_name = None  # left for the worker to reject
+            redis_conn.lmove(name, queue_name(shard_for(location_name, shards)), 'LEFT', 'RIGHT')
+            moved += 1
+
+    return moved
+
+
+if __name__ == "__main__":
+
+    setup()
+
+    shards: int = shard_count()
+    redis_conn: Redis = Redis(host=os.getenv("REDIS_HOST", "redis"), port=os.getenv("REDIS_PORT", 6379), db=os.getenv("REDIS_DB", 0))
+    requeued, dead = ReportQueue.reap(redis_conn)
+    print(f"[INFO] Re-queued {requeued} in-flight report(s) of dead workers ({dead} dead-lettered).")
+    print(f"[INFO] Rebalanced {rebalance(redis_conn, shards)} queued report(s) over {shards} shard(s).")
+
+    Supervisor(shards, redis_conn, os.getenv("DB_PATH")).run()
@@ -0,0 +1,108 @@
+"""
+The running incident aggregates against the full recompute. \n
+Usage: python -m unittest tests.test_aggregator
+"""
+
+from core import Aggregator, AggregatorHelper, ReportMessage, shard_for
+from db import Database, ReportType, migrate
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from unittest import mock
+import contextlib
+import random
+import unittest
+import io
+import os
+
+
+class RunningAggregatesTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        """Seed a database with reporters of various trust and experience, and one incident."""
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+            self.db.fill_types()
+
+        self.ag: Aggregator = Aggregator(self.db)
+        self.rng: random.Random = random.Random(6)
+
+        self.users: List[Dict[str, Any]] = []
+        for i in range(8):
+            uid: int = self.ag.user_repo.add_user(f"user{i}", f"user{i}@example.com")
+            self.ag.user_repo.update_trust_score(uid, self.rng.uniform(0.05, 1.0))
+            self.ag.user_repo.update_reports_made(uid, self.rng.randint(0, 300))
+            self.users.append(self.ag.user_repo.get_user(uid))
+
+        self.types: List[int] = [self.ag.general_repo.get_type_id(t) for t in (ReportType.DELAY, ReportType.ACCIDENT, ReportType.OTHER)]
+        self.lid: int = self.ag.general_repo.add_location("trip@stop", (50.06, 19.94))
+        self.iid: int = self.ag.incident_repo.add_incident(self.lid, self.types[0])
+
+    def _receive(self, created_at: datetime, delay: Optional[int]) -> None:
+
+        """Fold one report, arrived at `created_at`, into the incident's running aggregates."""
+
+        user: Dict[str, Any] = self.rng.choice(self.users)
+        rid: int = self.ag.report_repo.add_report(user["id"], self.lid, self.rng.choice(self.types), delay)
+        self.ag.user_repo.update_reports_made(user["id"], user["reports_made"])  # keep the user table fixed
+        self.db.execute("UPDATE reports SET created_at = ? WHERE id = ?", (created_at.strftime("%Y-%m-%d %H:%M:%S"), rid))
+        self.ag.report_repo.assign_to_incident(rid, self.iid)
+
+        incident: Dict[str, Any] = self.ag.incident_repo.get_incident(self.iid)
+        AggregatorHelper._update_incident(self.ag, incident, self.ag.report_repo.get_report(rid), user)
+
+    def test_recompute_matches_running_aggregates(self) -> None:
+
+        """With an unchanged user table, a recompute reproduces the running aggregates."""
+
+        at: datetime = datetime.now(timezone.utc) - timedelta(minutes=90)
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(AggregatorHelper, "RECOMPUTE_EVERY", 0):
+            for _ in range(120):
+                at += timedelta(seconds=self.rng.randint(0, 90))
+                # some reports without a delay, some far from the average
+                self._receive(at, self.rng.choice([None, 0, 3, 5, 8, 10, 12, 15, 40, 90]))
+
+            running: Dict[str, Any] = self.ag.stats_repo.get_stats(self.iid)
+            running_trust: float = self.ag.incident_repo.get_incident(self.iid)["trust_score"]
+            AggregatorHelper._recompute_incident(self.ag, self.ag.incident_repo.get_incident(self.iid))
+
+        recomputed: Dict[str, Any] = self.ag.stats_repo.get_stats(self.iid)
+        self.assertEqual(recomputed, running)
+        self.assertEqual(self.ag.incident_repo.get_incident(self.iid)["trust_score"], running_trust)
+
+
+class MergeLocationTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+            self.db.fill_types()
+
+    def _names(self, shard: int) -> List[str]:
+        """Location names owned by `shard` out of two."""
+        return [f"trip{i}@stop" for i in range(100) if shard_for(f"trip{i}@stop", 2) == shard]
+
+    def test_merge_stays_on_shard(self) -> None:
+
+        """A report is only merged into a nearby location of its own worker's shard."""
+
+        ours, theirs = self._names(0), self._names(1)
+        with mock.patch.dict(os.environ, {"REPORT_SHARDS": "2"}), mock.patch.object(Aggregator, "MERGE_RADIUS_KM", 1.0), \
+                contextlib.redirect_stdout(io.StringIO()):
+
+            ag: Aggregator = Aggregator(self.db, shard=0)
+            other: int = ag.general_repo.add_location(theirs[0], (50.0, 19.0))
+            report: ReportMessage = ReportMessage("u", (50.0, 19.0), ours[0], (50.0001, 19.0), ReportType.DELAY)
+            self.assertIsNone(ag._merge_location(report))
+
+            own: int = ag.general_repo.add_location(ours[1], (50.0005, 19.0))
+            self.assertEqual(ag._merge_location(report), own)
+            self.assertNotEqual(own, other)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Keyset pagination and spatial filters of the API listings. \n
+Usage: python -m unittest tests.test_api
+"""
+
+from benchmarks.pipeline_bench import InProcessRedis
+from db import Database, GeneralRepository, IncidentRepository, ReportRepository, UserRepository, migrate
+from db.pool import ConnectionPool
+from typing import Any, List, Optional
+from unittest import mock
+import contextlib
+import importlib
+import tempfile
+import unittest
+import json
+import os
+import io
+
+
+class ListingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+
+        """A database of 25 reports and incidents on a line of locations, 0.1° of latitude apart."""
+
+        cls.tmp: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+        fp: str = os.path.join(cls.tmp.name, "api.db")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            db: Database = Database(fp)
+            migrate(db, background=False)
+            db.fill_types()
+
+        general: GeneralRepository = GeneralRepository(db)
+        incidents: IncidentRepository = IncidentRepository(db)
+        reports: ReportRepository = ReportRepository(db)
+        with db.transaction():
+            uid: int = UserRepository(db).add_user("alice", "alice@example.com")
+            for i in range(25):
+                lid: int = general.add_location(f"trip{i}@stop", (50.0 + i / 10, 19.9))
+                incidents.add_incident(lid, 1, 5.0, 0.5, "active" if i % 5 else "resolved")
+                reports.add_report(uid, lid, 1, i)
+        db.close()
+
+        # the API opens its connection pool on import
+        with mock.patch.dict(os.environ, {"DB_PATH": fp}), contextlib.redirect_stdout(io.StringIO()):
+            cls.web: Any = importlib.import_module("web.app")
+        cls.web.db_pool = ConnectionPool(fp, read_only=True)
+        cls.web.redis_conn = InProcessRedis()
+        cls.client: Any = cls.web.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.web.db_pool.close()
+        cls.tmp.cleanup()
+
+    def _ids(self, url: str) -> List[int]:
+        response: Any = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [row["id"] for row in json.loads(response.data)]
+
+    def test_pages(self) -> None:
+
+        """Following `X-Next-After-Id` walks the whole listing, newest first, without overlap."""
+
+        for endpoint in ("/api/reports", "/api/incidents"):
+            with self.subTest(endpoint=endpoint):
+                ids: List[int] = []
+                after: Optional[str] = None
+                pages: int = 0
+                while True:
+                    response: Any = self.client.get(f"{endpoint}?limit=10" + (f"&after_id={after}" if after else ""))
+                    ids.extend(row["id"] for row in json.loads(response.data))
+                    pages += 1
+                    after = response.headers.get("X-Next-After-Id")
+                    if after is None:
+                        break
+
+                self.assertEqual(pages, 3)
+                self.assertEqual(ids, list(range(25, 0, -1)))
+                self.assertEqual(self._ids(f"{endpoint}?stream=1"), ids)
+                self.assertEqual(self._ids(f"{endpoint}?after_id=4"), [3, 2, 1])
+
+    def test_invalid_pages(self) -> None:
+
+        for query in ("limit=0", "limit=1001", "after_id=x"):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f"/api/reports?{query}").status_code, 400)
+
+    def test_radius(self) -> None:
+
+        """Active incidents within the radius, closest first."""
+
+        # location 8 is the center, 7 and 9 are about 11 km away
+        rows: List[Any] = json.loads(self.client.get("/api/incidents?lat=50.7&lon=19.9&radius_km=12").data)
+        self.assertEqual(rows[0]["id"], 8)
+        self.assertEqual(sorted(r["id"] for r in rows), [7, 8, 9])
+        self.assertEqual([r["distance_km"] for r in rows], sorted(r["distance_km"] for r in rows))
+
+    def test_bbox(self) -> None:
+
+        """Only the active incidents inside the box."""
+
+        # locations 6 to 15, of which 6 and 11 hold a resolved incident
+        ids: List[int] = self._ids("/api/incidents?bbox=19.8,50.45,20.0,51.45")
+        self.assertEqual(sorted(ids), [7, 8, 9, 10, 12, 13, 14, 15])
+
+    def test_invalid_areas(self) -> None:
+
+        for query in ("bbox=20,50,19,51", "bbox=1,2,3", "lat=50&lon=19.9", "lat=95&lon=0&radius_km=1",
+                      "lat=50&lon=19.9&radius_km=1&limit=5"):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f"/api/incidents?{query}").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
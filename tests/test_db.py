@@ -0,0 +1,113 @@
+"""
+Transactions and caches of `Database`. \n
+Usage: python -m unittest tests.test_db
+"""
+
+from db import Database, GeneralRepository, UserRepository, migrate
+from db.spatial import LocationIndex
+from unittest import mock
+import contextlib
+import sqlite3
+import unittest
+import io
+
+
+class TransactionTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+        self.users: UserRepository = UserRepository(self.db)
+
+    def test_failed_commit_rolls_back(self) -> None:
+
+        """A COMMIT that fails leaves no transaction open and no stale cached rows."""
+
+        uid: int = self.users.add_user("alice", "alice@example.com")
+        self.users.get_user(uid)  # cached
+
+        busy: sqlite3.OperationalError = sqlite3.OperationalError("database is locked")
+        with mock.patch.object(self.db, "_commit", side_effect=busy):
+            with self.assertRaises(sqlite3.OperationalError):
+                with self.db.transaction():
+                    self.users.update_trust_score(uid, 0.1)
+                    self.users.get_user(uid)  # cached again, inside the failed transaction
+
+        self.assertFalse(self.db.conn.in_transaction)
+        self.assertEqual(self.users.get_user(uid)["trust_score"], 1.0)
+
+        # the next transaction starts and commits normally
+        with self.db.transaction():
+            self.users.update_trust_score(uid, 0.2)
+        self.assertEqual(self.users.get_user(uid)["trust_score"], 0.2)
+
+    def test_savepoint_rollback(self) -> None:
+
+        """A failing nested block only rolls back its own writes."""
+
+        with self.db.transaction():
+            kept: int = self.users.add_user("bob", "bob@example.com")
+            with contextlib.suppress(ValueError), self.db.transaction():
+                self.users.add_user("carol", "carol@example.com")
+                raise ValueError("poison")
+
+        self.assertIsNotNone(self.users.get_user(kept))
+        self.assertIsNone(self.users.get_user_id("carol"))
+
+
+class LocationIndexTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+        self.general: GeneralRepository = GeneralRepository(self.db)
+        with self.db.transaction():
+            self.db.conn.executemany(
+                "INSERT INTO locations (name, coords_lat, coords_lon) VALUES (?, ?, ?)",
+                [(f"trip{i}@stop", 50.0 + i / 1000, 19.9) for i in range(1000)]
+            )
+
+    def test_rollback_keeps_committed_locations(self) -> None:
+
+        """A rolled back savepoint or transaction only drops its own locations from the index."""
+
+        index: LocationIndex = self.db.location_index()
+        with mock.patch.object(LocationIndex, "_rebuild", autospec=True, side_effect=LocationIndex._rebuild) as rebuild:
+            with self.db.transaction():
+                kept: int = self.general.add_location("kept@stop", (10.0, 10.0))
+                with contextlib.suppress(ValueError), self.db.transaction():
+                    self.general.add_location("poison@stop", (-10.0, -10.0))
+                    raise ValueError("poison")
+                self.assertEqual(self.general.get_nearest_location((10.0, 10.0))[0], kept)
+            self.assertEqual(rebuild.call_count, 0)
+
+            with contextlib.suppress(ValueError), self.db.transaction():
+                self.general.add_location("gone@stop", (20.0, 20.0))
+                raise ValueError("poison")
+            self.assertEqual(rebuild.call_count, 0)
+
+        self.assertEqual(len(self.db.location_index()), 1001)
+        self.assertEqual(self.general.get_nearest_location((-10.0, -10.0))[0], kept)
+        self.assertIs(self.db.location_index(), index)
+
+        # the rolled back id is reused by the next location
+        reused: int = self.general.add_location("next@stop", (20.0, 20.0))
+        self.assertEqual(self.general.get_nearest_location((20.0, 20.0)), (reused, 0.0))
+
+    def test_refresh_rebuilds_once(self) -> None:
+
+        """Loading many locations at once builds the tree a single time."""
+
+        fresh: LocationIndex = LocationIndex()
+        with mock.patch.object(LocationIndex, "_rebuild", autospec=True, side_effect=LocationIndex._rebuild) as rebuild:
+            fresh.refresh(self.db)
+        self.assertEqual(rebuild.call_count, 1)
+        self.assertEqual(len(fresh), 1000)
+        self.assertEqual(fresh.nearest((50.5, 19.9))[0][0], 501)
+
+if __name__ == "__main__":
+    unittest.main()
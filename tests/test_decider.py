@@ -0,0 +1,94 @@
+"""
+The vectorized decisions against the scalar ones. \n
+Usage: python -m unittest tests.test_decider
+"""
+
+from core import Decider, ReportMessage
+from core.decider import Thresholds
+from db import Database, ReportType, migrate
+from typing import Any, Dict, List
+import contextlib
+import unittest
+import random
+import math
+import io
+
+
+class DecideManyTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        """Seed users on both sides of the trust thresholds."""
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+            self.db.fill_types()
+
+        self.decider: Decider = Decider(self.db)
+        self.rng: random.Random = random.Random(11)
+
+        self.users: List[str] = []
+        for i in range(30):
+            uid: int = self.decider.user_repo.add_user(f"user{i}", f"user{i}@example.com")
+            self.decider.user_repo.update_trust_score(uid, self.rng.choice([0.5, 0.7, self.rng.random()]))
+            self.decider.user_repo.update_reports_made(uid, self.rng.choice([0, 1, self.rng.randint(0, 500)]))
+            self.users.append(f"user{i}")
+
+    def _message(self, user: str, distance_km: float, delay: Any) -> ReportMessage:
+
+        """A report `distance_km` north of its reporter, moved by a few ulps."""
+
+        lat: float = self.rng.uniform(-60.0, 60.0)
+        lon: float = self.rng.uniform(-170.0, 170.0)
+        target: float = lat + math.degrees(distance_km / 6371)
+        for _ in range(self.rng.randint(0, 4)):
+            target = math.nextafter(target, self.rng.choice([-math.inf, math.inf]))
+        return ReportMessage(user, (lat, lon), "trip@stop", (target, lon), ReportType.DELAY, delay)
+
+    def _assert_same_decisions(self, messages: List[ReportMessage]) -> None:
+
+        mask, prob = self.decider.decide_many(messages)
+        for i, message in enumerate(messages):
+            accepted, p = self.decider.decide(message)
+            self.assertEqual(bool(mask[i]), accepted, message)
+            self.assertAlmostEqual(float(prob[i]), p, places=12, msg=message)
+
+    def test_random_reports(self) -> None:
+
+        """Reports anywhere around the thresholds, with and without a delay."""
+
+        messages: List[ReportMessage] = [
+            self._message(
+                self.rng.choice(self.users),
+                self.rng.uniform(0.0, 2 * Thresholds.DISTANCE),
+                self.rng.choice([None, 0, self.rng.randint(0, 2 * int(Thresholds.TIME))])
+            )
+            for _ in range(2000)
+        ]
+        self._assert_same_decisions(messages)
+
+    def test_boundary_reports(self) -> None:
+
+        """Reports right on the distance threshold or on a probability of exactly `Thresholds.DECIDE`."""
+
+        users: Dict[str, Dict[str, Any]] = self.decider.user_repo.get_users_by_name(self.users)
+        messages: List[ReportMessage] = []
+        for _ in range(2000):
+
+            name: str = self.rng.choice(self.users)
+            user: Dict[str, Any] = users[name]
+            trust: float = self.decider._trust(user["id"])
+            delay: int = self.rng.randint(0, int(Thresholds.TIME))
+
+            # score = 2 * trust - distance / DISTANCE - delay / TIME = 0
+            distance: float = Thresholds.DISTANCE * (2 * trust - delay / Thresholds.TIME)
+            if not 0.0 <= distance <= Thresholds.DISTANCE:
+                distance = Thresholds.DISTANCE
+            messages.append(self._message(name, self.rng.choice([distance, Thresholds.DISTANCE]), delay))
+
+        self._assert_same_decisions(messages)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Schema migrations from an empty or an older database, and the index check. \n
+Usage: python -m unittest tests.test_migrations
+"""
+
+from db import Database, migrate
+from db.check_indexes import check
+from db.migrations import LATEST_VERSION, MIGRATIONS, schema_version
+from typing import Set
+import contextlib
+import unittest
+import io
+
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.db: Database = Database(":memory:")
+
+    def _indexes(self) -> Set[str]:
+        return {r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")}
+
+    def _migrate(self) -> int:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return migrate(self.db, background=False)
+
+    def test_from_v0(self) -> None:
+
+        """A new database gets every table and the indexes of the latest schema."""
+
+        self.assertEqual(schema_version(self.db), 0)
+        self.assertEqual(self._migrate(), LATEST_VERSION)
+        self.assertEqual(schema_version(self.db), LATEST_VERSION)
+
+        indexes: Set[str] = self._indexes()
+        self.assertIn("idx_incidents_location_active", indexes)
+        self.assertIn("idx_incidents_location", indexes)
+        self.assertNotIn("idx_incidents_location_updated", indexes)
+        self.assertNotIn("idx_reports_location", indexes)
+
+        # up to date: nothing to do
+        self.assertEqual(self._migrate(), LATEST_VERSION)
+        self.assertEqual(self._indexes(), indexes)
+
+    def test_from_v1(self) -> None:
+
+        """A database left at the baseline keeps its rows and gains the later steps."""
+
+        with self.db.transaction():
+            for statement in MIGRATIONS[0].statements:
+                self.db.execute(statement)
+            self.db.execute("PRAGMA user_version = 1;")
+            self.db.fill_types()
+            self.db.execute("INSERT INTO locations (name, coords_lat, coords_lon) VALUES ('trip@stop', 50.0, 19.9)")
+            self.db.execute("INSERT INTO users (username, email) VALUES ('alice', 'alice@example.com')")
+            self.db.execute("INSERT INTO incidents (location_id, type_id, avg_delay) VALUES (1, 1, 5.0)")
+            self.db.execute("INSERT INTO reports (user_id, location_id, type_id, delay_minutes, incident_id) VALUES (1, 1, 1, 5, 1)")
+        self.assertIn("idx_reports_location", self._indexes())
+
+        self.assertEqual(self._migrate(), LATEST_VERSION)
+
+        tables: Set[str] = {r[0] for r in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self.assertIn("incident_stats", tables)
+        self.assertEqual(self.db.execute("SELECT COUNT(*) FROM reports").fetchone()[0], 1)
+        self.assertEqual(self.db.execute("SELECT avg_delay FROM incidents").fetchone()[0], 5.0)
+
+        indexes: Set[str] = self._indexes()
+        self.assertIn("idx_incidents_location_active", indexes)
+        self.assertNotIn("idx_reports_location", indexes)
+        self.assertNotIn("idx_incidents_location_updated", indexes)
+
+    def test_queries_use_indexes(self) -> None:
+
+        """Every repository query of the latest schema is served by an index (see `db.check_indexes`)."""
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(check(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
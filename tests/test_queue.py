@@ -0,0 +1,185 @@
+"""
+Report queues on an in-process Redis: in-flight lists, redeliveries and bounded pushes. \n
+Usage: python -m unittest tests.test_queue
+"""
+
+from benchmarks.pipeline_bench import InProcessRedis
+from core import Routine
+from core.queue import DEAD_LETTER_QUEUE, QueueFull, ReportProducer, ReportQueue, queue_name
+from db import Database, migrate
+from typing import Any, List
+from unittest import mock
+import importlib.util
+import contextlib
+import sqlite3
+import unittest
+import io
+
+
+# the Lua scripts run on an embedded interpreter
+HAS_LUA: bool = importlib.util.find_spec("lupa") is not None
+
+
+class ReportQueueTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.redis: InProcessRedis = InProcessRedis()
+        self.queue: ReportQueue = ReportQueue(self.redis, 0, "w1")
+        self.redis.rpush(queue_name(0), b"r1", b"r2", b"r3")
+
+    def _kill(self, queue: ReportQueue) -> None:
+        """Let the heartbeat of `queue`'s worker expire."""
+        self.redis.delete(queue.heartbeat)
+
+    def test_fetch_and_ack(self) -> None:
+
+        """A fetched batch stays in flight until acknowledged, poison messages go to the dead-letter queue."""
+
+        self.assertFalse(self.queue.beat())
+        batch: List[bytes] = self.queue.fetch(2, 0)
+        self.assertEqual(batch, [b"r1", b"r2"])
+        self.assertEqual(self.redis.lrange(self.queue.processing, 0, -1), [b"r1", b"r2"])
+        self.assertEqual(self.redis.lrange(queue_name(0), 0, -1), [b"r3"])
+
+        self.queue.ack(batch, dead=[b"r2"])
+        self.assertEqual(self.redis.llen(self.queue.processing), 0)
+        self.assertEqual(self.redis.lrange(DEAD_LETTER_QUEUE, 0, -1), [b"r2"])
+
+    @unittest.skipUnless(HAS_LUA, "lupa is not installed")
+    def test_reap_requeues_then_dead_letters(self) -> None:
+
+        """A batch left by dead workers goes back to the head of its queue, until it reached the max deliveries."""
+
+        self.queue.beat()
+        self.queue.fetch(2, 0)
+
+        # alive: left alone
+        self.assertEqual(ReportQueue.reap(self.redis, 2), (0, 0))
+
+        self._kill(self.queue)
+        self.assertEqual(ReportQueue.reap(self.redis, 2), (2, 0))
+        self.assertEqual(self.redis.lrange(queue_name(0), 0, -1), [b"r1", b"r2", b"r3"])
+        self.assertEqual(self.redis.hgetall(self.queue.deliveries), {b"r1": b"1", b"r2": b"1"})
+
+        # only the redelivering shard is told so
+        self.assertTrue(ReportQueue(self.redis, 0, "w2").beat())
+        self.assertFalse(ReportQueue(self.redis, 1, "w3").beat())
+
+        # the next worker dies on the same reports: they are dead-lettered
+        second: ReportQueue = ReportQueue(self.redis, 0, "w4")
+        second.beat()
+        self.assertEqual(second.fetch(2, 0), [b"r1", b"r2"])
+        self._kill(second)
+        self.assertEqual(ReportQueue.reap(self.redis, 2), (0, 2))
+        self.assertEqual(self.redis.lrange(DEAD_LETTER_QUEUE, 0, -1), [b"r2", b"r1"])
+        self.assertEqual(self.redis.lrange(queue_name(0), 0, -1), [b"r3"])
+        self.assertFalse(self.redis.exists(second.processing, self.queue.deliveries))
+
+    @unittest.skipUnless(HAS_LUA, "lupa is not installed")
+    def test_ack_clears_deliveries(self) -> None:
+
+        """A redelivered report that is finally processed is no longer counted."""
+
+        self.queue.beat()
+        self.queue.fetch(1, 0)
+        self._kill(self.queue)
+        ReportQueue.reap(self.redis, 5)
+
+        survivor: ReportQueue = ReportQueue(self.redis, 0, "w2")
+        self.assertTrue(survivor.beat())
+        survivor.ack(survivor.fetch(1, 0))
+        self.assertFalse(survivor.beat())
+
+
+class ReportProducerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.redis: InProcessRedis = InProcessRedis()
+
+    def test_unbounded_push(self) -> None:
+
+        """Reports keep their order within each queue."""
+
+        producer: ReportProducer = ReportProducer(self.redis, max_depth=0)
+        self.assertEqual(producer.push([("a", b"1"), ("b", b"2"), ("a", b"3")]), {"a": 2, "b": 1})
+        self.assertEqual(producer.push([("a", b"4")]), {"a": 3})
+        self.assertEqual(self.redis.lrange("a", 0, -1), [b"1", b"3", b"4"])
+
+    @unittest.skipUnless(HAS_LUA, "lupa is not installed")
+    def test_bounded_push(self) -> None:
+
+        """A push that would overflow any of its queues pushes nothing."""
+
+        producer: ReportProducer = ReportProducer(self.redis, max_depth=3)
+        self.assertEqual(producer.push([("a", b"1"), ("b", b"2"), ("a", b"3")]), {"a": 2, "b": 1})
+
+        with self.assertRaises(QueueFull) as raised:
+            producer.push([("b", b"4"), ("a", b"5"), ("a", b"6")])
+        self.assertEqual((raised.exception.queue, raised.exception.depth), ("a", 2))
+        self.assertEqual(self.redis.llen("b"), 1)
+
+        self.assertEqual(producer.push([("a", b"5")]), {"a": 3})
+
+    @unittest.skipUnless(HAS_LUA, "lupa is not installed")
+    def test_bounded_push_large_batch(self) -> None:
+
+        """Batches longer than a Lua stack are pushed in chunks."""
+
+        producer: ReportProducer = ReportProducer(self.redis, max_depth=10000)
+        payloads: List[bytes] = [str(i).encode() for i in range(2500)]
+        self.assertEqual(producer.push([("a", p) for p in payloads]), {"a": 2500})
+        self.assertEqual(self.redis.lrange("a", 0, -1), payloads)
+
+
+class _Stop(Exception):
+    pass
+
+
+class RoutineRetryTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+            self.db.fill_types()
+        self.redis: InProcessRedis = InProcessRedis()
+        self.routine: Routine = Routine(self.db, batch_size=8, batch_wait_ms=0, shard=0)
+
+    def test_transient_error_retries_the_batch(self) -> None:
+
+        """A locked database retries the same batch, without counting a delivery or losing it."""
+
+        self.redis.rpush(queue_name(0), b"r1", b"r2")
+        batches: List[List[bytes]] = []
+
+        def process(raw_messages: List[bytes]) -> List[bytes]:
+            batches.append(list(raw_messages))
+            if len(batches) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            return []
+
+        fetch: Any = ReportQueue.fetch
+
+        def fetch_until_empty(queue: ReportQueue, *args: Any) -> List[bytes]:
+            batch: List[bytes] = fetch(queue, *args)
+            if not batch:
+                raise _Stop()
+            return batch
+
+        with mock.patch("core.routine.Redis", return_value=self.redis), \
+                mock.patch("core.routine.time.sleep") as sleep, \
+                mock.patch.object(self.routine, "_process_batch", side_effect=process), \
+                mock.patch.object(ReportQueue, "fetch", fetch_until_empty), \
+                contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(_Stop):
+                self.routine.run()
+
+        self.assertEqual(batches, [[b"r1", b"r2"], [b"r1", b"r2"]])
+        sleep.assert_called_once()
+        self.assertEqual([k for k in self.redis.data if ":processing:" in k or k.endswith(":deliveries")], [])
+        self.assertEqual(self.redis.llen(queue_name(0)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Validation and wire formats of `ReportMessage`. \n
+Usage: python -m unittest tests.test_report_message
+"""
+
+from core import ReportMessage
+from core.report_message import MSGPACK_V1
+from db import ReportType
+from typing import Any, Dict, List, Union
+import unittest
+import msgpack
+import json
+
+
+VALID: Dict[str, Any] = {
+    "user_name": "alice",
+    "user_location": [50.06, 19.94],
+    "location_name": "trip@stop",
+    "location_pos": {"latitude": 50.07, "longitude": 19.95},
+    "report_type": "DELAY",
+    "delay_minutes": 5
+}
+
+
+class ValidationTest(unittest.TestCase):
+
+    def test_valid(self) -> None:
+
+        message: ReportMessage = ReportMessage.from_dict(VALID)
+        self.assertEqual(message.location_pos, (50.07, 19.95))
+        self.assertEqual(message.report_type, ReportType.DELAY)
+        self.assertIsNone(ReportMessage.from_dict({**VALID, "delay_minutes": None}).delay_minutes)
+        self.assertEqual(ReportMessage.from_dict({**VALID, "delay_minutes": 5.0}).delay_minutes, 5)
+
+    def test_invalid_fields(self) -> None:
+
+        """Every malformed field is rejected with a `ValueError`."""
+
+        for field, value in [
+            ("report_type", "LATE"),
+            ("report_type", None),
+            ("delay_minutes", -1),
+            ("delay_minutes", 2.5),
+            ("delay_minutes", True),
+            ("delay_minutes", "5"),
+            ("user_location", [50.0]),
+            ("user_location", [91.0, 0.0]),
+            ("user_location", [float("nan"), 0.0]),
+            ("location_pos", {"latitude": "50", "longitude": 19.0}),
+            ("user_name", ""),
+            ("location_name", 7),
+        ]:
+            with self.subTest(field=field, value=value), self.assertRaises(ValueError):
+                ReportMessage.from_dict({**VALID, field: value})
+
+        with self.assertRaises(ValueError):
+            ReportMessage.from_dict([VALID])
+
+    def test_decode_array(self) -> None:
+
+        """Each report of a batch body is decoded or rejected on its own."""
+
+        decoded: List[Union[ReportMessage, ValueError]] = ReportMessage.decode_array(
+            json.dumps([VALID, {**VALID, "delay_minutes": -1}, VALID])
+        )
+        self.assertEqual([type(m) for m in decoded], [ReportMessage, ValueError, ReportMessage])
+
+        with self.assertRaises(ValueError):
+            ReportMessage.decode_array(json.dumps(VALID))
+
+
+class WireFormatTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.message: ReportMessage = ReportMessage.from_dict(VALID)
+
+    def test_round_trip(self) -> None:
+
+        for fmt in ("json", "msgpack"):
+            with self.subTest(fmt=fmt):
+                self.assertEqual(ReportMessage.from_wire(self.message.to_wire(fmt)), self.message)
+        self.assertTrue(self.message.to_wire("msgpack").startswith(MSGPACK_V1))
+
+        with self.assertRaises(ValueError):
+            self.message.to_wire("xml")
+
+    def test_decode_many(self) -> None:
+
+        """A batch mixing both formats and poison reports decodes in order."""
+
+        raws: List[bytes] = [
+            self.message.to_wire("msgpack"),
+            b"{not json",
+            self.message.to_wire("json"),
+            MSGPACK_V1 + msgpack.packb(["alice", 50.0]),
+            MSGPACK_V1 + b"\xc1",
+        ]
+        decoded: List[Union[ReportMessage, ValueError]] = ReportMessage.decode_many(raws)
+        self.assertEqual(decoded[0], self.message)
+        self.assertIsInstance(decoded[1], ValueError)
+        self.assertEqual(decoded[2], self.message)
+        self.assertIsInstance(decoded[3], ValueError)
+        self.assertIsInstance(decoded[4], ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
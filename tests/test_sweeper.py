@@ -0,0 +1,67 @@
+"""
+Expiry of stale incidents by the `Sweeper`. \n
+Usage: python -m unittest tests.test_sweeper
+"""
+
+from core.sweeper import Sweeper
+from db import Database, GeneralRepository, IncidentRepository, migrate
+from typing import Dict, Optional
+import contextlib
+import unittest
+import io
+
+
+class SweepTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.db: Database = Database(":memory:")
+            migrate(self.db, background=False)
+            self.db.fill_types()
+        self.incidents: IncidentRepository = IncidentRepository(self.db)
+        self.location: int = GeneralRepository(self.db).add_location("trip@stop", (50.0, 19.9))
+
+    def _incident(self, avg_delay: Optional[float], minutes_ago: float) -> int:
+
+        """An active incident last updated `minutes_ago`."""
+
+        iid: int = self.incidents.add_incident(self.location, 1, avg_delay, 0.5)
+        self.db.execute(
+            "UPDATE incidents SET last_updated = datetime('now', 'utc', ?) WHERE id = ?",
+            (f"-{minutes_ago} minutes", iid)
+        )
+        return iid
+
+    def _sweep(self, sweeper: Sweeper) -> Dict[int, str]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sweeper.sweep()
+        return {r[0]: r[1] for r in self.db.execute("SELECT id, status FROM incidents")}
+
+    def test_delay_and_grace(self) -> None:
+
+        """An incident expires once its remaining delay and the grace period are over."""
+
+        over: int = self._incident(10, 16)
+        within_grace: int = self._incident(10, 14)
+        delayed: int = self._incident(60, 30)
+
+        statuses: Dict[int, str] = self._sweep(Sweeper(self.db, grace_minutes=5, batch_size=1, default_ttl_minutes=60))
+        self.assertEqual(statuses, {over: "resolved", within_grace: "active", delayed: "active"})
+
+    def test_default_ttl(self) -> None:
+
+        """An incident without a delay lives the default TTL, or until resolved otherwise with a TTL of 0."""
+
+        expired: int = self._incident(None, 70)
+        fresh: int = self._incident(None, 30)
+
+        statuses: Dict[int, str] = self._sweep(Sweeper(self.db, grace_minutes=5, default_ttl_minutes=0))
+        self.assertEqual(statuses, {expired: "active", fresh: "active"})
+
+        statuses = self._sweep(Sweeper(self.db, grace_minutes=5, default_ttl_minutes=60))
+        self.assertEqual(statuses, {expired: "resolved", fresh: "active"})
+
+
+if __name__ == "__main__":
+    unittest.main()
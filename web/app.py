@@ -4,22 +4,42 @@ SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
 from redis import Redis
-from flask import Flask, request, Response
+from flask import Flask, request, Response, stream_with_context
 import json
 import time
+import hashlib
+import math
 import datetime
 from dotenv import load_dotenv
-from db import Database, IncidentRepository, GeneralRepository, ReportRepository
+# before `core` and `db`, which read their settings from the environment at import
+load_dotenv()
+
+from db import ConnectionPool, Database, IncidentRepository, GeneralRepository, ReportRepository, query_stats, render_prometheus
+from core import Decider, QueueFull, ReportMessage, ReportProducer, WIRE_FORMATS, queue_name, shard_for
 from google.transit import gtfs_realtime_pb2
-from typing import List, Dict, Any
+from typing import Callable, Iterator, List, Dict, Any, Optional, Tuple
+from dataclasses import dataclass
 
 
 app = Flask(__name__)
-load_dotenv()
 
 
 # Configure Redis connection
 redis_conn = Redis(host=os.getenv("REDIS_HOST", "redis"), port=os.getenv("REDIS_PORT", 6379), db=os.getenv("REDIS_DB", 0))
+# One read-only connection per thread, opened lazily in each gunicorn worker.
+# The schema is migrated by the routine worker, not by the API.
+db_pool: ConnectionPool = ConnectionPool(os.getenv("DB_PATH"), read_only=True)
+
+# encoding of the queued reports, the workers decode every format
+QUEUE_WIRE_FORMAT: str = os.getenv("QUEUE_WIRE_FORMAT", "json")
+if QUEUE_WIRE_FORMAT not in WIRE_FORMATS:
+    raise ValueError(f"QUEUE_WIRE_FORMAT must be one of {', '.join(WIRE_FORMATS)}")
+
+# reports are refused with a 429 once a shard queue holds MAX_QUEUE_DEPTH of them
+producer: ReportProducer = ReportProducer(redis_conn)
+QUEUE_RETRY_AFTER: int = int(os.getenv("QUEUE_RETRY_AFTER", 1))  # seconds
+ENQUEUE_BATCH_MAX: int = int(os.getenv("ENQUEUE_BATCH_MAX", 500))  # reports per /enqueue/batch request
+
 TIME_THRESHOLD_MINUTES = 60  # 1 hour
 SEVERITY_THRESHOLD_MINUTES = 30  # 30 minutes
 
@@ -28,28 +48,153 @@ SEVERITY_THRESHOLD_MINUTES = 30  # 30 minutes
 @app.route('/enqueue', methods=['POST'])
 def enqueue_report() -> Response:
 
-    data: dict = request.json
-    if not data:
-        return {"error": "Invalid payload"}, 400
-    
-    print(data)
-    
+    # validated up front, a bad payload never reaches the queue
+    raw: bytes = request.get_data()
     try:
-        redis_conn.rpush('report_queue', json.dumps(data))
+        report: ReportMessage = ReportMessage.from_json(raw)
+    except ValueError as e:
+        return {"error": f"Invalid payload: {e}"}, 400
+
+    # one queue per shard, a location always lands on the same worker
+    queue: str = queue_name(shard_for(report.location_name))
+
+    # JSON is queued as received, without encoding it again
+    payload: bytes = raw if QUEUE_WIRE_FORMAT == "json" else report.to_wire(QUEUE_WIRE_FORMAT)
+    try:
+        lengths: Dict[str, int] = producer.push([(queue, payload)])
+    except QueueFull as e:
+        return _queue_full(e)
     except Exception as e:
         app.logger.error(f"Redis error: {e}")
         return {"error": "Could not enqueue report"}, 500
 
-    queue_length: int = redis_conn.llen('report_queue')
-    print(f"[QUEUE] report_queue size = {queue_length}")
-    return {"status": "Report enqueued", "queue_size": queue_length}, 200
+    return {"status": "Report enqueued", "queue_size": lengths[queue]}, 200
 
 
-# GTFS-Realtime Trip Updates endpoint
-@app.route('/gtfs/trip-updates', methods=['GET'])
-def trip_updates() -> None:
+# bulk enqueue endpoint, a JSON array of reports pushed in one round trip
+@app.route('/enqueue/batch', methods=['POST'])
+def enqueue_reports() -> Response:
+
+    try:
+        decoded: List[Any] = ReportMessage.decode_array(request.get_data())
+    except ValueError as e:
+        return {"error": f"Invalid payload: {e}"}, 400
+
+    if not decoded:
+        return {"error": "Invalid payload: no reports"}, 400
+    if len(decoded) > ENQUEUE_BATCH_MAX:
+        return {"error": f"Too many reports, at most {ENQUEUE_BATCH_MAX} per batch"}, 413
+
+    # all or nothing, like the push itself
+    errors: Dict[int, str] = {i: str(r) for i, r in enumerate(decoded) if isinstance(r, ValueError)}
+    if errors:
+        return {"error": "Invalid payload", "errors": errors}, 400
+
+    reports: List[ReportMessage] = decoded
+    try:
+        lengths: Dict[str, int] = producer.push([
+            (queue_name(shard_for(r.location_name)), r.to_wire(QUEUE_WIRE_FORMAT)) for r in reports
+        ])
+    except QueueFull as e:
+        return _queue_full(e)
+    except Exception as e:
+        app.logger.error(f"Redis error: {e}")
+        return {"error": "Could not enqueue reports"}, 500
+
+    return {"status": "Reports enqueued", "count": len(reports), "queue_sizes": lengths}, 200
+
+
+def _queue_full(e: QueueFull) -> Tuple[Dict[str, Any], int, Dict[str, str]]:
+
+    """429 answer asking the client to come back once the workers caught up."""
+
+    return (
+        {"error": "Queue is full, retry later", "queue_size": e.depth},
+        429,
+        {"Retry-After": str(QUEUE_RETRY_AFTER)}
+    )
+
+
+# GTFS-Realtime Trip Updates feed cache
+@dataclass
+class FeedEntry:
+
+    """A serialized trip-updates feed along with its cache metadata."""
+
+    data: bytes
+    etag: str
+    version: Optional[int]
+    built_at: float
+    modified_at: int
+
+
+FEED_CACHE_KEY = 'gtfs_feed'
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", 30))  # seconds, bounds drift of the time window
+feed_cache: Optional[FeedEntry] = None
+
+
+def _incidents_version() -> Optional[int]:
+
+    """Current incidents version published by the worker, None if Redis is unreachable."""
+
+    try:
+        raw: Optional[bytes] = redis_conn.get('incidents_version')
+    except Exception as e:
+        app.logger.error(f"Redis error: {e}")
+        return None
+    return int(raw) if raw is not None else 0
+
+
+def _is_fresh(entry: Optional[FeedEntry], version: Optional[int]) -> bool:
+    """Whether a cached feed can still be served for the given incidents version."""
+    return entry is not None and entry.version == version \
+        and time.time() - entry.built_at < FEED_CACHE_TTL
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
+
+def _load_shared_feed() -> Optional[FeedEntry]:
+
+    """Fetch the feed cached in Redis by any gunicorn worker."""
+
+    try:
+        raw: Dict[bytes, bytes] = redis_conn.hgetall(FEED_CACHE_KEY)
+    except Exception as e:
+        app.logger.error(f"Redis error: {e}")
+        return None
+
+    if not raw:
+        return None
+
+    return FeedEntry(
+        data=raw[b'data'],
+        etag=raw[b'etag'].decode(),
+        version=int(raw[b'version']),
+        built_at=float(raw[b'built_at']),
+        modified_at=int(raw[b'modified_at'])
+    )
+
+
+def _store_shared_feed(entry: FeedEntry) -> None:
+
+    """Share a freshly built feed with the other gunicorn workers."""
+
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.hset(FEED_CACHE_KEY, mapping={
+            'data': entry.data,
+            'etag': entry.etag,
+            'version': entry.version,
+            'built_at': entry.built_at,
+            'modified_at': entry.modified_at
+        })
+        pipe.expire(FEED_CACHE_KEY, int(FEED_CACHE_TTL) + 1)
+        pipe.execute()
+    except Exception as e:
+        app.logger.error(f"Redis error: {e}")
+
+
+def _build_trip_updates(db: Database) -> gtfs_realtime_pb2.FeedMessage:
+
+    """Build the GTFS-Realtime feed from the recent active incidents."""
 
     feed: gtfs_realtime_pb2.FeedMessage = gtfs_realtime_pb2.FeedMessage()
     feed.header.gtfs_realtime_version = '2.0'
@@ -60,10 +205,9 @@ def trip_updates() -> None:
                    ).replace(tzinfo=datetime.timezone.utc)
 
     incident_repo: IncidentRepository = IncidentRepository(db)
-    general_repo: GeneralRepository = GeneralRepository(db)
-    incidents: List[Dict[str, Any]] = incident_repo.get_incidents_since(cutoff_time)
+    incidents: List[Dict[str, Any]] = incident_repo.get_incidents_since_detailed(cutoff_time)
 
-    print(f"[GTFS] Found {len(incidents)} active incidents.")
+    app.logger.debug(f"[GTFS] Found {len(incidents)} active incidents.")
 
     # Process each incident and create trip updates
     for incident in incidents:
@@ -75,11 +219,7 @@ def trip_updates() -> None:
         if incident['status'] == 'active' and incident['avg_delay'] > 0:
 
             # Assuming location_name is formatted as "tripid_stopid"
-            location_id = incident.get('location_id')
-            location = general_repo.get_location_by_id(location_id)
-            trip_id, stop_id = location['name'].split('@')
-
-            print(f"Processing incident {incident['id']} for trip {trip_id} at stop {stop_id}")
+            trip_id, stop_id = incident['location_name'].split('@')
 
             # Create a new trip update entity
             entity = feed.entity.add()
@@ -107,34 +247,271 @@ def trip_updates() -> None:
             else:
                 stop_time_update.schedule_relationship = stop_time_update.SCHEDULED
 
+    return feed
+
+
+def _current_feed() -> FeedEntry:
+
+    """
+    Return the trip-updates feed, rebuilding it only when the worker changed
+    an incident (new incidents version) or the cached copy outlived its TTL.
+    """
+
+    global feed_cache
+
+    version: Optional[int] = _incidents_version()
+    if _is_fresh(feed_cache, version):
+        return feed_cache
+
+    # another gunicorn worker may have rebuilt it already
+    shared: Optional[FeedEntry] = _load_shared_feed() if version is not None else None
+    if _is_fresh(shared, version):
+        feed_cache = shared
+        return feed_cache
+
+    feed: gtfs_realtime_pb2.FeedMessage = _build_trip_updates(db_pool.get())
+
+    # the ETag only covers the entities so a rebuild with the same content,
+    # but a newer header timestamp, still answers 304 to pollers
+    digest = hashlib.sha1()
+    for entity in feed.entity:
+        digest.update(entity.SerializeToString())
+    etag: str = digest.hexdigest()
+
+    previous: Optional[FeedEntry] = feed_cache or shared
+    now: float = time.time()
+    modified_at: int = previous.modified_at if previous and previous.etag == etag else int(now)
+
+    feed_cache = FeedEntry(
+        data=feed.SerializeToString(),
+        etag=etag,
+        version=version,
+        built_at=now,
+        modified_at=modified_at
+    )
+    if version is not None:
+        _store_shared_feed(feed_cache)
+    return feed_cache
+
+
+# GTFS-Realtime Trip Updates endpoint
+@app.route('/gtfs/trip-updates', methods=['GET'])
+def trip_updates() -> Response:
+
+    entry: FeedEntry = _current_feed()
+
     # Serialize and return the feed
     response = Response(
-        feed.SerializeToString(),
+        entry.data,
         mimetype='application/x-protobuf',
         headers={
             'Content-Disposition': 'attachment; filename=trip_updates.pb'
         }
     )
+    response.set_etag(entry.etag)
+    response.last_modified = datetime.datetime.fromtimestamp(entry.modified_at, tz=datetime.timezone.utc)
+
+    # answers 304 on a matching If-None-Match / If-Modified-Since
+    return response.make_conditional(request)
+
+
+# Keyset pagination and streaming of the listing endpoints
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+STREAM_FLUSH_ROWS = 256  # rows serialized per chunk of a streamed response
+
+
+@dataclass
+class Page:
+
+    """Requested slice of a listing: rows with an id below `after_id`, newest first."""
+
+    after_id: Optional[int]
+    limit: Optional[int]
+    stream: bool
+
+
+def _parse_page(args: Dict[str, str]) -> Optional[Page]:
+
+    """
+    Read `?after_id=&limit=` and `?stream=1` from the query string, None when
+    none is given (the whole listing, as a single JSON document). \n
+    Raises ValueError on a malformed value.
+    """
+
+    stream: bool = args.get('stream', '').lower() in ('1', 'true', 'yes')
+    if 'after_id' not in args and 'limit' not in args and not stream:
+        return None
+
+    after_id: Optional[int] = int(args['after_id']) if args.get('after_id') else None
+    limit: Optional[int] = int(args['limit']) if args.get('limit') else None
+    if limit is not None and not 0 < limit <= PAGE_SIZE_MAX:
+        raise ValueError(f"limit must be between 1 and {PAGE_SIZE_MAX}")
+
+    if not stream and limit is None:
+        limit = PAGE_SIZE_DEFAULT
+    return Page(after_id, limit, stream)
+
+
+def _stream_json_array(rows: Iterator[Dict[str, Any]]) -> Iterator[str]:
+
+    """Serialize rows as one JSON array, a few rows per chunk."""
+
+    yield '['
+    chunk: List[str] = []
+    first: bool = True
+    for row in rows:
+        chunk.append(json.dumps(row, default=str))
+        if len(chunk) >= STREAM_FLUSH_ROWS:
+            yield ('' if first else ',') + ','.join(chunk)
+            chunk, first = [], False
+    if chunk:
+        yield ('' if first else ',') + ','.join(chunk)
+    yield ']'
+
+
+def _page_response(fetch: Callable[..., Iterator[Dict[str, Any]]], page: Page) -> Response:
+
+    """
+    Answer a listing request with `fetch(after_id=, limit=)`. \n
+    A streamed response is serialized while the rows are read from the
+    cursor, so it never holds the listing in memory. A page is returned whole,
+    with the `after_id` of the next page in the `X-Next-After-Id` header
+    (absent on the last page).
+    """
+
+    if page.stream:
+        return Response(
+            stream_with_context(_stream_json_array(fetch(after_id=page.after_id, limit=page.limit))),
+            mimetype='application/json'
+        )
+
+    # one extra row tells whether a next page exists
+    rows: List[Dict[str, Any]] = list(fetch(after_id=page.after_id, limit=page.limit + 1))
+    response = Response(
+        json.dumps(rows[:page.limit], default=str),  # default=str to handle datetime serialization
+        mimetype='application/json'
+    )
+    if len(rows) > page.limit:
+        response.headers['X-Next-After-Id'] = str(rows[page.limit - 1]['id'])
     return response
 
 
+# Spatial filters of the incidents endpoint
+@dataclass
+class Area:
+
+    """
+    A circle around `center` (lat, lon), optionally narrowed to a bounding
+    box given as (min_lat, min_lon, max_lat, max_lon).
+    """
+
+    center: Tuple[float, float]
+    radius_km: float
+    bbox: Optional[Tuple[float, float, float, float]] = None
+
+    def contains(self, pos: Tuple[float, float]) -> Optional[float]:
+
+        """Distance in km from the center if `pos` is inside the area, None otherwise."""
+
+        if pos[0] is None or pos[1] is None:
+            return None
+
+        if self.bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if not (min_lat <= pos[0] <= max_lat and min_lon <= pos[1] <= max_lon):
+                return None
+
+        distance: float = Decider.haversine(*self.center, *pos)
+        if self.bbox is None and distance > self.radius_km:
+            return None
+        return distance
+
+
+def _parse_area(args: Dict[str, str]) -> Optional[Area]:
+
+    """
+    Read `?bbox=min_lon,min_lat,max_lon,max_lat` or `?lat=&lon=&radius_km=`
+    from the query string, None when neither is given. \n
+    Raises ValueError on a malformed filter.
+    """
+
+    if args.get('bbox'):
+        min_lon, min_lat, max_lon, max_lat = map(float, args['bbox'].split(','))
+        if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+            raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+
+        # the index is queried with the circle enclosing the box, then filtered exactly
+        center: Tuple[float, float] = ((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+        radius_km: float = max(
+            Decider.haversine(*center, lat, lon)
+            for lat in (min_lat, max_lat) for lon in (min_lon, max_lon)
+        ) if max_lon - min_lon <= 180 else math.pi * 6371  # wider than a hemisphere: whole globe
+        return Area(center, radius_km * 1.01 + 0.001, (min_lat, min_lon, max_lat, max_lon))
+
+    if args.get('lat') or args.get('lon') or args.get('radius_km'):
+        lat, lon, radius_km = float(args['lat']), float(args['lon']), float(args['radius_km'])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180 and radius_km > 0):
+            raise ValueError("lat, lon and radius_km out of range")
+        return Area((lat, lon), radius_km)
+
+    return None
+
+
+def _incidents_in_area(db: Database, area: Area) -> List[Dict[str, Any]]:
+
+    """
+    Active incidents located in `area`, each with its `distance_km` from the
+    center. Candidate locations come from the in-memory location index, only
+    their incidents are read from the database.
+    """
+
+    general_repo: GeneralRepository = GeneralRepository(db)
+    location_ids: List[int] = [lid for lid, _ in general_repo.get_locations_within(area.center, area.radius_km)]
+    if not location_ids:
+        return []
+
+    incident_repo: IncidentRepository = IncidentRepository(db)
+    incidents: List[Dict[str, Any]] = []
+    for incident in incident_repo.list_incidents_detailed(status='active', location_ids=location_ids):
+        distance: Optional[float] = area.contains(incident['coords'])
+        if distance is not None:
+            incident['distance_km'] = distance
+            incidents.append(incident)
+
+    if area.bbox is None:
+        incidents.sort(key=lambda x: x['distance_km'])
+    return incidents
+
+
 # Public API endpoint to get all incidents with enriched location names
 @app.route('/api/incidents', methods=['GET'])
 def get_incidents() -> Response:
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
-    incident_repo: IncidentRepository = IncidentRepository(db)
-    general_repo: GeneralRepository = GeneralRepository(db)
-    incidents: List[Dict[str, Any]] = incident_repo.list_incidents()
+    try:
+        area: Optional[Area] = _parse_area(request.args)
+    except (KeyError, ValueError) as e:
+        return {"error": f"Invalid spatial filter: {e}"}, 400
 
-    # Enrich incidents with location names
-    for incident in incidents:
-        location_id = incident.get('location_id')
-        if location_id:
-            location = general_repo.get_location_by_id(location_id)
-            incident['location_name'] = location['name'] if location else 'Unknown'
-        else:
-            incident['location_name'] = 'Unknown'
+    try:
+        page: Optional[Page] = _parse_page(request.args)
+    except ValueError as e:
+        return {"error": f"Invalid pagination: {e}"}, 400
+
+    if area is not None and page is not None:
+        return {"error": "Spatial filters cannot be paginated"}, 400
+
+    db: Database = db_pool.get()
+
+    if page is not None:
+        return _page_response(IncidentRepository(db).iter_incidents_detailed, page)
+
+    if area is not None:
+        # active incidents only, closest first for a radius query
+        incidents: List[Dict[str, Any]] = _incidents_in_area(db, area)
+    else:
+        # Incidents come enriched with location and type names in a single query
+        incidents: List[Dict[str, Any]] = IncidentRepository(db).list_incidents_detailed()
 
     return Response(
         json.dumps(incidents, default=str),  # default=str to handle datetime serialization
@@ -146,8 +523,17 @@ def get_incidents() -> Response:
 @app.route('/api/reports', methods=['GET'])
 def get_reports() -> Response:
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
+    try:
+        page: Optional[Page] = _parse_page(request.args)
+    except ValueError as e:
+        return {"error": f"Invalid pagination: {e}"}, 400
+
+    db: Database = db_pool.get()
     report_repo: ReportRepository = ReportRepository(db)
+
+    if page is not None:
+        return _page_response(report_repo.iter_reports, page)
+
     reports: List[Dict[str, Any]] = report_repo.list_reports()
 
     return Response(
@@ -160,7 +546,7 @@ def get_reports() -> Response:
 @app.route('/api/incidents/<int:incident_id>/reports', methods=['GET'])
 def get_incident_reports(incident_id: int) -> Response:
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
+    db: Database = db_pool.get()
     report_repo: ReportRepository = ReportRepository(db)
     reports: List[Dict[str, Any]] = report_repo.get_reports_by_incident(incident_id)
 
@@ -174,7 +560,7 @@ def get_incident_reports(incident_id: int) -> Response:
 @app.route('/api/types', methods=['GET'])
 def get_types() -> Response:
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
+    db: Database = db_pool.get()
     general_repo: GeneralRepository = GeneralRepository(db)
     types: List[Dict[str, Any]] = general_repo.list_types()
     return Response(
@@ -187,7 +573,7 @@ def get_types() -> Response:
 @app.route('/api/locations', methods=['GET'])
 def get_locations() -> Response:
 
-    db: Database = Database(os.getenv("DB_PATH"))  # ugly but works for now
+    db: Database = db_pool.get()
     general_repo: GeneralRepository = GeneralRepository(db)
     locations: List[Dict[str, Any]] = general_repo.list_locations()
     return Response(
@@ -196,6 +582,17 @@ def get_locations() -> Response:
     )
 
 
+# Prometheus metrics of this API process: per-statement counters (with
+# DB_STATS=1) and the row caches of its connections
+@app.route('/metrics', methods=['GET'])
+def get_metrics() -> Response:
+
+    return Response(
+        render_prometheus(query_stats(), db_pool.cache_stats()),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
 if __name__ == "__main__":
     
     app.run(host=os.getenv("HOST"), port=os.getenv("PORT"), debug=True)
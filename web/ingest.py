@@ -0,0 +1,371 @@
+
+"""
+Asynchronous ingestion front end: the `/enqueue` and `/enqueue/batch`
+endpoints of `web/app.py`, with the same contract, as a plain ASGI app. \n
+Concurrent submissions are coalesced into pipelined pushes, a single Redis
+round trip for however many reports arrived meanwhile, so a burst from the
+mobile app costs a few round trips instead of one blocked thread per report.
+The read endpoints stay on Flask. \n
+Usage: uvicorn web.ingest:app --host 0.0.0.0 --port 5001
+"""
+
+import os, sys
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from redis.asyncio import BlockingConnectionPool, Redis
+from dotenv import load_dotenv
+# before `core` and `db`, which read their settings from the environment at import
+load_dotenv()
+
+from core import QueueFull, ReportMessage, WIRE_FORMATS, queue_name, shard_for
+from core.queue import BOUNDED_PUSH_SCRIPT
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+import asyncio
+import json
+
+
+QUEUE_WIRE_FORMAT: str = os.getenv("QUEUE_WIRE_FORMAT", "json")
+if QUEUE_WIRE_FORMAT not in WIRE_FORMATS:
+    raise ValueError(f"QUEUE_WIRE_FORMAT must be one of {', '.join(WIRE_FORMATS)}")
+
+QUEUE_RETRY_AFTER: int = int(os.getenv("QUEUE_RETRY_AFTER", 1))  # seconds
+ENQUEUE_BATCH_MAX: int = int(os.getenv("ENQUEUE_BATCH_MAX", 500))  # reports per /enqueue/batch request
+MAX_BODY_BYTES: int = ENQUEUE_BATCH_MAX * 1024  # generous for a report, refuses runaway bodies
+
+
+Pending = Tuple[str, bytes, asyncio.Future]
+
+
+class Coalescer:
+
+    """
+    Pushes the reports submitted concurrently in pipelined batches. \n
+    `flushers` tasks take whatever is pending (up to `max_batch` reports) and
+    push it in one round trip. An idle service pushes each report right away,
+    and under load the reports queue up while the flushers wait on Redis, so
+    the batches grow with the load. With a `max_depth`, each report goes
+    through the bounded push script (see `ReportProducer`), still in the same
+    pipeline, and a report refused by a full queue fails with `QueueFull`.
+    """
+
+    def __init__(
+        self,
+        redis_conn: Redis,
+        max_depth: Optional[int] = None,
+        max_batch: Optional[int] = None,
+        flushers: Optional[int] = None
+    ) -> None:
+
+        """
+        Initialize the Coalescer. The settings default to the `MAX_QUEUE_DEPTH`,
+        `INGEST_MAX_BATCH` and `INGEST_FLUSHERS` environment variables.
+        """
+
+        self.redis: Redis = redis_conn
+        self.max_depth: int = max(0, max_depth if max_depth is not None else int(os.getenv("MAX_QUEUE_DEPTH", 0)))
+        self.max_batch: int = max(1, max_batch or int(os.getenv("INGEST_MAX_BATCH", 512)))
+        self.flushers: int = max(1, flushers or int(os.getenv("INGEST_FLUSHERS", 4)))
+        self._bounded_push: Any = redis_conn.register_script(BOUNDED_PUSH_SCRIPT)
+
+        self._pending: List[Pending] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+        # pushes and reports pushed, their ratio is the coalescing factor
+        self.batches: int = 0
+        self.reports: int = 0
+
+    def start(self) -> None:
+
+        """Start the flusher tasks on the running loop (done on first use otherwise)."""
+
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._flush_forever()) for _ in range(self.flushers)]
+
+    async def stop(self) -> None:
+
+        """Push what is still pending, then stop the flusher tasks."""
+
+        while self._pending:
+            await self._flush(self._take())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, queue: str, payload: bytes) -> int:
+
+        """
+        Push a report onto `queue` along with the other pending ones. Returns
+        the length of the queue right after it, raises `QueueFull` if refused.
+        """
+
+        self.start()
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._pending.append((queue, payload, future))
+        self._wakeup.set()
+        return await future
+
+    def _take(self) -> List[Pending]:
+
+        """Take the next batch off the pending reports."""
+
+        batch: List[Pending] = self._pending[:self.max_batch]
+        del self._pending[:self.max_batch]
+        if not self._pending:
+            self._wakeup.clear()
+        return batch
+
+    async def _flush_forever(self) -> None:
+
+        """Flusher task: push pending batches until cancelled."""
+
+        while True:
+            await self._wakeup.wait()
+            # let the requests handled in the same loop iteration join the batch
+            await asyncio.sleep(0)
+            batch: List[Pending] = self._take()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: List[Pending]) -> None:
+
+        """Push a batch in one round trip and settle the futures of its reports."""
+
+        try:
+            results: List[Union[int, QueueFull]] = await self._push(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done(): future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.reports += len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue  # the request went away
+            if isinstance(result, QueueFull): future.set_exception(result)
+            else: future.set_result(result)
+
+    async def _push(self, batch: List[Pending]) -> List[Union[int, QueueFull]]:
+
+        """The queue length after each report, or the `QueueFull` that refused it."""
+
+        pipe: Any = self.redis.pipeline(transaction=False)
+
+        if self.max_depth > 0:
+            for queue, payload, _ in batch:
+                await self._bounded_push(keys=[queue], args=[self.max_depth, 1, payload], client=pipe)
+            replies: List[List[int]] = await pipe.execute()
+            return [
+                reply[1] if reply[0] else QueueFull(queue, reply[2])
+                for (queue, _, _), reply in zip(batch, replies)
+            ]
+
+        # one RPUSH per queue, its reply is the length after the last report
+        queues: Dict[str, List[int]] = {}
+        for i, (queue, _, _) in enumerate(batch):
+            queues.setdefault(queue, []).append(i)
+        for queue, indexes in queues.items():
+            pipe.rpush(queue, *(batch[i][1] for i in indexes))
+        lengths: List[int] = await pipe.execute()
+
+        results: List[Union[int, QueueFull]] = [0] * len(batch)
+        for indexes, length in zip(queues.values(), lengths):
+            for k, i in enumerate(indexes):
+                results[i] = length - len(indexes) + k + 1
+        return results
+
+    async def push_all(self, reports: List[Tuple[str, bytes]]) -> Dict[str, int]:
+
+        """
+        Push a whole `/enqueue/batch` at once, all or nothing, without waiting
+        for other submissions. Returns the new length of every queue pushed to.
+        """
+
+        queues: Dict[str, List[bytes]] = {}
+        for queue, payload in reports:
+            queues.setdefault(queue, []).append(payload)
+
+        if self.max_depth <= 0:
+            pipe: Any = self.redis.pipeline(transaction=False)
+            for queue, payloads in queues.items():
+                pipe.rpush(queue, *payloads)
+            return dict(zip(queues, await pipe.execute()))
+
+        keys: List[str] = list(queues)
+        args: List[Any] = [self.max_depth, *(len(queues[k]) for k in keys)]
+        for k in keys:
+            args.extend(queues[k])
+        result: List[int] = await self._bounded_push(keys=keys, args=args)
+        if not result[0]:
+            raise QueueFull(keys[result[1] - 1], result[2])
+        return dict(zip(keys, result[1:]))
+
+
+class IngestApp:
+
+    """
+    ASGI application serving `POST /enqueue` and `POST /enqueue/batch`.
+    Reports are validated before anything is queued, exactly like the Flask
+    endpoints, and a full queue answers 429 with `Retry-After`.
+    """
+
+    def __init__(self, redis_conn: Optional[Redis] = None) -> None:
+
+        """
+        Initialize the app. By default Redis is reached through a pool of at most
+        `INGEST_REDIS_POOL` connections, shared by every request of the process.
+        """
+
+        if redis_conn is None:
+            pool: BlockingConnectionPool = BlockingConnectionPool(
+                host=os.getenv("REDIS_HOST", "redis"),
+                port=int(os.getenv("REDIS_PORT", 6379)),
+                db=int(os.getenv("REDIS_DB", 0)),
+                max_connections=int(os.getenv("INGEST_REDIS_POOL", 16))
+            )
+            redis_conn = Redis(connection_pool=pool)
+
+        self.redis: Redis = redis_conn
+        self.coalescer: Coalescer = Coalescer(redis_conn)
+        self.routes: Dict[str, Callable[[bytes], Awaitable[Tuple[int, Dict[str, Any], Dict[str, str]]]]] = {
+            "/enqueue": self.enqueue_report,
+            "/enqueue/batch": self.enqueue_reports,
+        }
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        handler: Optional[Callable] = self.routes.get(scope["path"].rstrip("/") or "/")
+        if handler is None:
+            await self._respond(send, 404, {"error": "Not found"})
+            return
+        if scope["method"] != "POST":
+            await self._respond(send, 405, {"error": "Method not allowed"}, {"Allow": "POST"})
+            return
+
+        body: Optional[bytes] = await self._read_body(receive)
+        if body is None:
+            await self._respond(send, 413, {"error": "Payload too large"})
+            return
+
+        status, payload, headers = await handler(body)
+        await self._respond(send, status, payload, headers)
+
+    async def enqueue_report(self, raw: bytes) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+
+        """Validate and queue a single report, see `/enqueue` in `web/app.py`."""
+
+        try:
+            report: ReportMessage = ReportMessage.from_json(raw)
+        except ValueError as e:
+            return 400, {"error": f"Invalid payload: {e}"}, {}
+
+        queue: str = queue_name(shard_for(report.location_name))
+        payload: bytes = raw if QUEUE_WIRE_FORMAT == "json" else report.to_wire(QUEUE_WIRE_FORMAT)
+        try:
+            length: int = await self.coalescer.submit(queue, payload)
+        except QueueFull as e:
+            return self._queue_full(e)
+        except Exception as e:
+            print(f"[ERROR] Redis error: {e}")
+            return 500, {"error": "Could not enqueue report"}, {}
+
+        return 200, {"status": "Report enqueued", "queue_size": length}, {}
+
+    async def enqueue_reports(self, raw: bytes) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+
+        """Validate and queue a JSON array of reports, all or nothing, see `/enqueue/batch` in `web/app.py`."""
+
+        try:
+            decoded: List[Any] = ReportMessage.decode_array(raw)
+        except ValueError as e:
+            return 400, {"error": f"Invalid payload: {e}"}, {}
+
+        if not decoded:
+            return 400, {"error": "Invalid payload: no reports"}, {}
+        if len(decoded) > ENQUEUE_BATCH_MAX:
+            return 413, {"error": f"Too many reports, at most {ENQUEUE_BATCH_MAX} per batch"}, {}
+
+        errors: Dict[str, str] = {str(i): str(r) for i, r in enumerate(decoded) if isinstance(r, ValueError)}
+        if errors:
+            return 400, {"error": "Invalid payload", "errors": errors}, {}
+
+        try:
+            lengths: Dict[str, int] = await self.coalescer.push_all([
+                (queue_name(shard_for(r.location_name)), r.to_wire(QUEUE_WIRE_FORMAT)) for r in decoded
+            ])
+        except QueueFull as e:
+            return self._queue_full(e)
+        except Exception as e:
+            print(f"[ERROR] Redis error: {e}")
+            return 500, {"error": "Could not enqueue reports"}, {}
+
+        return 200, {"status": "Reports enqueued", "count": len(decoded), "queue_sizes": lengths}, {}
+
+    @staticmethod
+    def _queue_full(e: QueueFull) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        """429 answer asking the client to come back once the workers caught up."""
+        return 429, {"error": "Queue is full, retry later", "queue_size": e.depth}, {"Retry-After": str(QUEUE_RETRY_AFTER)}
+
+    @staticmethod
+    async def _read_body(receive: Callable) -> Optional[bytes]:
+
+        """The request body, or None once it grows past `MAX_BODY_BYTES`."""
+
+        chunks: List[bytes] = []
+        size: int = 0
+        while True:
+            message: Dict[str, Any] = await receive()
+            chunk: bytes = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _respond(send: Callable, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+
+        """Send a JSON response."""
+
+        body: bytes = json.dumps(payload).encode()
+        raw_headers: List[Tuple[bytes, bytes]] = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+        raw_headers.extend((k.lower().encode(), v.encode()) for k, v in (headers or {}).items())
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _lifespan(self, receive: Callable, send: Callable) -> None:
+
+        """Start the flushers with the server, push what is pending on shutdown."""
+
+        while True:
+            message: Dict[str, Any] = await receive()
+            if message["type"] == "lifespan.startup":
+                self.coalescer.start()
+                print(f"[INFO] Ingestion ready ({self.coalescer.flushers} flusher(s), "
+                      f"batches of up to {self.coalescer.max_batch}, {QUEUE_WIRE_FORMAT} wire format).")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.coalescer.stop()
+                print(f"[INFO] Ingestion stopped after {self.coalescer.reports} report(s) "
+                      f"in {self.coalescer.batches} push(es).")
+                await self.redis.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app: IngestApp = IngestApp()